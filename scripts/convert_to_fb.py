@@ -3,84 +3,142 @@
 import os
 import sys
 import argparse
-import glob
 import time
+import threading
 import subprocess
-import itertools
+import multiprocessing
+from Queue import Queue, Empty
 
 
-def convert(dictionary):
+def output_file(datastore_path, hour, level, tile_index):
+  """ where the flatbuffer for a given hour and tile goes: year/month/day/hour/level/index.fb """
+  t = time.gmtime(hour * 3600)
+  return os.path.join(datastore_path, str(t[0]), str(t[1]), str(t[2]), str(t[3]), str(level), str(tile_index) + '.fb')
+
+
+def convert(jobs, tile_writer, concurrency):
+  """ run the jobs, biggest first, over a few long running tile writers.
+  each writer takes one job at a time on stdin and says when its done with
+  it on stdout, so whichever is free gets the next one """
   print('[INFO] running conversion process')
-    
-  print len(dictionary)
-  for key, val in dictionary.items():
-  
-    epoch_seconds=str(key[3])
-    hour = str(int(epoch_seconds.split('_')[0]) // 3600 % 24)
-    tile_bucket_hour = str(int(epoch_seconds.split('_')[0])/3600)
-    level = str(key[1])
-    tile_index = str(key[2])
-    tile_id = str((int(tile_index) << 3) | int(level))
-    date = "/2017/1/1/"
-    file_path = args.datastore_bucket + date + hour + "/" + level + '/' 
-    out_dir = os.path.dirname(file_path)
-    if not os.path.exists(out_dir):
-      os.makedirs(out_dir)
-    
-    fb_out_file = out_dir + '/' + tile_index + '.fb'
-    time_bucket = glob.glob(args.reporter_path + '/' + epoch_seconds + '/' + level + '/' + tile_index + '/*')
-    print time_bucket
-    
+  jobs = sorted(jobs, key=lambda job: job[4], reverse=True)
+  total_bytes = sum([job[4] for job in jobs])
+  print '[INFO] %d jobs over %d inputs totalling %.1fMB on %d writers' % (len(jobs), sum([len(job[3]) for job in jobs]), total_bytes / 1048576.0, concurrency)
+
+  pending = Queue()
+  for job in jobs:
+    pending.put(job)
+  lock = threading.Lock()
+  progress = {'done': 0, 'failed': 0, 'bytes': 0}
+  start = time.time()
+
+  def run():
+    tilewriter = subprocess.Popen([tile_writer, '--jobs', '-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    while True:
+      try:
+        hour, tile_id, fb_out_file, inputs, size = pending.get_nowait()
+      except Empty:
+        break
+      if not os.path.exists(os.path.dirname(fb_out_file)):
+        try:
+          os.makedirs(os.path.dirname(fb_out_file))
+        except OSError:
+          pass
+      status = None
+      try:
+        tilewriter.stdin.write('\t'.join([str(hour), str(tile_id), fb_out_file] + inputs) + '\n')
+        tilewriter.stdin.flush()
+      except IOError:
+        status = 'FAILED'
+        print '[ERROR] datastore-histogram-tile-writer is no longer running'
+      #skip the logging until we hear how the job went
+      while status is None:
+        line = tilewriter.stdout.readline()
+        if not line:
+          status = 'FAILED'
+          print '[ERROR] datastore-histogram-tile-writer exited early'
+        elif line.startswith('OK\t') or line.startswith('FAILED\t'):
+          status = line.split('\t', 1)[0]
+      with lock:
+        progress['done'] += 1
+        progress['bytes'] += size
+        if status != 'OK':
+          progress['failed'] += 1
+          print '[ERROR] Failed to convert ' + fb_out_file
+        elapsed = max(time.time() - start, 0.001)
+        print '[INFO] %d/%d jobs done, %d failed, %.1f jobs/s, %.2fMB/s, %s' % (progress['done'], len(jobs), progress['failed'],
+          progress['done'] / elapsed, progress['bytes'] / 1048576.0 / elapsed, fb_out_file)
+      if status != 'OK' and tilewriter.poll() is not None:
+        break
     try:
-      subprocess.check_output(['target/datastore-histogram-tile-writer', '-b', tile_bucket_hour, '-t', tile_id, '-v', '-f', fb_out_file] + time_bucket, universal_newlines=True, stderr=subprocess.STDOUT)
+      tilewriter.stdin.close()
+    except IOError:
+      pass
+    tilewriter.wait()
+
+  threads = [threading.Thread(target=run) for i in range(0, min(concurrency, len(jobs)))]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  for t in threads:
+    while t.is_alive():
+      t.join(1)
 
-    except subprocess.CalledProcessError as tilewriter:
-      print('[ERROR] Failed running datastore-histogram-tile-writer:', tilewriter.returncode, tilewriter.output)
-      sys.exit([tilewriter.returncode])
-    print('[INFO] Finished running conversion')
+  print '[INFO] Finished running conversion of %d jobs in %.1fs' % (len(jobs), time.time() - start)
+  return progress['failed'] + pending.qsize()
 
 
 def build_dictionary(reporter_buckets, bucket_interval, reporter_path):
     """ create a dictionary with a key of type tuple of (time bucket,
-    tile_level, tile_index), with the value as a list of
-    files: dictionary = {(23, 32, 43): 'tuple as key'}
+    tile_level, tile_index), with the value as a list of every file
+    under any reporter bucket that covers that time bucket:
     dictionary[time_bucket, tile_level, tile_index] = ['/path/1', '/path/2'] """
     dictionary = {}
     for bucket in reporter_buckets:
       epoch_start_seconds = int(bucket.split('_')[0])
       epoch_end_seconds = int(bucket.split('_')[1])
 
-      # calculate the tile id: shift the tile
-      # index 3 bits to the left then add the
-      # tile level.
-      for root, dirs, files in os.walk(reporter_path + '/' + bucket):
-        tile_level = root.rsplit('/',3)[2]
-        tile_index = root.rsplit('/',3)[3]
-
-        for file in files:
-          if (root + os.sep + file):
-            # create the dictionary, sorting on time_bucket, tile_level, tile_index
-            for time_bucket in range(epoch_start_seconds/bucket_interval, epoch_end_seconds/bucket_interval + 1):
-              if (time_bucket, tile_level, tile_index, bucket) in dictionary:
-                  dictionary[(time_bucket, tile_level, tile_index, bucket)]
-              else:
-                  dictionary[(time_bucket, tile_level, tile_index, bucket)] = [bucket]
+      # the reporter output is bucket/tile_level/tile_index/files
+      for root, dirs, files in os.walk(os.path.join(reporter_path, bucket)):
+        parts = os.path.relpath(root, os.path.join(reporter_path, bucket)).split(os.sep)
+        if len(parts) != 2 or not files:
+          continue
+        tile_level, tile_index = parts
+
+        # group them by time_bucket, tile_level, tile_index
+        for time_bucket in range(epoch_start_seconds/bucket_interval, epoch_end_seconds/bucket_interval + 1):
+          dictionary.setdefault((time_bucket, tile_level, tile_index), []).extend([os.path.join(root, f) for f in files])
     return dictionary
 
-            
+
+def make_jobs(dictionary, datastore_path):
+  """ turn the grouped inputs into (time bucket, tile id, output file, inputs, input bytes) """
+  jobs = []
+  for (hour, level, tile_index), inputs in dictionary.iteritems():
+    tile_id = (int(tile_index) << 3) | int(level)
+    size = sum([os.path.getsize(f) for f in inputs])
+    jobs.append((hour, tile_id, output_file(datastore_path, hour, level, int(tile_index)), sorted(inputs), size))
+  return jobs
+
+
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description='Generate flatbuffer tiles from Reporter output', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-  parser.add_argument('--reporter-path', type=str, help='The directory path to the root of the Reporter output containing the epochHour generated folders.')
-  parser.add_argument('--datastore-bucket', type=str, help='The directory path to the where the flatbuffer files are generated.')
+  parser.add_argument('--reporter-path', type=str, help='The directory path to the root of the Reporter output containing the epochHour generated folders.', required=True)
+  parser.add_argument('--datastore-bucket', type=str, help='The directory path to the where the flatbuffer files are generated.', required=True)
+  parser.add_argument('--concurrency', type=int, help='How many conversions to run at once', default=multiprocessing.cpu_count())
+  parser.add_argument('--tile-writer', type=str, help='The datastore-histogram-tile-writer executable to use', default='target/datastore-histogram-tile-writer')
   args = parser.parse_args()
-  
+
   bucket_interval = 3600 # an hour would be 3600
- 
+
   reporter_path = args.reporter_path
   datastore_bucket = args.datastore_bucket
 
-  reporter_buckets = [f for f in next(os.walk(reporter_path))[1]]
+  reporter_buckets = [f for f in next(os.walk(reporter_path))[1] if f.replace('_', '').isdigit()]
   dictionary = build_dictionary(reporter_buckets, bucket_interval, reporter_path)
-  convert(dictionary)
-  
-  print 'done'            
+  failed = convert(make_jobs(dictionary, datastore_bucket), args.tile_writer, args.concurrency)
+  if failed:
+    print '[ERROR] %d jobs did not convert' % failed
+    sys.exit(1)
+
+  print 'done'
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+""" convert reporter csv output into the columnar format the datastore-histogram-tile-writer reads without parsing text """
+
+import os
+import csv
+import gzip
+import struct
+import argparse
+
+#see ColumnarSource.java for the layout
+MAGIC = b'OTCL'
+VERSION = 1
+EXTENSION = '.col'
+BLOCK_ROWS = 65536
+INVALID_NEXT_SEGMENT_ID = 0x3ffffffffff
+VEHICLE_TYPES = ['AUTO']
+COLUMNS = ['segment_id', 'next_segment_id', 'duration', 'count', 'length', 'queue_length', 'minimum_timestamp', 'maximum_timestamp', 'source', 'vehicle_type']
+
+def parse_row(row):
+  #same defaults as MeasurementSource
+  next_segment_id = int(row[1]) if row[1] else INVALID_NEXT_SEGMENT_ID
+  source = row[8] if len(row) > 8 else None
+  vehicle_type = VEHICLE_TYPES.index(row[9]) if len(row) > 9 and row[9] else 0
+  return (int(row[0]), next_segment_id, int(row[2]), int(row[3]), int(row[4]), int(row[5]), int(row[6]), int(row[7]), source, vehicle_type)
+
+def encode_block(rows):
+  columns = list(zip(*rows))
+  sources = sorted(set([s for s in columns[8] if s is not None]))
+  index = dict([(s, i) for i, s in enumerate(sources)])
+  n = len(rows)
+  parts = [struct.pack('>i', len(sources))]
+  for source in sources:
+    encoded = source.encode('utf-8')
+    parts.append(struct.pack('>i', len(encoded)) + encoded)
+  for column, code in zip(columns[:8], 'qqiiiiqq'):
+    parts.append(struct.pack('>%d%s' % (n, code), *column))
+  parts.append(struct.pack('>%di' % n, *[-1 if s is None else index[s] for s in columns[8]]))
+  parts.append(struct.pack('>%db' % n, *columns[9]))
+  body = b''.join(parts)
+  return struct.pack('>ii', n, len(body)) + body
+
+def convert(csv_file, columnar_file):
+  # returns how many rows were written
+  count = 0
+  with open(csv_file, 'r', newline='') as f, gzip.open(columnar_file, 'wb') as out:
+    reader = csv.reader(f)
+    header = next(reader, None)
+    if header is not None and header[:len(COLUMNS)] != COLUMNS[:len(header)]:
+      raise ValueError('Unexpected columns in %s: %s' % (csv_file, ','.join(header)))
+    out.write(MAGIC + struct.pack('>i', VERSION))
+    rows = []
+    for row in reader:
+      if not row:
+        continue
+      rows.append(parse_row(row))
+      if len(rows) == BLOCK_ROWS:
+        out.write(encode_block(rows))
+        count += len(rows)
+        rows = []
+    if rows:
+      out.write(encode_block(rows))
+      count += len(rows)
+  return count
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Convert reporter csv files to the columnar format, each one is written next to the original with ' + EXTENSION + ' on the end')
+  parser.add_argument('csv_files', type=str, nargs='+', help='The reporter csv files to convert')
+  parser.add_argument('--remove', action='store_true', help='Remove each csv file once it has been converted')
+  args = parser.parse_args()
+
+  for csv_file in args.csv_files:
+    columnar_file = csv_file + EXTENSION
+    count = convert(csv_file, columnar_file)
+    print('Wrote %d rows from %s (%d bytes) to %s (%d bytes)' % (count, csv_file, os.path.getsize(csv_file), columnar_file, os.path.getsize(columnar_file)))
+    if args.remove:
+      os.remove(csv_file)
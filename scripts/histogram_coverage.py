@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+""" a per week index of which tiles have histograms, kept in the histogram bucket next to them
+
+every histogram that gets written leaves an empty marker object at coverage/year/week/level/index/hour where the week
+is named the same way as the speed tiles (the year and week of its monday) and the hour is counted from the start of it.
+markers are written independently so the jobs writing histograms never race each other updating a shared file.
+
+histograms written before there were markers, or by anything other than work.py, dont have one. so a week is only
+trusted once it has been backfilled, which marks every histogram already there and then leaves coverage/year/week/complete """
+
+import re
+import time
+import calendar
+import argparse
+import listing
+
+COVERAGE_PREFIX = 'coverage/'
+COMPLETE = 'complete'
+HOURS_PER_WEEK = 24 * 7
+HISTOGRAM_KEY = re.compile(r'^([0-9]+)/([0-9]+)/([0-9]+)/([0-9]+)/([0-9]+)/([0-9]+)\.fb$')
+
+def week_hour(epoch):
+  # the week an epoch second falls in and which hour of that week it is
+  day = epoch - epoch % 86400
+  monday = day - time.gmtime(day).tm_wday * 86400
+  return time.strftime('%Y/%W', time.gmtime(monday)), int((epoch - monday) / 3600)
+
+def week_start(week):
+  # epoch seconds at the start of the monday of a year/week
+  return calendar.timegm(time.strptime(week + '/1', '%Y/%W/%w'))
+
+def week_prefix(week):
+  # always the zero padded name the markers are written under, however the week was spelled
+  return COVERAGE_PREFIX + week_hour(week_start(week.strip('/')))[0] + '/'
+
+def marker_key(epoch, level, index):
+  week, hour = week_hour(epoch)
+  return week_prefix(week) + str(level) + '/' + str(index) + '/' + str(hour)
+
+def mark(client, bucket, epoch, level, index):
+  # record that there is a histogram for this tile in the hour starting at epoch
+  client.put_object(Bucket=bucket, ContentType='binary/octet-stream', Body=b'', Key=marker_key(epoch, level, index))
+
+def covered_tiles(client, bucket, week, concurrency=listing.LIST_CONCURRENCY):
+  # {level: set of tile indices} with data for the week, or None when the index for the week cant be trusted
+  levels, keys = listing.get_prefixes_keys(client, bucket, [week_prefix(week)], concurrency)
+  if week_prefix(week) + COMPLETE not in keys:
+    return None
+  tiles = {}
+  indices, _ = listing.get_prefixes_keys(client, bucket, levels, concurrency)
+  for prefix in indices:
+    level, index = prefix.strip('/').split('/')[-2:]
+    tiles.setdefault(int(level), set()).add(int(index))
+  return tiles
+
+def covered_hours(client, bucket, week, level, index):
+  # the hours of the week for which this tile has data
+  _, keys = listing.get_prefixes_keys(client, bucket, [week_prefix(week) + str(level) + '/' + str(index) + '/'])
+  return sorted([int(key.split('/')[-1]) for key in keys])
+
+def backfill(client, bucket, week, concurrency=listing.LIST_CONCURRENCY):
+  # mark every histogram of the week that doesnt have a marker yet and then mark the week as complete
+  start = week_start(week)
+  days = []
+  for day in range(0, 7):
+    t = time.gmtime(start + day * 86400)
+    days.append('%d/%d/%d/' % (t.tm_year, t.tm_mon, t.tm_mday))
+  existing = set([key for key, _ in listing.get_keys_sizes(client, bucket, [week_prefix(week)], concurrency)])
+  missing = set()
+  for key, _ in listing.get_keys_sizes(client, bucket, days, concurrency):
+    match = HISTOGRAM_KEY.match(key)
+    if match:
+      year, month, day, hour, level, index = [int(g) for g in match.groups()]
+      epoch = calendar.timegm((year, month, day, hour, 0, 0))
+      if marker_key(epoch, level, index) not in existing:
+        missing.add((epoch, level, index))
+  listing.fan_out(lambda m: mark(client, bucket, *m), sorted(missing), concurrency)
+  client.put_object(Bucket=bucket, ContentType='binary/octet-stream', Body=b'', Key=week_prefix(week) + COMPLETE)
+  return len(missing)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Backfill the coverage index for weeks of histograms written without it')
+  parser.add_argument('--bucket', type=str, help='The histogram bucket (e.g. datastore-output-prod)', required=True)
+  parser.add_argument('weeks', type=str, nargs='+', help='The weeks to backfill, as year/week like the speed tiles')
+  args = parser.parse_args()
+
+  client = listing.s3_client()
+  for week in args.weeks:
+    print('Marked %d histograms for the week of %s' % (backfill(client, args.bucket, week), week))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+""" walk s3 prefixes, a level at a time with every prefix in a level listed concurrently """
+
+from multiprocessing.pool import ThreadPool
+import boto3
+from botocore.config import Config
+
+#how many list requests to have in flight at once
+LIST_CONCURRENCY = 32
+
+def s3_client(concurrency=LIST_CONCURRENCY):
+  # clients are thread safe, give it enough pooled connections that the listing threads dont wait on each other
+  return boto3.client('s3', config=Config(max_pool_connections=concurrency))
+
+def list_prefix(client, bucket, prefix):
+  # the sub prefixes and keys directly under one prefix
+  keys = []
+  pres = []
+  token = None
+  first = True
+  while first or token:
+    if token:
+      objects = client.list_objects_v2(Bucket=bucket, Delimiter='/', Prefix=prefix, ContinuationToken=token)
+    else:
+      objects = client.list_objects_v2(Bucket=bucket, Delimiter='/', Prefix=prefix)
+    if 'Contents' in objects:
+      keys.extend([ o['Key'] for o in objects['Contents'] ])
+    if 'CommonPrefixes' in objects:
+      pres.extend([ o['Prefix'] for o in objects['CommonPrefixes'] ])
+    token = objects.get('NextContinuationToken')
+    first = False
+  return pres, keys
+
+def fan_out(func, prefixes, concurrency):
+  # func of each prefix, on a bounded pool when there is more than one
+  prefixes = list(prefixes)
+  if len(prefixes) < 2 or concurrency < 2:
+    return [func(prefix) for prefix in prefixes]
+  pool = ThreadPool(min(concurrency, len(prefixes)))
+  try:
+    return pool.map(func, prefixes, 1)
+  finally:
+    pool.close()
+    pool.join()
+
+def get_prefixes_keys(client, bucket, prefixes, concurrency=LIST_CONCURRENCY):
+  # the sub prefixes and keys under all of the prefixes, in the same order as listing them one after the other
+  keys = []
+  pres = []
+  for p, k in fan_out(lambda prefix: list_prefix(client, bucket, prefix), prefixes, concurrency):
+    pres.extend(p)
+    keys.extend(k)
+  return pres, keys
+
+def list_objects(client, bucket, prefix):
+  # every object anywhere under the prefix, as the listing describes it
+  listed = []
+  token = None
+  first = True
+  while first or token:
+    if token:
+      objects = client.list_objects_v2(Bucket=bucket, Prefix=prefix, ContinuationToken=token)
+    else:
+      objects = client.list_objects_v2(Bucket=bucket, Prefix=prefix)
+    listed.extend(objects.get('Contents', []))
+    token = objects.get('NextContinuationToken')
+    first = False
+  return listed
+
+def list_sizes(client, bucket, prefix):
+  # every key anywhere under the prefix along with its size
+  return [ (o['Key'], o['Size']) for o in list_objects(client, bucket, prefix) ]
+
+def get_objects(client, bucket, prefixes, concurrency=LIST_CONCURRENCY):
+  # every object under all of the prefixes, each prefix is listed in full rather than level by level
+  return [o for listed in fan_out(lambda prefix: list_objects(client, bucket, prefix), prefixes, concurrency) for o in listed]
+
+def get_keys_sizes(client, bucket, prefixes, concurrency=LIST_CONCURRENCY):
+  # every key under all of the prefixes along with its size
+  return [ (o['Key'], o['Size']) for o in get_objects(client, bucket, prefixes, concurrency) ]
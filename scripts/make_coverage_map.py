@@ -7,6 +7,7 @@ import boto3
 import math
 import datetime
 import time
+import listing
 
 #world bb
 minx_ = -180
@@ -14,25 +15,6 @@ miny_ = -90
 maxx_ = 180
 maxy_ = 90
 
-def get_prefixes_keys(client, bucket, prefixes):
-  keys = []
-  pres = []
-  for prefix in prefixes:
-    token = None
-    first = True
-    while first or token:
-      if token:
-        objects = client.list_objects_v2(Bucket=bucket, Delimiter='/', Prefix=prefix, ContinuationToken=token)
-      else:
-        objects = client.list_objects_v2(Bucket=bucket, Delimiter='/', Prefix=prefix)
-      if 'Contents' in objects:
-        keys.extend([ o['Key'] for o in objects['Contents'] ])
-      if 'CommonPrefixes' in objects:
-        pres.extend([ o['Prefix'] for o in objects['CommonPrefixes'] ])
-      token = objects.get('NextContinuationToken')
-      first = False
-  return pres, keys
-
 class BoundingBox(object):
 
   def __init__(self, min_x, min_y, max_x, max_y):
@@ -115,16 +97,16 @@ if __name__ == "__main__":
    
   print('[INFO] Output file: ' + args.output_file)
   tile_hierarchy = TileHierarchy()
-  client = boto3.client('s3')
+  client = listing.s3_client()
   batch_client = boto3.client('batch')
 
   print('[INFO] Getting keys from bucket')
   # only level 1
-  prefixes, _ = get_prefixes_keys(client, args.ref_speed_bucket, "/1")
+  prefixes, _ = listing.get_prefixes_keys(client, args.ref_speed_bucket, "/1")
   # tile dirs
-  prefixes, _ = get_prefixes_keys(client, args.ref_speed_bucket, prefixes)
+  prefixes, _ = listing.get_prefixes_keys(client, args.ref_speed_bucket, prefixes)
   # physical tiles
-  prefixes, keys = get_prefixes_keys(client, args.ref_speed_bucket, prefixes)
+  prefixes, keys = listing.get_prefixes_keys(client, args.ref_speed_bucket, prefixes)
   
   geojson = '{"type": "FeatureCollection","features": ['
   first = True
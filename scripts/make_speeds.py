@@ -5,6 +5,11 @@ import os
 import errno
 import sys
 import math
+import json
+import hashlib
+import calendar
+import time
+import mmap
 import logging
 
 log = logging.getLogger('make_speeds')
@@ -27,6 +32,12 @@ except ImportError:
   print 'You need to generate the flatbuffer source via: sed -e "s/namespace.*/namespace dsfb;/g" ../src/main/fbs/histogram-tile.fbs > schema.fbs && flatc --python schema.fbs'
   sys.exit(1)
 
+try:
+  import numpy
+except ImportError:
+  print 'You need to install numpy via: pip install numpy'
+  sys.exit(1)
+
 #try this fat tile: wget https://s3.amazonaws.com/datastore_output_prod/2017/1/1/0/0/2415.fb
 ###############################################################################
 LEVEL_BITS = 3
@@ -64,58 +75,341 @@ def unquantise(val):
   raise (hi, lo)
 
 ###############################################################################
-def addSegments(file_name, extractInfo, lengths, segments):
-  with open(file_name, 'rb') as filehandle:
-    log.info('Loading %s...' % file_name)
-    hist = Histogram.GetRootAsHistogram(bytearray(filehandle.read()), 0)
-  level = get_level(hist.TileId())
-  tile_index = get_tile_index(hist.TileId())
-  if (level == extractInfo['level']) and (tile_index == extractInfo['index']):
-    log.info('Processing %s...' % file_name)
-    #for each segment
-    for i in range(0, hist.SegmentsLength()):
-      segment = hist.Segments(i)
-      #has to be one we know about and its not tombstoned/markered
-      if segment.EntriesLength() > 0 and segment.SegmentId() < len(lengths) and lengths[segment.SegmentId()] > 0:
-        length = lengths[segment.SegmentId()]
-        processSegment(segments, segment, extractInfo, length)
-    log.info('Processed %s' % file_name)
-  del hist
+# Opens a histogram for reading. By default the file is memory mapped read only
+# and the flatbuffer accessors read straight out of the mapping, so even the fat
+# tiles never get copied into python memory in full. Anything built from the
+# histogram is only valid until the with block exits
+class HistogramFile(object):
+  def __init__(self, file_name, use_mmap=True):
+    self.file_name = file_name
+    self.use_mmap = use_mmap
+    self.filehandle = None
+    self.mapped = None
+    self.buf = None
+
+  def __enter__(self):
+    self.filehandle = open(self.file_name, 'rb')
+    #cant map an empty file
+    if self.use_mmap and os.fstat(self.filehandle.fileno()).st_size > 0:
+      self.mapped = mmap.mmap(self.filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+      #a read only array over the mapping works for both flatbuffers and numpy
+      self.buf = numpy.frombuffer(self.mapped, dtype=numpy.uint8)
+    else:
+      self.buf = bytearray(self.filehandle.read())
+    return Histogram.GetRootAsHistogram(self.buf, 0)
 
-###############################################################################
-def processSegment(segments, segment, extractInfo, length):
-  for i in range(0, segment.EntriesLength()):
-    e = segment.Entries(i)
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.buf = None
+    if self.mapped is not None:
+      self.mapped.close()
+      self.mapped = None
+    self.filehandle.close()
+    return False
 
-    # if entry is not within time range then skip
-    epochSec = e.EpochHour() * 3600
-    if epochSec < extractInfo['rangeStart'] or epochSec >= extractInfo['rangeEnd']:
-      log.warn('Entry time is not in range: ' + str(epochSec))
-      continue
+###############################################################################
+# Rather than rewriting a histogram every time late data shows up the datastore
+# writes small deltas next to it in file_name.d/ which get folded back in every
+# so often. Reading a histogram means reading its deltas too, the accumulator
+# sums up whatever rows they have in common
+def histogramFiles(file_name):
+  deltas = file_name + '.d'
+  try:
+    names = [f for f in sorted(os.listdir(deltas)) if f.endswith('.fb')]
+  except OSError:
+    return [file_name]
+  folded = foldedDeltas(file_name)
+  return [file_name] + [os.path.join(deltas, f) for f in names if f not in folded]
+
+def foldedDeltas(file_name):
+  #a compaction that died before removing the deltas it folded leaves a record of them, see work.py, but it only
+  #counts if the histogram it names is the one that is actually there
+  try:
+    with open(os.path.join(file_name + '.d', 'folded'), 'r') as f:
+      lines = f.read().split()
+    with open(file_name, 'rb') as f:
+      digest = hashlib.md5(f.read()).hexdigest()
+  except IOError:
+    return set()
+  if not lines or lines[0] != digest:
+    return set()
+  return set(lines[1:])
+
+def addSegments(file_name, extractInfo, lengths, segments, use_mmap=True):
+  for name in histogramFiles(file_name):
+    addHistogram(name, extractInfo, lengths, segments, use_mmap)
+
+def addHistogram(file_name, extractInfo, lengths, segments, use_mmap=True):
+  log.info('Loading %s...' % file_name)
+  with HistogramFile(file_name, use_mmap) as hist:
+    level = get_level(hist.TileId())
+    tile_index = get_tile_index(hist.TileId())
+    if (level == extractInfo['level']) and (tile_index == extractInfo['index']):
+      log.info('Processing %s...' % file_name)
+      #for each segment
+      for i in range(0, hist.SegmentsLength()):
+        segment = hist.Segments(i)
+        segment_id = segment.SegmentId()
+        #has to be one we know about and its not tombstoned/markered
+        if segment_id < len(lengths) and lengths[segment_id] > 0 and segment.EntriesLength() > 0:
+          length = lengths[segment_id]
+          processSegment(segments, segment, extractInfo, length)
+      log.info('Processed %s' % file_name)
+    del hist
 
-    #get the right segment
-    hours = segments.setdefault(segment.SegmentId(), {})
+###############################################################################
+# Entry is a fixed size struct so a segments entries vector can be viewed in
+# place as a numpy structured array, see histogram-tile.fbs for the layout
+ENTRY_DTYPE = numpy.dtype({
+  'names': ['epoch_hour', 'next_segment_idx', 'duration_bucket', 'count', 'queue'],
+  'formats': ['<u4', 'u1', 'u1', '<u4', 'u1'],
+  'offsets': [0, 4, 5, 8, 12],
+  'itemsize': 16})
+#vtable slots of the vectors in the Segment table
+SEGMENT_NEXT_SEGMENT_IDS_SLOT = 6
+SEGMENT_ENTRIES_SLOT = 8
+#every possible duration bucket unquantised up front
+DURATION_LUT = numpy.array([unquantise(val) for val in range(0, 256)], dtype=numpy.int64)
+
+def vectorAsNumpy(table, slot, dtype, length):
+  offset = table.Offset(slot)
+  if offset == 0 or length == 0:
+    return numpy.zeros(0, dtype=dtype)
+  return numpy.frombuffer(table.Bytes, dtype=dtype, count=length, offset=table.Vector(offset))
+
+# gives back the hours, next segment ids, counts, duration sums and queue sums
+# of a segment with one row per hour and next segment id pair
+def decodeSegment(segment, extractInfo, length):
+  entries = vectorAsNumpy(segment._tab, SEGMENT_ENTRIES_SLOT, ENTRY_DTYPE, segment.EntriesLength())
+
+  # if entry is not within time range then skip
+  epochSecs = entries['epoch_hour'].astype(numpy.int64) * 3600
+  inRange = (epochSecs >= extractInfo['rangeStart']) & (epochSecs < extractInfo['rangeEnd'])
+  if not inRange.all():
+    log.warn('%d entries of segment %d are not in time range' % (len(inRange) - numpy.count_nonzero(inRange), segment.SegmentId()))
+    entries = entries[inRange]
+
+  #weight everything by how many there were
+  counts = entries['count'].astype(numpy.int64)
+  durations = DURATION_LUT[entries['duration_bucket']] * counts
+  queues = (entries['queue'] / 255.0) * length * counts
+
+  #collapse the duration buckets so there is one row per hour and next segment
+  keys = (entries['epoch_hour'].astype(numpy.int64) << 8) | entries['next_segment_idx']
+  keys, rows = numpy.unique(keys, return_inverse=True)
+  nextIds = vectorAsNumpy(segment._tab, SEGMENT_NEXT_SEGMENT_IDS_SLOT, '<u8', segment.NextSegmentIdsLength())
+  return (keys >> 8, nextIds[keys & 255],
+    numpy.bincount(rows, weights=counts).astype(numpy.int64),
+    numpy.bincount(rows, weights=durations).astype(numpy.int64),
+    numpy.bincount(rows, weights=queues))
 
-    #get the right hour in there
-    nexts = hours.setdefault(e.EpochHour(), {})
+###############################################################################
+# Accumulates the totals for every segment, hour and next segment as parallel
+# columns rather than nested dicts. Rows come in a segment at a time and are
+# only sorted and reduced by key when someone wants to read them back out
+class SegmentAccumulator(object):
+  DTYPES = [numpy.uint32, numpy.uint32, numpy.uint64, numpy.int64, numpy.int64, numpy.float64]
+  #how many small per segment chunks to hold before gluing them into a block
+  MAX_CHUNKS = 4096
+
+  def __init__(self):
+    self.chunks = []
+    self.blocks = []
+    self.compacted = True
+
+  def __getstate__(self):
+    self.flush()
+    return self.__dict__
+
+  def add(self, segment_id, hours, nextIds, counts, durations, queues):
+    if len(hours) == 0:
+      return
+    self.chunks.append((numpy.full(len(hours), segment_id, dtype=numpy.uint32), hours, nextIds, counts, durations, queues))
+    self.compacted = False
+    if len(self.chunks) >= self.MAX_CHUNKS:
+      self.flush()
+
+  def extend(self, other):
+    other.flush()
+    self.flush()
+    self.blocks.extend(other.blocks)
+    self.compacted = self.compacted and other.compacted and len(self.blocks) < 2
+
+  # writes the compacted columns out as one .npy file each and gives back their names
+  def save(self, prefix):
+    file_names = []
+    for i, column in enumerate(self.columns()):
+      file_names.append('%s.%d.npy' % (prefix, i))
+      numpy.save(file_names[-1], column)
+    return file_names
+
+  # memory maps columns written by save, they must stay on disk until this is compacted
+  @classmethod
+  def load(cls, file_names):
+    accumulator = cls()
+    columns = tuple([numpy.load(file_name, mmap_mode='r') for file_name in file_names])
+    if len(columns[0]):
+      accumulator.blocks.append(columns)
+    return accumulator
+
+  def flush(self):
+    if self.chunks:
+      self.blocks.append(tuple([numpy.concatenate([c[i] for c in self.chunks]).astype(t, copy=False) for i, t in enumerate(self.DTYPES)]))
+      self.chunks = []
+
+  # sort everything by segment, hour and next segment and sum up the rows that share a key
+  def compact(self):
+    self.flush()
+    if self.compacted:
+      return
+    columns = [numpy.concatenate([b[i] for b in self.blocks]) for i in range(0, len(self.DTYPES))]
+    del self.blocks[:]
+    self.compacted = True
+    if len(columns[0]) == 0:
+      return
+    order = numpy.lexsort((columns[2], columns[1], columns[0]))
+    columns = [c[order] for c in columns]
+    del order
+    change = (columns[0][1:] != columns[0][:-1]) | (columns[1][1:] != columns[1][:-1]) | (columns[2][1:] != columns[2][:-1])
+    starts = numpy.concatenate(([0], numpy.flatnonzero(change) + 1))
+    self.blocks = [tuple([c[starts] for c in columns[:3]] + [numpy.add.reduceat(c, starts) for c in columns[3:]])]
+
+  def __len__(self):
+    self.compact()
+    return len(self.blocks[0][0]) if self.blocks else 0
+
+  # the compacted columns of segment ids, hours, next segment ids, counts, duration sums and queue sums
+  def columns(self):
+    self.compact()
+    if not self.blocks:
+      return tuple([numpy.zeros(0, dtype=t) for t in self.DTYPES])
+    return self.blocks[0]
+
+  # gives back each segment id in order along with its hours and next segments
+  # in the same form as {hour: {next_segment_id: {'count','duration','queue'}}}
+  def iterSegments(self):
+    segmentIds, hours, nextIds, counts, durations, queues = self.columns()
+    bounds = (numpy.flatnonzero(segmentIds[1:] != segmentIds[:-1]) + 1).tolist()
+    for start, end in zip([0] + bounds, bounds + [len(segmentIds)]):
+      if start == end:
+        continue
+      segmentHours = {}
+      for hour, nextId, count, duration, queue in zip(hours[start:end].tolist(), nextIds[start:end].tolist(), counts[start:end].tolist(),
+          durations[start:end].tolist(), queues[start:end].tolist()):
+        segmentHours.setdefault(hour, {})[nextId] = {'count': count, 'duration': duration, 'queue': queue}
+      yield int(segmentIds[start]), segmentHours
 
-    #if you dont have the right next segment in there
-    totals = nexts.setdefault(segment.NextSegmentIds(e.NextSegmentIdx()), {'count': 0, 'duration': 0, 'queue': 0 })
+###############################################################################
+def processSegment(segments, segment, extractInfo, length):
+  segments.add(segment.SegmentId(), *decodeSegment(segment, extractInfo, length))
 
-    #continuing a previous pair
-    totals['count'] += e.Count()
-    totals['duration'] += unquantise(e.DurationBucket()) * e.Count()
-    totals['queue'] += (e.Queue()/255.0) * length * e.Count()
+###############################################################################
+# The histogram tree is laid out as year/month/day/hour/level/index.fb so we
+# can tell which tile and hour a file holds without ever opening it. The
+# manifest remembers that mapping along with the mtime of each level directory
+# so that refreshing it only relists the directories that have changed, and
+# only for the hours that are being asked about
+MANIFEST_VERSION = 1
+
+def loadManifest(manifest_file):
+  try:
+    with open(manifest_file, 'r') as f:
+      manifest = json.load(f)
+    if manifest.get('version') == MANIFEST_VERSION:
+      return manifest
+    log.info('Ignoring manifest %s with unknown version' % manifest_file)
+  except (IOError, ValueError):
+    pass
+  return {'version': MANIFEST_VERSION, 'dirs': {}, 'tiles': {}}
+
+def saveManifest(manifest, manifest_file):
+  temp_file = manifest_file + '.tmp'
+  with open(temp_file, 'w') as f:
+    json.dump(manifest, f)
+  os.rename(temp_file, manifest_file)
+
+def listDirs(path):
+  try:
+    return [d for d in os.listdir(path) if d.isdigit() and os.path.isdir(os.path.join(path, d))]
+  except OSError:
+    return []
+
+def hourDir(epoch_hour):
+  return '%d/%d/%d/%d' % time.gmtime(epoch_hour * 3600)[:4]
+
+def hourDirs(path, epoch_hours=None):
+  #year/month/day/hour of every hour there is, or just the ones given that are there
+  if epoch_hours is not None:
+    return dict([(hourDir(epoch_hour), epoch_hour) for epoch_hour in epoch_hours if os.path.isdir(os.path.join(path, hourDir(epoch_hour)))])
+  dirs = {}
+  for year in listDirs(path):
+    for month in listDirs(os.path.join(path, year)):
+      for day in listDirs(os.path.join(path, year, month)):
+        for hour in listDirs(os.path.join(path, year, month, day)):
+          dirs['/'.join([year, month, day, hour])] = calendar.timegm((int(year), int(month), int(day), int(hour), 0, 0)) / 3600
+  return dirs
+
+def refreshManifest(path, manifest, epoch_hours=None):
+  #only the hours asked for are looked at, so a warm run doesnt walk the whole tree, and of those only the level
+  #directories whose mtime changed are relisted. gives back whether the manifest changed
+  scope = None if epoch_hours is None else set([hourDir(epoch_hour) for epoch_hour in epoch_hours])
+  dirs = {}
+  for rel_hour, epoch_hour in hourDirs(path, epoch_hours).iteritems():
+    for level in listDirs(os.path.join(path, rel_hour)):
+      rel = rel_hour + '/' + level
+      dirs[rel] = (epoch_hour, level, os.path.getmtime(os.path.join(path, rel)))
+
+  #drop anything that went away or changed
+  tiles = manifest['tiles']
+  stale = set([d for d, mtime in manifest['dirs'].iteritems() if (scope is None or d.rsplit('/', 1)[0] in scope) and
+    (d not in dirs or dirs[d][2] != mtime)])
+  if stale:
+    for tile in tiles.keys():
+      hours = tiles[tile]
+      for hour in hours.keys():
+        if hours[hour].rsplit('/', 1)[0] in stale:
+          del hours[hour]
+      if not hours:
+        del tiles[tile]
+  for d in stale:
+    del manifest['dirs'][d]
+
+  #relist anything that is new or changed
+  relisted = 0
+  for rel, (epoch_hour, level, mtime) in dirs.iteritems():
+    if rel in manifest['dirs']:
+      continue
+    for file in os.listdir(os.path.join(path, rel)):
+      if file.endswith('.fb') and file[:-3].isdigit():
+        tile = level + '/' + str(int(file[:-3]))
+        tiles.setdefault(tile, {})[str(epoch_hour)] = rel + '/' + file
+    manifest['dirs'][rel] = mtime
+    relisted += 1
+  log.info('Manifest has %d tiles, relisted %d of %d directories and dropped %d' % (len(tiles), relisted, len(dirs), len(stale)))
+  return bool(relisted or stale)
 
 ###############################################################################
-def getSegments(path, extractInfo, lengths):
+def getSegments(path, extractInfo, lengths, manifest_file=None, use_mmap=True):
   log.debug('getSegments ###############################################################################')
   log.debug('Looking for level=' + str(extractInfo['level']) + ' and tile_id=' + str(extractInfo['index']) + ' here:' + path)
-  segments = {}
-  for root, dirs, files in os.walk(path):
-    for file in files:
-      if (root + os.sep + file).endswith('.fb'):
-        addSegments(root + os.sep + file, extractInfo, lengths, segments)
+  if manifest_file is None:
+    manifest_file = os.path.join(path, '.manifest.json')
+  #only the hours in this time range need to be up to date and its only written if they werent
+  manifest = loadManifest(manifest_file)
+  epoch_hours = range(extractInfo['rangeStart'] / 3600, (extractInfo['rangeEnd'] + 3599) / 3600)
+  if refreshManifest(path, manifest, epoch_hours):
+    try:
+      saveManifest(manifest, manifest_file)
+    except (IOError, OSError) as e:
+      log.warn('Could not save manifest %s: %s' % (manifest_file, e))
+
+  #only open the files for this tile in this time range
+  hours = manifest['tiles'].get(str(extractInfo['level']) + '/' + str(extractInfo['index']), {})
+  segments = SegmentAccumulator()
+  for epoch_hour in epoch_hours:
+    rel = hours.get(str(epoch_hour))
+    if rel:
+      addSegments(os.path.join(path, rel), extractInfo, lengths, segments, use_mmap)
+  return segments
 
 ###############################################################################
 # length in meters, rounded to the nearest meter
@@ -140,6 +434,61 @@ def getLengths(fileName):
   del osmlr
   return lengths
 
+###############################################################################
+# parsing a whole osmlr tile just to sum up lrp lengths is expensive and the answer only changes
+# when osmlr does, so we keep the lengths on disk as npy arrays under version/level/index and
+# map them in when we need them again. the least recently used ones are evicted over the budget
+LENGTHS_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'opentraffic', 'lengths')
+LENGTHS_CACHE_BYTES = 512 * 1024 * 1024
+
+def lengthsCachePath(cache_dir, version, level, index):
+  return os.path.join(cache_dir, version, str(level), str(index) + '.npy')
+
+def evictLengths(cache_dir, max_bytes, keep=None):
+  cached = []
+  for root, dirs, files in os.walk(cache_dir):
+    for file in files:
+      if file.endswith('.npy'):
+        path = os.path.join(root, file)
+        stat = os.stat(path)
+        cached.append((stat.st_mtime, stat.st_size, path))
+  total = sum([c[1] for c in cached])
+  for mtime, size, path in sorted(cached):
+    if total <= max_bytes:
+      break
+    if path != keep:
+      log.info('Evicting cached lengths ' + path)
+      remove(path)
+      total -= size
+
+def getCachedLengths(cache_dir, version, level, index, osmlr, max_bytes=LENGTHS_CACHE_BYTES):
+  #osmlr is either the tile file or a function that fetches it and returns its name, used only on a miss
+  path = lengthsCachePath(cache_dir, version, level, index)
+  try:
+    lengths = numpy.load(path, mmap_mode='r')
+    #touch it so it counts as recently used
+    os.utime(path, None)
+    log.info('Using cached lengths ' + path)
+    return lengths
+  except (IOError, OSError, ValueError):
+    pass
+
+  if callable(osmlr):
+    osmlr = osmlr()
+  lengths = numpy.array(getLengths(osmlr), dtype=numpy.int64)
+  try:
+    os.makedirs(os.path.dirname(path))
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  #other processes may be reading or writing the same entry so only ever swap in whole files
+  temp_file = '%s.%d.tmp' % (path, os.getpid())
+  with open(temp_file, 'wb') as f:
+    numpy.save(f, lengths)
+  os.rename(temp_file, path)
+  evictLengths(cache_dir, max_bytes, path)
+  return lengths
+
 ###############################################################################
 def remove(path):
   try:
@@ -229,7 +578,109 @@ def variance(items):
   return int(round(sum([(xi - mean)**2 for xi in items]) / len(items)))
 
 ###############################################################################
-def createSpeedTiles(lengths, fileName, subTileSize, nextName, separate, segments, extractInfo):
+# The vectorized equivalents of the above which work on whole columns at once.
+# Python 2 rounds half away from zero where numpy rounds half to even
+def roundHalfAway(values):
+  floors = numpy.floor(values)
+  return (floors + (values - floors >= 0.5)).astype(numpy.int64)
+
+PREVALENCE_COUNTS = numpy.array([0, 2, 6, 12, 20, 30, 42, 56, 72, 90])
+
+def prevalences(counts):
+  levels = numpy.searchsorted(PREVALENCE_COUNTS, counts, side='left')
+  #only the middle levels get obscured, draw in the same order as prevalence() would
+  obscured = numpy.flatnonzero((levels > 0) & (levels < len(PREVALENCE_COUNTS)))
+  rand = numpy.array([random.random() for i in xrange(len(obscured))])
+  levels[obscured] += numpy.where(rand < 0.15, -1, numpy.where(rand < 0.85, 0, 1))
+  return levels
+
+# variance of each group of values, the group sums are done with bincount
+# which adds up each group in order just like sum() does in variance()
+def variances(values, groups, sizes):
+  means = numpy.bincount(groups, weights=values, minlength=len(sizes)) / sizes
+  return roundHalfAway(numpy.bincount(groups, weights=(values - means[groups])**2, minlength=len(sizes)) / sizes)
+
+###############################################################################
+# Fills out every speed and next segment column of a subtile in one go from the
+# compacted accumulator columns rather than segment by segment and hour by hour
+def fillSubtile(subtile, nextSubtile, lengths, startIndex, endIndex, minHour, columns, extractInfo):
+  entries = subtile.unitSize/subtile.entrySize
+  cellCount = (endIndex - startIndex) * entries
+  segmentIds, hours, nextIds, counts, durations, queues = columns
+
+  #the rows for segments and hours in this subtile, they are sorted by segment, hour, next segment
+  begin, end = numpy.searchsorted(segmentIds, [startIndex, endIndex])
+  rowSegments = segmentIds[begin:end].astype(numpy.int64) - startIndex
+  rowHours = hours[begin:end].astype(numpy.int64) - minHour
+  keep = numpy.flatnonzero((rowHours >= 0) & (rowHours < entries))
+  cells = rowSegments[keep] * entries + rowHours[keep]
+  rows = begin + keep
+
+  #one group of next segments per segment hour that has data
+  starts = numpy.flatnonzero(numpy.concatenate(([True], cells[1:] != cells[:-1]))) if len(cells) else numpy.zeros(0, dtype=numpy.int64)
+  sizes = numpy.diff(numpy.append(starts, len(cells)))
+  groups = numpy.repeat(numpy.arange(len(starts)), sizes)
+
+  #keep the next segments in the order the dict based path would iterate them in
+  for g in numpy.flatnonzero(sizes > 1).tolist():
+    start, end = starts[g], starts[g] + sizes[g]
+    positions = dict([(nextId, rows[start + i]) for i, nextId in enumerate(nextIds[rows[start:end]].tolist())])
+    rows[start:end] = positions.values()
+
+  #compute the averages
+  rowCounts = counts[rows].astype(numpy.float64)
+  rowDurations = durations[rows] / rowCounts
+  rowQueues = queues[rows] / rowCounts
+  rowLengths = numpy.array(lengths[startIndex:endIndex], dtype=numpy.float64)[rowSegments[keep]]
+
+  #speeds in kph instead of meters per second, the max speed comes from the min duration
+  minDurations = numpy.minimum.reduceat(rowDurations, starts) if len(starts) else numpy.zeros(0)
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    maxSpeeds = rowLengths[starts] / minDurations * 3.6
+  #we do not want to include the invalid speeds
+  invalid = ~((maxSpeeds > -0.5) & (maxSpeeds < 160.5))
+  for g in numpy.flatnonzero(invalid).tolist():
+    k = startIndex + cells[starts[g]] / entries
+    log.warn('Invalid speed of %s with length %d found for segment %d with min duration %s' % (maxSpeeds[g], lengths[k], (k<<25)|(extractInfo['index']<<3)|extractInfo['level'], minDurations[g]))
+  maxSpeeds = roundHalfAway(numpy.where(invalid, 0, maxSpeeds))
+  hasSpeed = maxSpeeds > 0
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    rowSpeeds = numpy.where(hasSpeed[groups], rowLengths / rowDurations * 3.6, 0)
+  speedVariances = numpy.where(hasSpeed, variances(roundHalfAway(rowSpeeds), groups, sizes), 0)
+
+  #spread the groups out over every segment hour in the subtile
+  groupCells = cells[starts]
+  cellSpeeds = numpy.zeros(cellCount, dtype=numpy.int64)
+  cellSpeeds[groupCells] = maxSpeeds
+  cellVariances = numpy.zeros(cellCount, dtype=numpy.int64)
+  cellVariances[groupCells] = speedVariances
+  cellCounts = numpy.zeros(cellCount, dtype=numpy.int64)
+  cellCounts[groupCells] = numpy.bincount(groups, weights=rowCounts, minlength=len(starts))
+  cellNexts = numpy.zeros(cellCount, dtype=numpy.int64)
+  cellNexts[groupCells] = sizes
+  subtile.speeds.extend(cellSpeeds.tolist())
+  subtile.speedVariances.extend(cellVariances.tolist())
+  subtile.prevalences.extend(prevalences(cellCounts).tolist())
+  subtile.nextSegmentIndices.extend((len(nextSubtile.nextSegmentIds) + numpy.cumsum(cellNexts) - cellNexts).tolist())
+  subtile.nextSegmentCounts.extend(cellNexts.tolist())
+
+  #and the next segment attributes
+  delays = roundHalfAway(rowDurations - minDurations[groups])
+  nextSubtile.nextSegmentIds.extend(nextIds[rows].tolist())
+  nextSubtile.nextSegmentDelays.extend(delays.tolist())
+  nextSubtile.nextSegmentDelayVariances.extend(variances(delays, groups, sizes)[groups].tolist())
+  nextSubtile.nextSegmentQueueLengths.extend(roundHalfAway(rowQueues).tolist())
+  nextSubtile.nextSegmentQueueLengthVariances.extend(variances(rowQueues, groups, sizes)[groups].tolist())
+
+###############################################################################
+def advance(iterator):
+  try:
+    return iterator.next()
+  except StopIteration:
+    return None
+
+###############################################################################
+def createSpeedTiles(lengths, fileName, subTileSize, nextName, separate, segments, extractInfo, vectorized=True):
   log.debug('createSpeedTiles ###############################################################################')
 
   #find the minimum epoch hour for this time range
@@ -237,6 +688,13 @@ def createSpeedTiles(lengths, fileName, subTileSize, nextName, separate, segment
   log.debug('minHour=' + str(minHour))
   written = []
 
+  #either do whole subtiles at once or walk the accumulated segments in order alongside the osmlr ones
+  if vectorized:
+    columns = segments.columns()
+  else:
+    accumulated = segments.iterSegments()
+    current = advance(accumulated)
+
   #fake a segment for each entry in the osmlr
   tile = None
   nextTile = None
@@ -269,11 +727,22 @@ def createSpeedTiles(lengths, fileName, subTileSize, nextName, separate, segment
         del nextTile
       #set up new pbf messages to write into
       tile, subtile, nextTile, nextSubtile = next(k, len(lengths), nextName, subTileSize, extractInfo)
+      if vectorized:
+        fillSubtile(subtile, nextSubtile, lengths, k, min(k + subTileSize, len(lengths)), minHour, columns, extractInfo)
+
+    #the whole subtile was already done
+    if vectorized:
+      continue
+
+    #get the data we have for this segment if any
+    while current is not None and current[0] < k:
+      current = advance(accumulated)
+    segmentHours = current[1] if current is not None and current[0] == k else {}
 
     #do all the entries
     for i in range(0 + minHour, subtile.unitSize/subtile.entrySize + minHour):
       #if we have data get it
-      nextSegments = segments[k][i] if k in segments and i in segments[k] else None
+      nextSegments = segmentHours.get(i)
       #compute the averages
       if nextSegments:
         for nid, n in nextSegments.iteritems():
@@ -346,7 +815,10 @@ def createSpeedTiles(lengths, fileName, subTileSize, nextName, separate, segment
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description='Generate speed tiles', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument('--osmlr', type=str, help='The osmlr tile containing the relevant segments definitions', required=True)
+  parser.add_argument('--osmlr-version', type=str, help='The version of the osmlr tile, if present the segment lengths derived from it are cached under this version, level and tile id')
+  parser.add_argument('--lengths-cache', type=str, help='The directory in which to cache segment lengths when --osmlr-version is given', default=LENGTHS_CACHE_DIR)
   parser.add_argument('--fb-path', type=str, help='The flatbuffer tile path to load the files necessary for the time period given', required=True)
+  parser.add_argument('--fb-manifest', type=str, help='The file in which to keep the index of which tile and hour each flatbuffer under --fb-path holds. Defaults to .manifest.json inside --fb-path')
   parser.add_argument('--time-range-start', type=int, help='The epoch start time (inclusive) in seconds', required=True)
   parser.add_argument('--time-range-end', type=int, help='The epoch end time (exclusive) in seconds', required=True)
   parser.add_argument('--time-unit-size', type=int, help='The target time range in seconds, a week would be 604800', required=True)
@@ -359,6 +831,8 @@ if __name__ == "__main__":
   parser.add_argument('--separate-next-segments-prefix', type=str, help='The prefix for the next segments output tiles if they should be separated from the primary speed entries. If omitted they will not be separate')
   parser.add_argument('--max-segments', type=int, help='The maximum number of segments to have in a single subtile message', default=10000)
   parser.add_argument('--no-separate-subtiles', help='If present all subtiles will be in the same tile', action='store_true')
+  parser.add_argument('--no-mmap', help='If present histograms are read fully into memory rather than memory mapped', action='store_true')
+  parser.add_argument('--no-vectorize', help='If present speed tiles are computed one segment and hour at a time rather than a whole subtile at once', action='store_true')
   parser.add_argument('--verbose', '-v', help='Turn on verbose output i.e. DEBUG level logging', action='store_true')
 
   # parse the arguments
@@ -390,19 +864,22 @@ if __name__ == "__main__":
     log.debug('index=' + str(extractInfo['index']))
 
   print 'getting osmlr lengths'
-  lengths = getLengths(args.osmlr)
+  if args.osmlr_version:
+    lengths = getCachedLengths(args.lengths_cache, args.osmlr_version, args.level, args.tile_id, args.osmlr)
+  else:
+    lengths = getLengths(args.osmlr)
 
   print 'getting speed averages from fb Histogram'
-  segments = getSegments(args.fb_path, extractInfo, lengths)
+  segments = getSegments(args.fb_path, extractInfo, lengths, args.fb_manifest, not args.no_mmap)
 
   if args.verbose:
     log.debug('loop over segments ###############################################################################')
-    for k,v in segments.iteritems():
+    for k,v in segments.iterSegments():
       log.debug('k=' + str(k) + ' | v=' + str(v))
     log.debug('DONE loop over segments ###############################################################################')
 
   print 'creating 1 week of speeds at hourly intervals for ' + str(len(lengths)) + ' segments'
-  createSpeedTiles(lengths, args.output_prefix, args.max_segments, args.separate_next_segments_prefix, not args.no_separate_subtiles, segments, extractInfo)
+  createSpeedTiles(lengths, args.output_prefix, args.max_segments, args.separate_next_segments_prefix, not args.no_separate_subtiles, segments, extractInfo, not args.no_vectorize)
 
   print 'done'
 
@@ -5,7 +5,9 @@
 ### 2017/<week>/<level/<tileid>
 year=2017
 week=01
-osmlr_base_dir="/data/opentraffic/osmlr-tiles/v0.1/pbf"
+osmlr_version="v0.1"
+osmlr_base_dir="/data/opentraffic/osmlr-tiles/${osmlr_version}/pbf"
+lengths_cache="/data/opentraffic/lengths-cache"
 fb_path="/data/opentraffic/datastore_output_prod"
 speed_output_base_dir="speed-extracts/${year}/${week}"
 time_range_start=1483315200
@@ -26,7 +28,7 @@ extract="${speed_output_base_dir}/${level}/${x}/${y}"
 echo "level=${level} tile_index=${tile_index}"
 mkdir -p "${speed_output_base_dir}/${level}/${x}"
 
-./make_speeds.py --osmlr ${osmlr} --fb-path ${fb_path} --output-prefix ${extract}.spd --separate-next-segments-prefix ${extract}.nex --time-range-start ${time_range_start} --time-range-end ${time_range_end} --time-unit-size ${time_unit_size} --time-entry-size ${time_entry_size} --time-range-description "${time_range_description}" --level ${level} --tile-id ${tile_index} --verbose
+./make_speeds.py --osmlr ${osmlr} --osmlr-version ${osmlr_version} --lengths-cache ${lengths_cache} --fb-path ${fb_path} --output-prefix ${extract}.spd --separate-next-segments-prefix ${extract}.nex --time-range-start ${time_range_start} --time-range-end ${time_range_end} --time-unit-size ${time_unit_size} --time-entry-size ${time_entry_size} --time-range-description "${time_range_description}" --level ${level} --tile-id ${tile_index} --verbose
 
 ######################################################################
 x=037
@@ -38,7 +40,7 @@ extract="${speed_output_base_dir}/${level}/${x}/${y}"
 echo "level=${level} tile_index=${tile_index}"
 mkdir -p "${speed_output_base_dir}/${level}/${x}"
 
-./make_speeds.py --osmlr ${osmlr} --fb-path ${fb_path} --output-prefix ${extract}.spd --separate-next-segments-prefix ${extract}.nex --time-range-start ${time_range_start} --time-range-end ${time_range_end} --time-unit-size ${time_unit_size} --time-entry-size ${time_entry_size} --time-range-description "${time_range_description}" --level ${level} --tile-id ${tile_index} --verbose
+./make_speeds.py --osmlr ${osmlr} --osmlr-version ${osmlr_version} --lengths-cache ${lengths_cache} --fb-path ${fb_path} --output-prefix ${extract}.spd --separate-next-segments-prefix ${extract}.nex --time-range-start ${time_range_start} --time-range-end ${time_range_end} --time-unit-size ${time_unit_size} --time-entry-size ${time_entry_size} --time-range-description "${time_range_description}" --level ${level} --tile-id ${tile_index} --verbose
 
 ######################################################################
 x=037
@@ -50,7 +52,7 @@ extract="${speed_output_base_dir}/${level}/${x}/${y}"
 echo "level=${level} tile_index=${tile_index}"
 mkdir -p "${speed_output_base_dir}/${level}/${x}"
 
-./make_speeds.py --osmlr ${osmlr} --fb-path ${fb_path} --output-prefix ${extract}.spd --separate-next-segments-prefix ${extract}.nex --time-range-start ${time_range_start} --time-range-end ${time_range_end} --time-unit-size ${time_unit_size} --time-entry-size ${time_entry_size} --time-range-description "${time_range_description}" --level ${level} --tile-id ${tile_index} --verbose
+./make_speeds.py --osmlr ${osmlr} --osmlr-version ${osmlr_version} --lengths-cache ${lengths_cache} --fb-path ${fb_path} --output-prefix ${extract}.spd --separate-next-segments-prefix ${extract}.nex --time-range-start ${time_range_start} --time-range-end ${time_range_end} --time-unit-size ${time_unit_size} --time-entry-size ${time_entry_size} --time-range-description "${time_range_description}" --level ${level} --tile-id ${tile_index} --verbose
 
 ######################################################################
 # gzip the files
@@ -9,6 +9,8 @@ import logging
 import datetime
 import time
 import StringIO
+import json
+import multiprocessing
 from Queue import Queue
 from threading import Thread
 
@@ -24,6 +26,12 @@ except ImportError:
   print 'You need to generate protobuffer source via: protoc --python_out . --proto_path ../proto ../proto/*.proto'
   sys.exit(1)
 
+try:
+  import numpy
+except ImportError:
+  print 'You need to install numpy via: pip install numpy'
+  sys.exit(1)
+
 valhalla_tiles = [{'level': 2, 'size': 0.25}, {'level': 1, 'size': 1.0}, {'level': 0, 'size': 4.0}]
 
 def url_suffix(tile_level, tile_index):
@@ -74,7 +82,7 @@ class ThreadPool:
     self.tasks.join()
     return list(self.results.queue)
 
-def work(speed_bucket, week_tile, part, **kargs):
+def work(speed_bucket, week_tile, part, size=None, **kargs):
   session = boto3.session.Session()
   client = session.client('s3')
   #make sure we have a spot for this
@@ -87,8 +95,10 @@ def work(speed_bucket, week_tile, part, **kargs):
   try:
     client.download_file(speed_bucket, key, key)
     log.info('Downloaded %s from %s' % (key, speed_bucket))
-    #queue up more if there is more
-    if part == 0:
+    if size is not None and os.path.getsize(key) != size:
+      log.warn('%s is %d bytes but its manifest says %d' % (key, os.path.getsize(key), size))
+    #queue up more if there is more and we didnt know about them already
+    if part == 0 and size is None:
       parts = get_subtile_count(key)
       for p in range(1, parts):
         kargs['adder'](work, speed_bucket, week_tile, p)
@@ -96,76 +106,162 @@ def work(speed_bucket, week_tile, part, **kargs):
   except:
     pass
 
-def download(tile_level, tile_index, end_week, weeks, speed_bucket):
-  #TODO: check if the bucket is valid and if not pretend its a dir to scan for speed tiles
-  log.info('Downloading speed information for the time range')
-  pool = ThreadPool(10)
+def discover(speed_bucket, week_tile, manifest_key, **kargs):
+  #the speed tile stage publishes how many parts there are so we can queue them all straight away
+  session = boto3.session.Session()
+  client = session.client('s3')
+  try:
+    manifest = json.loads(client.get_object(Bucket=speed_bucket, Key=manifest_key)['Body'].read())
+  except Exception:
+    #older weeks dont have one so we find out from the first part
+    kargs['adder'](work, speed_bucket, week_tile, 0)
+    return
+  for part, size in enumerate(manifest['sizes']):
+    kargs['adder'](work, speed_bucket, week_tile, part, size)
+
+def getWeeks(end_week, weeks):
   end = datetime.datetime.strptime(end_week + '/1','%Y/%W/%w').date()
-  suffix = url_suffix(tile_level, tile_index) + '.spd.%d.gz'
-  for week in range(0, weeks):
-    key = (end - datetime.timedelta(weeks=week)).strftime("%Y/%W") + suffix
-    pool.add_task(work, speed_bucket, key, 0)
+  return [(end - datetime.timedelta(weeks=week)).strftime("%Y/%W") for week in range(0, weeks)]
+
+def download(tile_level, tile_index, weeks, speed_bucket, concurrency=10):
+  #TODO: check if the bucket is valid and if not pretend its a dir to scan for speed tiles
+  log.info('Downloading speed information for %d weeks' % len(weeks))
+  #every part of every week goes through the same pool
+  pool = ThreadPool(concurrency)
+  suffix = url_suffix(tile_level, tile_index)
+  for week in weeks:
+    pool.add_task(discover, speed_bucket, week + suffix + '.spd.%d.gz', week + suffix + '.spd.json')
   return pool.wait_completion()
 
-def createAvgSpeedList(fileNames):
+#speeds are whole kph so a histogram with one bin per possible speed gives exact percentiles without keeping
+#every speed around, the hourly averages are kept as dense segment by hour of the week sums and counts
+MAX_SPEED = 160
+SPEED_BINS = MAX_SPEED + 1
+HOURS = 168
+
+def grow(array, rows):
+  if rows <= len(array):
+    return array
+  grown = numpy.zeros((rows,) + array.shape[1:], dtype=array.dtype)
+  grown[:len(array)] = array
+  return grown
+
+def newSums():
+  return {'bins': numpy.zeros((0, SPEED_BINS), dtype=numpy.int32), 'totals': numpy.zeros((0, HOURS), dtype=numpy.int32),
+    'counts': numpy.zeros((0, HOURS), dtype=numpy.int32)}
+
+#boils a single speed tile down to its time range, how many segments it says the tile has and
+#the speed histograms and hourly sums and counts for the rows each of its subtiles covers
+def parseSpeedTile(fileName):
+  log.info('Processing ' + fileName)
+  spdtile = speedtile_pb2.SpeedTile()
+  with gzip.open(fileName, 'rb') as f:
+    spdtile.ParseFromString(f.read())
+  minSeconds = None
+  maxSeconds = None
+  segments = spdtile.subtiles[0].totalSegments if len(spdtile.subtiles) else 0
+  parts = []
+  subtileCount = 1;
+  #we now need to retrieve all of the speeds for each segment in this tile
+  for subtile in spdtile.subtiles:
+    log.debug('>>>>> subtileCount per file=' + str(subtileCount))
+    subtileCount += 1
+    if minSeconds is None or minSeconds > subtile.rangeStart:
+      minSeconds = subtile.rangeStart
+    if maxSeconds is None or maxSeconds < subtile.rangeEnd:
+      maxSeconds = subtile.rangeEnd
+
+    entries = subtile.unitSize / subtile.entrySize
+    speeds = numpy.array(subtile.speeds, dtype=numpy.int64)
+    positions = numpy.arange(len(speeds))
+    #rows are relative to the first segment of the subtile
+    rows = positions / entries
+    hours = positions % entries
+    for i in numpy.flatnonzero(speeds > MAX_SPEED):
+      segmentIndex = subtile.startSegmentIndex + int(rows[i])
+      log.error('INVALID SPEED: i=' + str(i) + ' | segmentIndex=' + str(segmentIndex) + ' | segmentId=' + str((segmentIndex<<25)|(subtile.index<<3)|subtile.level) + ' | speed=' + str(speeds[i]))
+
+    #count each valid speed into its segments histogram
+    size = (len(speeds) + entries - 1) / entries
+    valid = (speeds > 0) & (speeds <= MAX_SPEED)
+    speeds = speeds[valid]
+    rows = rows[valid]
+    hours = hours[valid]
+    bins = numpy.bincount(rows * SPEED_BINS + speeds, minlength=size * SPEED_BINS).reshape(size, SPEED_BINS).astype(numpy.int32)
+    #and into its hour of the week, only the first week of hours makes it into the tile
+    inWeek = hours < HOURS
+    cells = rows[inWeek] * HOURS + hours[inWeek]
+    totals = numpy.bincount(cells, weights=speeds[inWeek], minlength=size * HOURS).reshape(size, HOURS).astype(numpy.int32)
+    counts = numpy.bincount(cells, minlength=size * HOURS).reshape(size, HOURS).astype(numpy.int32)
+    parts.append((subtile.startSegmentIndex, bins, totals, counts))
+
+  del spdtile
+  return fileName, minSeconds, maxSeconds, segments, parts
+
+#parsing is most of the work so its spread over a pool of processes which each hand back the
+#compact sums for one tile at a time to be merged in whatever order they finish
+def parseSpeedTiles(fileNames, processes=1):
+  if processes < 2 or len(fileNames) < 2:
+    for fileName in fileNames:
+      yield parseSpeedTile(fileName)
+    return
+  pool = multiprocessing.Pool(min(processes, len(fileNames)))
+  try:
+    for parsed in pool.imap_unordered(parseSpeedTile, fileNames):
+      yield parsed
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+def mergeSpeedTile(sums, parsed, sign=1):
+  fileName, minSeconds, maxSeconds, segments, parts = parsed
+  #make sure that there are enough rows for all segments
+  log.debug('totalSegments=' + str(segments) + ' | len(bins)=' + str(len(sums['bins'])))
+  for name in ['bins', 'totals', 'counts']:
+    sums[name] = grow(sums[name], segments)
+  for start, bins, totals, counts in parts:
+    end = start + len(bins)
+    sums['bins'][start:end] += sign * bins
+    sums['totals'][start:end] += sign * totals
+    sums['counts'][start:end] += sign * counts
+
+def widenRange(minSeconds, maxSeconds, parsed):
+  if parsed[1] is not None and (minSeconds is None or minSeconds > parsed[1]):
+    minSeconds = parsed[1]
+  if parsed[2] is not None and (maxSeconds is None or maxSeconds < parsed[2]):
+    maxSeconds = parsed[2]
+  return minSeconds, maxSeconds
+
+def createAvgSpeedList(fileNames, processes=1):
   log.info('Getting speed information for time range')
 
   #TODO: when this is getting data over a range of time that includes an update to OSMLR definitions
   #this process will waste time computing values for segments that are marked deleted, this is probably
   #a good thing as it means that people using previous version of osmlr will still have reference speeds
 
-  #each segment has its own list of speeds, we dont know how many segments for the avg speed list to start with
-  segments = []
-  segmentHours=[]
+  #we dont know how many segments there are to start with so these grow as we see bigger tiles
+  sums = newSums()
   minSeconds = None
   maxSeconds = None
 
   #need to loop thru all of the speed tiles for a given tile id
-  for fileName in fileNames:
-    log.info('Processing ' + fileName)
-    spdtile = speedtile_pb2.SpeedTile()
-    with gzip.open(fileName, 'rb') as f:
-      spdtile.ParseFromString(f.read())
-    subtileCount = 1;
-    #we now need to retrieve all of the speeds for each segment in this tile
-    for subtile in spdtile.subtiles:
-      log.debug('>>>>> subtileCount per file=' + str(subtileCount))
-      subtileCount += 1
-      if minSeconds is None or minSeconds > subtile.rangeStart:
-        minSeconds = subtile.rangeStart
-      if maxSeconds is None or maxSeconds < subtile.rangeEnd:
-        maxSeconds = subtile.rangeEnd
-
-      #make sure that there are enough lists in the list for all segments
-      missing = spdtile.subtiles[0].totalSegments - len(segments)
-      log.debug('spdtile.subtiles[0].totalSegments=' + str(spdtile.subtiles[0].totalSegments) + ' | len(segments)=' + str(len(segments)) + ' | missing=' + str(missing))
-      if missing > 0:
-        segments.extend([ [] for i in range(0, missing) ])
-        segmentHours.extend([ {} for i in range(0, missing) ])
-      
-      entries = subtile.unitSize / subtile.entrySize
-      for i, speed in enumerate(subtile.speeds):
-        segmentIndex = subtile.startSegmentIndex + int(math.floor(i/entries))
-        hour = i % entries;
-        log.debug('SPEED: i=' + str(i) + ' | hour=' + str(hour) + ' | segmentIndex=' + str(segmentIndex) + ' | segmentId=' + str((segmentIndex<<25)|(subtile.index<<3)|subtile.level) + ' | speed=' + str(speed))
-        if speed > 0 and speed <= 160:
-          segments[segmentIndex].append(speed)
-          if hour in segmentHours[segmentIndex]:
-            segmentHours[segmentIndex][hour]['total'] += speed
-            segmentHours[segmentIndex][hour]['count'] += 1
-          else:
-            segmentHours[segmentIndex][hour] = {'total': speed, 'count': 1.0}
-        elif speed > 160:
-          log.error('INVALID SPEED: i=' + str(i) + ' | segmentIndex=' + str(segmentIndex) + ' | segmentId=' + str((segmentIndex<<25)|(subtile.index<<3)|subtile.level) + ' | speed=' + str(speed))
-
-  #sort each list of speeds per segment
-  for i, segment in enumerate(segments):
-    segment.sort()
-    log.debug('SORTED SPEEDS: segmentIndex=' + str(i) + ' | speeds=' + str(segment))
-
-  return segments, segmentHours, minSeconds, maxSeconds
-
-def createRefSpeedTile(speedListPerSegment, speedListPerHourPerSegment, tile_level, tile_index, minSeconds, maxSeconds):
+  for parsed in parseSpeedTiles(fileNames, processes):
+    mergeSpeedTile(sums, parsed)
+    minSeconds, maxSeconds = widenRange(minSeconds, maxSeconds, parsed)
+
+  return sums['bins'], sums['totals'], sums['counts'], minSeconds, maxSeconds
+
+#the speed at the given fraction of the way through each segments sorted speeds, 0 where there are none
+def percentiles(bins, fraction):
+  sizes = bins.sum(axis=1)
+  ranks = (sizes * fraction).astype(numpy.int64)
+  #the first speed whose running count passes the rank is the one that would be there after sorting
+  speeds = (numpy.cumsum(bins, axis=1) <= ranks[:, numpy.newaxis]).sum(axis=1)
+  speeds[sizes == 0] = 0
+  return speeds
+
+def createRefSpeedTile(bins, totals, counts, tile_level, tile_index, minSeconds, maxSeconds):
   log.info('Creating reference speed tile')
 
   tile = speedtile_pb2.SpeedTile()
@@ -173,8 +269,8 @@ def createRefSpeedTile(speedListPerSegment, speedListPerHourPerSegment, tile_lev
   st.level = tile_level
   st.index = tile_index
   st.startSegmentIndex = 0
-  st.totalSegments = len(speedListPerSegment)
-  st.subtileSegments = len(speedListPerSegment)
+  st.totalSegments = len(bins)
+  st.subtileSegments = len(bins)
   #time stuff
   st.rangeStart = minSeconds
   st.rangeEnd = maxSeconds
@@ -182,22 +278,121 @@ def createRefSpeedTile(speedListPerSegment, speedListPerHourPerSegment, tile_lev
   st.entrySize = 3600 #note that this only holds true for the average per hour speeds, the references speeds have no bearing on unit and entry size since they are one speed per segment
   st.description = 'Week reference speeds averaged over ' + time.strftime('%Y.%m.%d %H:%M:%S', time.gmtime(minSeconds)) + ' - ' + time.strftime('%Y.%m.%d %H:%M:%S', time.gmtime(maxSeconds))
 
-  #bucketize avg speeds into 20%, 40%, 60% and 80% reference speed buckets
-  #for each segment
-  #for segment in speedListPerSegment:
-  for segment in speedListPerSegment:
-    size = len(segment)
-    st.referenceSpeeds20.append(segment[int(size * .2)] if size > 0 else 0) #0 here represents no data
-    st.referenceSpeeds40.append(segment[int(size * .4)] if size > 0 else 0) #0 here represents no data
-    st.referenceSpeeds60.append(segment[int(size * .6)] if size > 0 else 0) #0 here represents no data
-    st.referenceSpeeds80.append(segment[int(size * .8)] if size > 0 else 0) #0 here represents no data
-
-  # write out the average speeds for each hour for each segment
-  for segment in speedListPerHourPerSegment:
-    for hour in range(0,168):
-      st.speeds.append(int(round(segment[hour]['total'] / segment[hour]['count'])) if hour in segment else 0)
+  #bucketize avg speeds into 20%, 40%, 60% and 80% reference speed buckets for each segment, 0 here represents no data
+  st.referenceSpeeds20.extend(percentiles(bins, .2).tolist())
+  st.referenceSpeeds40.extend(percentiles(bins, .4).tolist())
+  st.referenceSpeeds60.extend(percentiles(bins, .6).tolist())
+  st.referenceSpeeds80.extend(percentiles(bins, .8).tolist())
+
+  # write out the average speeds for each hour for each segment, rounding halves up like round does for positives
+  averages = numpy.zeros(totals.shape, dtype=numpy.int64)
+  seen = counts > 0
+  averages[seen] = numpy.floor(totals[seen] / counts[seen].astype(numpy.float64) + 0.5)
+  st.speeds.extend(averages.ravel().tolist())
   return tile
 
+#rather than going through the whole window every time we keep the running sums for it along with what
+#each week contributed to the time range. when the window slides the new weeks are added in and the weeks
+#that fell out are downloaded again and subtracted, so usually only two weeks of speed tiles are read.
+#a week with no data is remembered as None so we dont keep looking for it
+STATE_VERSION = 1
+
+def stateKey(tile_level, tile_index):
+  return ('state' + url_suffix(tile_level, tile_index) + '.state.npz').strip('/')
+
+def newState():
+  state = newSums()
+  state['weeks'] = {}
+  return state
+
+def loadState(bucket, key):
+  fileName = key.split('/')[-1]
+  try:
+    if bucket is not None:
+      boto3.client('s3').download_file(bucket, key, fileName)
+    npz = numpy.load(fileName)
+    try:
+      meta = json.loads(str(npz['meta']))
+      if meta.get('version') != STATE_VERSION:
+        log.info('Ignoring state with unknown version')
+        return None
+      return {'weeks': meta['weeks'], 'bins': npz['bins'], 'totals': npz['totals'], 'counts': npz['counts']}
+    finally:
+      npz.close()
+  except Exception as e:
+    log.info('No usable state found at %s' % key)
+    return None
+  finally:
+    if bucket is not None and os.path.isfile(fileName):
+      os.remove(fileName)
+
+def saveState(state, bucket, key):
+  buf = StringIO.StringIO()
+  numpy.savez_compressed(buf, meta=numpy.array(json.dumps({'version': STATE_VERSION, 'weeks': state['weeks']})),
+    bins=state['bins'], totals=state['totals'], counts=state['counts'])
+  if bucket is not None:
+    log.info('Uploading state to %s as %s' % (bucket, key))
+    boto3.client('s3').put_object(Bucket=bucket, ContentType='application/octet-stream', Body=buf.getvalue(), Key=key)
+  else:
+    fileName = key.split('/')[-1]
+    log.info('Writing state to %s' % fileName)
+    with open(fileName, 'wb') as f:
+      f.write(buf.getvalue())
+
+#adds or subtracts the given weeks of files to or from the running sums
+def updateState(state, files, sign, processes):
+  weeks = {}
+  fileWeeks = {}
+  for week, fileNames in files.iteritems():
+    for fileName in fileNames:
+      fileWeeks[fileName] = week
+  for parsed in parseSpeedTiles(fileWeeks.keys(), processes):
+    mergeSpeedTile(state, parsed, sign)
+    meta = weeks.setdefault(fileWeeks[parsed[0]], {'rangeStart': None, 'rangeEnd': None, 'segments': 0})
+    meta['rangeStart'], meta['rangeEnd'] = widenRange(meta['rangeStart'], meta['rangeEnd'], parsed)
+    meta['segments'] = max(meta['segments'], parsed[3])
+  for week in files.iterkeys():
+    if sign > 0:
+      state['weeks'][week] = weeks.get(week)
+    else:
+      del state['weeks'][week]
+
+def weekFiles(fileNames, weeks):
+  files = dict([(week, []) for week in weeks])
+  for fileName in fileNames:
+    files['/'.join(fileName.split('/')[:2])].append(fileName)
+  return files
+
+def rollState(state, tile_level, tile_index, weeks, speed_bucket, concurrency, processes):
+  #we cant tell what a week used to contribute once its been rewritten, so if the week were asked to
+  #include is one we already have, or theres more to change than to read, start from scratch
+  adding = [week for week in weeks if week not in state['weeks']]
+  removing = [week for week in state['weeks'] if week not in weeks]
+  if weeks[0] in state['weeks'] or len(adding) + len(removing) >= len(weeks):
+    log.info('Recomputing the whole window')
+    return None
+  log.info('Adding %d weeks and removing %d weeks' % (len(adding), len(removing)))
+  #one round of downloads for everything, the weeks we subtract have to still be there
+  files = weekFiles(download(tile_level, tile_index, adding + removing, speed_bucket, concurrency), adding + removing)
+  if any([state['weeks'][week] is not None and not files[week] for week in removing]):
+    log.info('Some of the weeks that left the window are gone')
+    return None
+  updateState(state, dict([(week, files[week]) for week in adding]), 1, processes)
+  updateState(state, dict([(week, files[week] if state['weeks'][week] is not None else []) for week in removing]), -1, processes)
+  if (state['bins'] < 0).any() or (state['counts'] < 0).any():
+    log.warn('State went negative')
+    return None
+  return state
+
+def windowState(state):
+  weeks = [w for w in state['weeks'].itervalues() if w is not None]
+  if not weeks:
+    return None
+  #the tile only covers the segments of the largest week
+  segments = max([w['segments'] for w in weeks])
+  return state['bins'][:segments], state['totals'][:segments], state['counts'][:segments], \
+    min([w['rangeStart'] for w in weeks]), max([w['rangeEnd'] for w in weeks])
+
 def writeTile(tile, bucket):
   #compress
   log.info('Compressing reference speed tile')
@@ -227,6 +422,9 @@ if __name__ == "__main__":
   parser.add_argument('--weeks', type=int, help='How many weeks up to and including this end week to make use of', default=52)
   parser.add_argument('--tile-level', type=int, help='The level to target', required=True)
   parser.add_argument('--tile-index', type=int, help='The tile id to target', required=True)
+  parser.add_argument('--concurrency', type=int, help='How many speed tiles to download at once', default=10)
+  parser.add_argument('--processes', type=int, help='How many processes to parse speed tiles with', default=multiprocessing.cpu_count())
+  parser.add_argument('--no-state', help='If present the whole window is recomputed rather than updating the running sums from the last run', action='store_true')
   parser.add_argument('--verbose', '-v', help='Turn on verbose output i.e. DEBUG level logging', action='store_true')
 
   # parse the arguments
@@ -247,17 +445,27 @@ if __name__ == "__main__":
     log.debug('tile-level ' + str(args.tile_level))
     log.debug('tile-index ' + str(args.tile_index))
 
+  #update the running sums or failing that build them for the whole window
+  weeks = getWeeks(args.end_week, args.weeks)
+  key = stateKey(args.tile_level, args.tile_index)
+  state = None if args.no_state else loadState(reference_bucket, key)
+  if state is not None:
+    state = rollState(state, args.tile_level, args.tile_index, weeks, speed_bucket, args.concurrency, args.processes)
+  if state is None:
+    state = newState()
+    files = weekFiles(download(args.tile_level, args.tile_index, weeks, speed_bucket, args.concurrency), weeks)
+    updateState(state, files, 1, args.processes)
+  saveState(state, reference_bucket, key)
+
   #get the data
-  fileNames = download(args.tile_level, args.tile_index, args.end_week, args.weeks, speed_bucket)
-  if not fileNames:
+  window = windowState(state)
+  if window is None:
     log.info('No data was found')
     sys.exit(0)
-  
-  #read the data
-  speedListPerSegment, speedListPerHourPerSegment, minSeconds, maxSeconds = createAvgSpeedList(fileNames)
+  bins, totals, counts, minSeconds, maxSeconds = window
 
   #turn the data into a tile
-  tile = createRefSpeedTile(speedListPerSegment, speedListPerHourPerSegment, args.tile_level, args.tile_index, minSeconds, maxSeconds)
+  tile = createRefSpeedTile(bins, totals, counts, args.tile_level, args.tile_index, minSeconds, maxSeconds)
 
   #store the ref tile
   writeTile(tile, reference_bucket)
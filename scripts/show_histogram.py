@@ -5,6 +5,7 @@ import os
 import errno
 import sys
 import logging
+import mmap
 import pprint
 
 log = logging.getLogger('make_speeds')
@@ -58,18 +59,28 @@ def unquantise(val):
 ###############################################################################
 def getSegments(path):
   segments = {}
-  with open(path) as filehandle:
+  with open(path, 'rb') as filehandle:
     log.info('Loading ' + path + '...')
-    hist = Histogram.GetRootAsHistogram(bytearray(filehandle.read()), 0)
-  level = get_level(hist.TileId())
-  tile_index = get_tile_index(hist.TileId())
-  log.info('Processing ' + path + '...')
-  #for each segment
-  for i in range(0, hist.SegmentsLength()):
-    segment = hist.Segments(i)
-    if segment.EntriesLength() > 0:
-      processSegment(segments, segment)
-  del hist
+    #map it read only rather than copying it, cant map an empty file though
+    mapped = None
+    if os.fstat(filehandle.fileno()).st_size > 0:
+      mapped = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+      buf = memoryview(buffer(mapped))
+    else:
+      buf = bytearray(filehandle.read())
+    hist = Histogram.GetRootAsHistogram(buf, 0)
+    level = get_level(hist.TileId())
+    tile_index = get_tile_index(hist.TileId())
+    log.info('Processing ' + path + '...')
+    #for each segment
+    for i in range(0, hist.SegmentsLength()):
+      segment = hist.Segments(i)
+      if segment.EntriesLength() > 0:
+        processSegment(segments, segment)
+    del hist
+    del buf
+    if mapped is not None:
+      mapped.close()
   return segments
 
 ###############################################################################
@@ -16,6 +16,10 @@ import multiprocessing
 import Queue
 import random
 import functools
+import json
+import time
+import shutil
+import sys
 
 logger = logging.getLogger('make_speeds')
 logger.setLevel(logging.INFO)
@@ -25,9 +29,15 @@ logger.addHandler(handler)
 
 # import make_speeds after logger has been setup
 import make_speeds
+import listing
+import histogram_coverage
 
 valhalla_tiles = [{'level': 2, 'size': 0.25}, {'level': 1, 'size': 1.0}, {'level': 0, 'size': 4.0}]
 
+#rough guess at how much memory decoding a tile takes, from how big its histograms are
+DECODED_BYTES_PER_HISTOGRAM_BYTE = 8
+TILE_OVERHEAD_BYTES = 64 * 1024 * 1024
+
 def url_suffix(tile_level, tile_index):
   tile_set = filter(lambda x: x['level'] == tile_level, valhalla_tiles)[0]
   max_index = int(360.0/tile_set['size'] * 180.0/tile_set['size']) - 1
@@ -59,6 +69,7 @@ def upload(speed_bucket, level, index, week, speed_tiles):
   logger.info('Uploading data to bucket: ' + speed_bucket)
   client = boto3.client('s3')
   prefix = week + '/'.join(url_suffix(int(level), int(index)).split('/')[:-1])
+  sizes = {}
   for tile in speed_tiles:
     key = prefix + '/' + tile.split('/')[-1] + '.gz'
     logger.info('Uploading ' + tile + ' as ' + key)
@@ -72,68 +83,123 @@ def upload(speed_bucket, level, index, week, speed_tiles):
       ContentEncoding='gzip',
       Body=zipped.getvalue(),
       Key=key)
+    sizes[tile.split('/')[-1]] = len(zipped.getvalue())
+
+  #publish how many parts there are and how big so readers can fetch them all at once
+  name = url_suffix(int(level), int(index)).split('/')[-1]
+  for kind in ['spd', 'nex']:
+    parts = []
+    while '%s.%s.%d' % (name, kind, len(parts)) in sizes:
+      parts.append(sizes['%s.%s.%d' % (name, kind, len(parts))])
+    if not parts:
+      continue
+    key = prefix + '/' + name + '.' + kind + '.json'
+    logger.info('Uploading manifest of %d parts as %s' % (len(parts), key))
+    client.put_object(
+      ACL='public-read',
+      Bucket=speed_bucket,
+      ContentType='application/json',
+      Body=json.dumps({'parts': len(parts), 'sizes': parts}),
+      Key=key)
 
-def load(histograms, sub_segments, info, lengths, loaded):
-  segments = {}
+def load(histograms, sub_segments, info, lengths, prefix):
+  segments = make_speeds.SegmentAccumulator()
+  count = 0
+  waiting = 0.0
+  started = time.time()
   while True:
     try:
+      #block until a fetcher has a file on disk for us
+      waited = time.time()
       file_name = histograms.get()
+      waiting += time.time() - waited
       #finished if we get the sentinel
       if not file_name:
         break
-      loaded.put(file_name)
       make_speeds.addSegments(file_name, info, lengths, segments)
+      count += 1
     except (KeyboardInterrupt, SystemExit) as e:
       raise e
     except Exception as e:
       logger.error('Failed to load segments from %s' % file_name)
+  logger.info('Decoded %d histograms in %.2fs of which %.2fs was spent waiting on downloads' % (count, time.time() - started, waiting))
 
-  #send back the info
-  sub_segments.put(segments)
+  #write out the info and send back where it is rather than pickling the whole thing
+  sub_segments.put((count, segments.save(prefix)))
 
-def convert(level, index, week, osmlr_version, histograms, concurrency):
+def fetch_osmlr(level, index, osmlr_version, osmlr):
   url = 'http://s3.amazonaws.com/osmlr-tiles/' + osmlr_version + '/pbf' + url_suffix(level, index) + '.osmlr'
   logger.info('Fetching osmlr tile: ' + url)
-  osmlr = str(level) + '_' + str(index) + '.osmlr'
   urllib.URLopener().retrieve(url, osmlr)
+  return osmlr
 
+def convert(level, index, week, osmlr_version, histogram_bucket, concurrency, lengths_cache, keys):
+  started = time.time()
   logger.info('Getting segment lengths from osmlr')
-  lengths = make_speeds.getLengths(osmlr)
+  #the tile is only fetched if the lengths arent already cached and we dont need it after that
+  osmlr = str(level) + '_' + str(index) + '.osmlr'
+  lengths = make_speeds.getCachedLengths(lengths_cache, osmlr_version, level, index, functools.partial(fetch_osmlr, level, index, osmlr_version, osmlr))
+  if os.path.isfile(osmlr):
+    os.remove(osmlr)
+  logger.info('Stage osmlr took %.2fs' % (time.time() - started))
 
   date = datetime.datetime.strptime(week + '/1','%Y/%W/%w')
   start = calendar.timegm(date.timetuple())
   info = {'rangeStart': start, 'rangeEnd': start + 604800, 'unitSize': 604800, 'entrySize': 3600,
     'description': 'Hourly speeds for the week starting on ' + str(date), 'level': level, 'index': index}
 
-  logger.info('Accumulating segment speeds from histograms')
-  #we share the segments dict in a process safe way
+  logger.info('Accumulating segment speeds from histograms as they are downloaded')
+  #the loaders start first and pick up each histogram as soon as its on disk, the queue is bounded
+  #so that when decoding falls behind the fetchers block rather than filling the disk
+  started = time.time()
+  histograms = multiprocessing.Queue(concurrency * 2)
   sub_segments = multiprocessing.Queue()
-  loaded = multiprocessing.Queue()
   processes = []
-  #start them up and wait for them to get all the results back
-  for i in xrange(concurrency):
-    histograms.put(False)
   for i in xrange(concurrency):
-    bound = functools.partial(load, histograms, sub_segments, info, lengths, loaded)
+    bound = functools.partial(load, histograms, sub_segments, info, lengths, '%d_%d.segments.%d' % (level, index, i))
     processes.append(multiprocessing.Process(target=interrupt_wrapper, args=(bound,)))
     processes[-1].start()
 
+  #go get the histogram data, once its all fetched tell the loaders they can finish
+  for p in download(histogram_bucket, keys, concurrency, histograms):
+    if p.is_alive():
+      p.join()
+  logger.info('Stage download took %.2fs' % (time.time() - started))
+  for i in xrange(concurrency):
+    histograms.put(False)
+
+  #decoding overlaps the download so this is only what is left of it once the download is done, the loaders log their
+  #own decode times
+  started = time.time()
+
   #then harvest all the sub_segments
-  segments = {}
+  #the sub processes can have rows for the same segment and hour, a histogram and its deltas are the same hour but can
+  #be decoded by different loaders, so this only works because the accumulator sums up rows that share a key when it
+  #compacts before anything reads it. that compact is not redundant
+  segments = make_speeds.SegmentAccumulator()
+  segment_files = []
+  count = 0
   for i in xrange(concurrency):
     #get out the segments and merge them all together
-    sub = sub_segments.get()
-    while len(sub):
-      seg_id = sub.iterkeys().next()
-      hours = sub.pop(seg_id)
-      #since each histogram is a specific hour no two dicts will have the same hour
-      segments.setdefault(seg_id, {}).update(hours)
+    sub_count, sub = sub_segments.get()
+    count += sub_count
+    segments.extend(make_speeds.SegmentAccumulator.load(sub))
+    segment_files.extend(sub)
     logger.info('Merged result segments from sub process %d' % i)
+  logger.info('Stage decode took %.2fs' % (time.time() - started))
 
   #then make some tiles
-  logger.info('Creating speed tiles')
-  prefix = url_suffix(int(level), int(index)).split('/')[-1]
-  return make_speeds.createSpeedTiles(lengths, prefix + '.spd', 10000, prefix + '.nex', True, segments, info), loaded, osmlr
+  speed_tiles = None
+  if count:
+    started = time.time()
+    logger.info('Creating speed tiles')
+    prefix = url_suffix(int(level), int(index)).split('/')[-1]
+    speed_tiles = make_speeds.createSpeedTiles(lengths, prefix + '.spd', 10000, prefix + '.nex', True, segments, info)
+    logger.info('Stage speed tiles took %.2fs' % (time.time() - started))
+  del segments
+  for f in segment_files:
+    os.remove(f)
+  return speed_tiles
 
 def fetch(histogram_bucket, keys, results):
   session = boto3.session.Session()
@@ -144,33 +210,140 @@ def fetch(histogram_bucket, keys, results):
       resource.Object(histogram_bucket, key).download_file(dest)
       if os.path.isfile(dest):
         logger.info('Downloaded s3://' + histogram_bucket + '/' + key)
+        #blocks while the loaders are behind
         results.put(dest)
     except (KeyboardInterrupt, SystemExit) as e:
       raise e
     except Exception as e:
       pass
 
-def download(histogram_bucket, tile_level, tile_index, week, concurrency):
-  #we need to get all the histograms for all the hours of this week
+def list_histograms(client, histogram_bucket, tile_level, tile_index, week, hours=None):
+  #the keys and sizes of the histograms, and any deltas that havent been folded into them yet, for all the hours of
+  #this week or just the ones the coverage index says exist
   date = datetime.datetime.strptime(week + '/1','%Y/%W/%w')
-  logger.info('Downloading files for week ' + '{d.year}/{d.month}/{d.day} tile {l}/{t}.fb'.format(d=date, l=tile_level, t=tile_index))
   keys = []
-  for hour in xrange(0, 24 * 7):
+  for hour in (xrange(0, histogram_coverage.HOURS_PER_WEEK) if hours is None else hours):
     key = '{d.year}/{d.month}/{d.day}/{d.hour}/{l}/{t}.fb'.format(d=(date + datetime.timedelta(hours=hour)), l=tile_level, t=tile_index)
     keys.append(key)
+  listed = listing.get_objects(client, histogram_bucket, keys)
+  etags = dict([(o['Key'], o['ETag'].strip('"')) for o in listed])
+  #a compaction that died before removing the deltas it folded leaves a record of them, see work.py, but it only
+  #counts if the histogram it names is the one that is actually there
+  folded = set()
+  for key in keys:
+    if key in etags and key + '.d/folded' in etags:
+      lines = client.get_object(Bucket=histogram_bucket, Key=key + '.d/folded')['Body'].read().split()
+      if lines and lines[0] == etags[key]:
+        folded.update([key + '.d/' + name for name in lines[1:]])
+  keys = set(keys)
+  return [(o['Key'], o['Size']) for o in listed if o['Key'] not in folded and
+    (o['Key'] in keys or (o['Key'].rsplit('.d/', 1)[0] in keys and o['Key'].endswith('.fb')))]
+
+def download(histogram_bucket, keys, concurrency, downloaded):
+  logger.info('Downloading %d histograms' % len(keys))
+  keys = list(keys)
   random.shuffle(keys)
   keys = split(keys, concurrency)
 
+  #the fetchers hand off each file as it lands, callers join them when they need to know they are done
   processes = []
-  downloaded = multiprocessing.Queue()
   for i in xrange(concurrency):
     bound = functools.partial(fetch, histogram_bucket, keys[i], downloaded)
     processes.append(multiprocessing.Process(target=interrupt_wrapper, args=(bound,)))
     processes[-1].start()
-  for p in processes:
-    if p.is_alive():
-      p.join()
-  return downloaded
+  return processes
+
+def make_tile(tile, keys, args, events):
+  #everything for this tile happens in its own directory so tiles running side by side dont trip over each others files
+  #anything left there by an earlier attempt that crashed cant be trusted so it goes first
+  cwd = os.getcwd()
+  directory = os.path.join(cwd, '%d_%d' % tile)
+  shutil.rmtree(directory, True)
+  os.makedirs(directory)
+  os.chdir(directory)
+  histogram_bucket = 'datastore-output-' + args.environment
+  speed_bucket = 'speedtiles-' + args.environment
+  job_queue = 'referencetiles-' + args.environment
+  job_def = 'referencetiles-' + args.environment
+  try:
+    logger.info('Making speed tile %d/%d from %d histograms' % (tile[0], tile[1], len(keys)))
+    #go get the histogram data and make the speed tile as it arrives
+    speed_tiles = convert(tile[0], tile[1], args.week, args.osmlr_version, histogram_bucket, args.concurrency, args.lengths_cache, keys)
+    #the big stuff is gone now so the next tile can start decoding while we upload this one
+    events.put(('decoded', tile))
+    if speed_tiles is not None:
+      #move the speed tile to its destination
+      upload(speed_bucket, tile[0], tile[1], args.week, speed_tiles)
+      #create the corresponding referencetile job
+      job_name = '_'.join([args.week.replace('/', '-'), str(tile[0]), str(tile[1])])
+      job = {'environment': args.environment, 'tile_level': str(tile[0]), 'tile_index': str(tile[1]), 'week': args.week}
+      logger.info('Submitting reference tile job ' + job_name)
+      logger.info('Job parameters ' + str(job))
+      submitted = boto3.client('batch').submit_job(
+        jobName = job_name,
+        jobQueue = job_queue,
+        jobDefinition = job_def,
+        parameters = job,
+        containerOverrides={
+          'memory': 8192,
+          'vcpus': 2,
+          'command': ['/scripts/ref-tile-work.py', '--environment', 'Ref::environment', '--end-week', 'Ref::week', '--weeks', '52', '--tile-level', 'Ref::tile_level', '--tile-index', 'Ref::tile_index', '--processes', '2']
+        }
+      )
+      logger.info('Job %s was submitted and got id %s' % (job_name, submitted['jobId']))
+    else:
+      logger.info('No histogram data for tile %d/%d' % tile)
+    events.put(('done', tile))
+  finally:
+    #clean up the files
+    os.chdir(cwd)
+    shutil.rmtree(directory, True)
+
+def schedule(tiles, start, events, workers, budget):
+  #run up to workers tiles at once, largest first, without the ones that are still decoding going over the memory budget
+  #tiles are (tile, estimated bytes) and start(tile) gives back a started process, returns the tiles that didnt finish
+  pending = sorted(tiles, key=lambda t: t[1], reverse=True)
+  running = {}
+  reserved = {}
+  done = set()
+  failed = []
+  while pending or running:
+    #start whatever fits, if nothing is decoding a tile gets to go even when its over the budget on its own
+    for tile, estimate in list(pending):
+      if len(running) >= workers:
+        break
+      if reserved and sum(reserved.values()) + estimate > budget:
+        continue
+      pending.remove((tile, estimate))
+      running[tile] = start(tile)
+      reserved[tile] = estimate
+    #wait to hear from one of them
+    try:
+      kind, tile = events.get(True, 1)
+      reserved.pop(tile, None)
+      if kind == 'done':
+        done.add(tile)
+    except Queue.Empty:
+      pass
+    #see which ones have exited
+    for tile, process in list(running.items()):
+      if not process.is_alive():
+        process.join()
+        #it may have finished just after we stopped waiting
+        while tile not in done:
+          try:
+            kind, finished = events.get(True, 1)
+          except Queue.Empty:
+            break
+          reserved.pop(finished, None)
+          if kind == 'done':
+            done.add(finished)
+        del running[tile]
+        reserved.pop(tile, None)
+        if tile not in done:
+          logger.error('Failed making speed tile %d/%d' % tile)
+          failed.append(tile)
+  return failed
 
 def add_tiles(tiles, tile_level, tile_index, max_level):
   #keep this one
@@ -201,64 +374,58 @@ if __name__ == '__main__':
   parser.add_argument('--concurrency', type=int, help='The week used to get the input data from the histogram bucket', default=1)
   parser.add_argument('--max-tile-level', type=int, help='The max tile level to generate speed tiles for. Must be at least 0 and can go up to 2', default=1)
   parser.add_argument('--osmlr-version', type=str, help='The version of osmlr to fetch when creating speed tiles', required=True)
+  parser.add_argument('--tile-concurrency', type=int, help='How many of the parent tile and its subtiles to work on at once', default=2)
+  parser.add_argument('--memory-budget', type=int, help='Roughly how many megabytes the tiles being decoded at once can use between them', default=6144)
+  parser.add_argument('--lengths-cache', type=str, help='The directory in which to cache segment lengths derived from osmlr tiles', default=make_speeds.LENGTHS_CACHE_DIR)
   args = parser.parse_args()
 
   #generate the list of the parent tile and all its subtiles, level 0 and 1 only right now
   tiles = []
   add_tiles(tiles, args.tile_level, args.tile_index, args.max_tile_level)
 
-  #need this to submit jobs
-  batch_client = boto3.client('batch')
   histogram_bucket = 'datastore-output-' + args.environment
   speed_bucket = 'speedtiles-' + args.environment
-  job_queue = 'referencetiles-' + args.environment
-  job_def = 'referencetiles-' + args.environment
+  logger.info('Histogram input bucket: ' + histogram_bucket)
+  logger.info('Speedtile output bucket: ' + speed_bucket)
+  logger.info('Week: ' + args.week)
+  logger.info('OSMLR: ' + args.osmlr_version)
+  args.lengths_cache = os.path.abspath(args.lengths_cache)
 
-  try:
-    #for each tile
-    for tile in tiles:
-      logger.info('Histogram input bucket: ' + histogram_bucket)
-      logger.info('Speedtile output bucket: ' + speed_bucket)
-      logger.info('Tile level: ' + str(tile[0]))
-      logger.info('Tile index: ' + str(tile[1]))
-      logger.info('Week: ' + args.week)
-      logger.info('OSMLR: ' + args.osmlr_version)
-      #go get the histogram data
-      histograms = download(histogram_bucket, tile[0], tile[1], args.week, args.concurrency)
-      if not histograms.empty():
-        #make the speed tile
-        speed_tiles, histograms, osmlr = convert(tile[0], tile[1], args.week, args.osmlr_version, histograms, args.concurrency)
-        #move the speed tile to its destination
-        upload(speed_bucket, tile[0], tile[1], args.week, speed_tiles)
-        #create the corresponding referencetile job
-        job_name = '_'.join([args.week.replace('/', '-'), str(tile[0]), str(tile[1])])
-        job = {'environment': args.environment, 'tile_level': str(tile[0]), 'tile_index': str(tile[1]), 'week': args.week}
-        logger.info('Submitting reference tile job ' + job_name)
-        logger.info('Job parameters ' + str(job))
-        submitted = batch_client.submit_job(
-          jobName = job_name,
-          jobQueue = job_queue,
-          jobDefinition = job_def,
-          parameters = job,
-          containerOverrides={
-            'memory': 8192,
-            'vcpus': 2,
-            'command': ['/scripts/ref-tile-work.py', '--environment', 'Ref::environment', '--end-week', 'Ref::week', '--weeks', '52', '--tile-level', 'Ref::tile_level', '--tile-index', 'Ref::tile_index']
-          }
-        )
-        logger.info('Job %s was submitted and got id %s' % (job_name, submitted['jobId']))
-        #clean up the files
-        histograms.put(False)
-        while True:
-          f = histograms.get()
-          if not f:
-            break
-          os.remove(f)
-        for f in speed_tiles + [osmlr]:
-          os.remove(f)
-      else:
-        logger.info('No histogram data')
+  #skip the tiles that have no histograms this week, weeks whose index isnt complete try everything
+  s3_client = listing.s3_client()
+  covered = histogram_coverage.covered_tiles(s3_client, histogram_bucket, args.week)
+  if covered is None:
+    logger.warning('No complete coverage index for the week of ' + args.week + ', trying every hour of every tile')
+  else:
+    tiles = [tile for tile in tiles if tile[1] in covered.get(tile[0], set())]
+    logger.info('%d tiles have data for the week of %s' % (len(tiles), args.week))
+
+  #find out which histograms there are and guess how much memory each tile will need from how big they are
+  keys = {}
+  estimates = []
+  for tile in tiles:
+    hours = None if covered is None else histogram_coverage.covered_hours(s3_client, histogram_bucket, args.week, tile[0], tile[1])
+    listed = list_histograms(s3_client, histogram_bucket, tile[0], tile[1], args.week, hours)
+    if not listed:
+      logger.info('No histogram data for tile %d/%d' % tile)
+      continue
+    keys[tile] = [k for k, size in listed]
+    estimates.append((tile, sum([size for k, size in listed]) * DECODED_BYTES_PER_HISTOGRAM_BYTE + TILE_OVERHEAD_BYTES))
+    logger.info('Tile %d/%d has %d histograms, expect it to need %dMB' % (tile[0], tile[1], len(listed), estimates[-1][1] / 1048576))
 
-    logger.info('Run complete')
+  #each tile is its own process so upload and submission of one overlaps decoding of the next
+  events = multiprocessing.Queue()
+  def start(tile):
+    process = multiprocessing.Process(target=interrupt_wrapper, args=(functools.partial(make_tile, tile, keys[tile], args, events),))
+    process.start()
+    return process
+
+  try:
+    failed = schedule(estimates, start, events, args.tile_concurrency, args.memory_budget * 1048576)
   except (KeyboardInterrupt, SystemExit):
     logger.error('Interrupted or killed')
+    sys.exit(1)
+  if failed:
+    logger.error('Failed making %d speed tiles' % len(failed))
+    sys.exit(1)
+  logger.info('Run complete')
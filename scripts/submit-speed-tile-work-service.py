@@ -9,6 +9,8 @@ import re
 import datetime
 import logging
 import math
+import listing
+import histogram_coverage
 
 logger = logging.getLogger('make_speeds')
 logger.setLevel(logging.DEBUG)
@@ -22,40 +24,21 @@ def natural_sorted(l):
   exp = re.compile('([0-9]+)')
   return sorted(l, key=lambda s:[ int(c) if c.isdigit() else c for c in re.split(exp, s) ])
 
-def get_prefixes_keys(client, bucket, prefixes):
-  keys = []
-  pres = []
-  for prefix in prefixes:
-    token = None
-    first = True
-    while first or token:
-      if token:
-        objects = client.list_objects_v2(Bucket=bucket, Delimiter='/', Prefix=prefix, ContinuationToken=token)
-      else:
-        objects = client.list_objects_v2(Bucket=bucket, Delimiter='/', Prefix=prefix)
-      if 'Contents' in objects:
-        keys.extend([ o['Key'] for o in objects['Contents'] ])
-      if 'CommonPrefixes' in objects:
-        pres.extend([ o['Prefix'] for o in objects['CommonPrefixes'] ])
-      token = objects.get('NextContinuationToken')
-      first = False
-  return pres, keys
-
 def get_week(client, env):
   histogram_bucket = 'datastore-output-' + env
   speed_bucket = 'speedtiles-' + env
 
   #what source data do we have
   logger.info('Getting time range for source ' + histogram_bucket)
-  years = natural_sorted(get_prefixes_keys(client, histogram_bucket, [''])[0])
-  min_month = natural_sorted(get_prefixes_keys(client, histogram_bucket, years[:1])[0])[0]
-  max_month = natural_sorted(get_prefixes_keys(client, histogram_bucket, years[-1:])[0])[-1]
+  years = natural_sorted(filter(lambda p: p.strip('/').isdigit(), listing.get_prefixes_keys(client, histogram_bucket, [''])[0]))
+  min_month = natural_sorted(listing.get_prefixes_keys(client, histogram_bucket, years[:1])[0])[0]
+  max_month = natural_sorted(listing.get_prefixes_keys(client, histogram_bucket, years[-1:])[0])[-1]
 
-  min_day = natural_sorted(get_prefixes_keys(client, histogram_bucket, [min_month])[0])[0]
+  min_day = natural_sorted(listing.get_prefixes_keys(client, histogram_bucket, [min_month])[0])[0]
   min_date = datetime.datetime.strptime(min_day, '%Y/%m/%d/').date()
   min_date = min_date - datetime.timedelta(days=min_date.weekday())
 
-  max_day = natural_sorted(get_prefixes_keys(client, histogram_bucket, [max_month])[0])[-1]
+  max_day = natural_sorted(listing.get_prefixes_keys(client, histogram_bucket, [max_month])[0])[-1]
   max_date = datetime.datetime.strptime(max_day, '%Y/%m/%d/').date()
   max_date = max_date + datetime.timedelta(days=(6 - max_date.weekday()))
   logger.info('Source data ranges from ' + min_day + ' to ' + max_day)
@@ -64,9 +47,9 @@ def get_week(client, env):
   #what dest data did we already create
   logger.info('Getting week for destination ' + speed_bucket)
   
-  years = natural_sorted(get_prefixes_keys(client, speed_bucket, [''])[0])
+  years = natural_sorted(listing.get_prefixes_keys(client, speed_bucket, [''])[0])
   if len(years):
-    week = natural_sorted(get_prefixes_keys(client, speed_bucket, years[-1:])[0])[-1]
+    week = natural_sorted(listing.get_prefixes_keys(client, speed_bucket, years[-1:])[0])[-1]
     date = datetime.datetime.strptime(week + '1','%Y/%W/%w').date()
     date = date + datetime.timedelta(days=7)
     #this week falls too far in the future
@@ -93,7 +76,36 @@ def get_tiles(tile_level, tile_index):
       tiles.append((next_level['level'],  y*per_row + x))
   return tiles
 
-def submit_jobs(batch_client, env, week, bbox, max_level, osmlr_version):
+def get_parent(tile_level, tile_index):
+  level = filter(lambda x: x['level'] == tile_level, valhalla_tiles)[0]
+  parent_level = filter(lambda x: x['level'] == tile_level - 1, valhalla_tiles)[0]
+  per_row = int(360 / level['size'])
+  scale = int(parent_level['size'] / level['size'])
+  row = tile_index / per_row / scale
+  col = tile_index % per_row / scale
+  return parent_level['level'], row * int(360 / parent_level['size']) + col
+
+def get_covered(client, env, week, max_level):
+  #the level 0 tiles which themselves or any of their sub tiles, up to the max level, have data this week
+  histogram_bucket = 'datastore-output-' + env
+  covered = histogram_coverage.covered_tiles(client, histogram_bucket, week)
+  if covered is None:
+    #some histograms may not have markers, mark them all so the workers can trust the index too
+    logger.info('Backfilling the coverage index for the week of ' + week)
+    logger.info('Marked %d histograms' % histogram_coverage.backfill(client, histogram_bucket, week))
+    covered = histogram_coverage.covered_tiles(client, histogram_bucket, week)
+  tiles = set()
+  for level, indices in covered.items():
+    if level > int(max_level):
+      continue
+    for index in indices:
+      tile = (level, index)
+      while tile[0] > 0:
+        tile = get_parent(*tile)
+      tiles.add(tile[1])
+  return tiles
+
+def submit_jobs(batch_client, env, week, bbox, max_level, osmlr_version, covered=None):
   job_queue = 'speedtiles-' + env
   job_def = 'speedtiles-' + env
 
@@ -114,6 +126,9 @@ def submit_jobs(batch_client, env, week, bbox, max_level, osmlr_version):
       tile_index = y * 90 + x
       if tile_index > 90 * 45 - 1:
         continue
+      #no point in a job for a tile without any histograms
+      if covered is not None and tile_index not in covered:
+        continue
 
       #submit the job to make the speed tiles for level 0 and level 1
       job_name = '_'.join([week.replace('/', '-'), str(tile_level), str(tile_index)])
@@ -135,9 +150,8 @@ def submit_jobs(batch_client, env, week, bbox, max_level, osmlr_version):
       logger.info('Job %s was submitted and got id %s' % (job_name, parent_id))
 
 def get_osmlr_version(version):
-  session = boto3.session.Session()
-  client = session.client('s3')
-  prefixes, _ = get_prefixes_keys(client, 'osmlr-tiles', [''])
+  client = listing.s3_client()
+  prefixes, _ = listing.get_prefixes_keys(client, 'osmlr-tiles', [''])
   prefixes = filter(re.compile('^v[0-9]+.[0-9]+/$').match, prefixes)
   prefixes = [ p.strip('/') for p in prefixes ]
   version = version.strip('/') if version else version
@@ -158,7 +172,7 @@ if env != 'prod' and env != 'dev':
   logger.error('DATASTORE_ENV environment variable not set! Exiting.')
   sys.exit(1)
 
-client = boto3.client('s3')
+client = listing.s3_client()
 batch_client = boto3.client('batch')
 
 #figure out what time ranges are available
@@ -167,6 +181,9 @@ if week is None:
 
 #send the jobs to batch service
 if week is not None:
-  submit_jobs(batch_client, env, week, bbox, max_level, osmlr_version)
+  #only bother with the tiles that have data
+  covered = get_covered(client, env, week, max_level)
+  logger.info('%d level 0 tiles have data for the week of %s' % (len(covered), week))
+  submit_jobs(batch_client, env, week, bbox, max_level, osmlr_version, covered)
 
 logger.info('Run complete!')
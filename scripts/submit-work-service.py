@@ -5,10 +5,16 @@ import os
 import sys
 import time
 import boto3
+import json
 import logging
 import threading
 import math
 from botocore.exceptions import ClientError
+import listing
+try:
+  from urllib import unquote_plus
+except ImportError:
+  from urllib.parse import unquote_plus
 
 logger = logging.getLogger('make_histograms')
 logger.setLevel(logging.INFO)
@@ -16,76 +22,321 @@ handler = logging.StreamHandler()
 handler.setFormatter(logging.Formatter(fmt='%(asctime)s %(levelname)s %(message)s'))
 logger.addHandler(handler)
 
-def batch_check_queue(batch_client, job_queue):
-  """ check that the job queue is empty before submitting any new work """
+#statuses of jobs that havent finished yet
+ACTIVE_STATUSES = set(['SUBMITTED', 'PENDING', 'RUNNABLE', 'STARTING', 'RUNNING'])
+#how many jobs can be in the queue at once and how many times a time tile is tried before we give up on it
+MAX_IN_FLIGHT = 100
+MAX_ATTEMPTS = 3
+#when listening for events, how often to list the whole bucket anyway to catch whatever the events missed
+RECONCILE_SECONDS = 3600
+STATE_VERSION = 1
 
-  # set default queue status
-  queue_status = 'idle'
+def load_state(state_file):
+  """ what we have submitted and what has failed, from the last run """
+  try:
+    with open(state_file, 'r') as f:
+      state = json.load(f)
+    if state.get('version') == STATE_VERSION:
+      state.setdefault('sizes', {})
+      return state
+    logger.info('Ignoring state %s with unknown version' % state_file)
+  except (IOError, ValueError):
+    logger.warning('No state in %s, nothing new is submitted until whatever is already in the queue finishes' % state_file)
+  #job id -> time tiles of the jobs we are waiting on, time tile -> number of failed jobs it was in and
+  #time tile -> [objects, bytes] it had when it was submitted
+  return {'version': STATE_VERSION, 'jobs': {}, 'failures': {}, 'sizes': {}}
 
-  logger.info('Checking for existing jobs in the queue.')
-  statuses = ['RUNNING', 'RUNNABLE', 'SUBMITTED', 'PENDING', 'STARTING']
+def save_state(state, state_file):
+  directory = os.path.dirname(os.path.abspath(state_file))
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  temp_file = state_file + '.tmp'
+  with open(temp_file, 'w') as f:
+    json.dump(state, f)
+  os.rename(temp_file, state_file)
 
-  for status in statuses:
-    response = batch_client.list_jobs(
-      jobQueue=job_queue,
-      jobStatus=status,
-      maxResults=10
-      )
+def update_state(batch_client, state):
+  """ check on the jobs we are waiting on, forgetting the finished ones and counting up failures
+  gives back the time tiles of the failed jobs with the objects and bytes they had when they were submitted """
+
+  job_ids = sorted(state['jobs'].keys())
+  statuses = {}
+  for i in range(0, len(job_ids), 100):
+    for job in batch_client.describe_jobs(jobs=job_ids[i:i + 100])['jobs']:
+      statuses[job['jobId']] = job['status']
+
+  succeeded = failed = 0
+  retry = {}
+  for job_id in job_ids:
+    status = statuses.get(job_id)
+    if status in ACTIVE_STATUSES:
+      continue
+    prefixes = state['jobs'].pop(job_id)
+    sizes = [tuple(state['sizes'].pop(prefix, (0, 0))) for prefix in prefixes]
+    #its inputs are deleted once its done so there is nothing to remember, if they show up again its new data
+    if status == 'SUCCEEDED':
+      succeeded += 1
+      for prefix in prefixes:
+        state['failures'].pop(prefix, None)
+    #whatever is still there will get picked up again by the next listing
+    else:
+      failed += 1
+      logger.warning('Job %s for %s finished with status %s' % (job_id, ' '.join(prefixes), status))
+      for prefix in prefixes:
+        state['failures'][prefix] = state['failures'].get(prefix, 0) + 1
+      retry.update(zip(prefixes, sizes))
+  logger.info('%d jobs succeeded, %d failed and %d are still in flight' % (succeeded, failed, len(state['jobs'])))
+  return retry
+
+def histogram(tile):
+  """ the hour, level and tile of the histogram a time tile goes into, more than one time tile can go into each """
+  epoch, level, index = tile.strip('/').split('/')
+  return int(epoch.split('_')[0]) // 3600, level, index
 
-    if len(response['jobSummaryList']) > 0:
-      logger.info('Found active jobs in state: ' + status)
-      queue_status = 'processing'
+def in_flight(state):
+  """ the time tiles of the jobs we are waiting on and the histograms they are writing """
+  tiles = set([prefix for prefixes in state['jobs'].values() for prefix in prefixes])
+  return tiles, set([histogram(tile) for tile in tiles])
 
-  return queue_status
+def unknown_jobs(batch_client, job_queue, state):
+  """ ids of unfinished jobs in the queue that we didnt submit, or at least dont remember submitting """
 
-def get_prefixes_keys(client, bucket, prefixes):
-  keys = []
-  pres = []
-  for prefix in prefixes:
+  unknown = []
+  for status in sorted(ACTIVE_STATUSES):
     token = None
     first = True
     while first or token:
       if token:
-        objects = client.list_objects_v2(Bucket=bucket, Delimiter='/', Prefix=prefix, ContinuationToken=token)
+        response = batch_client.list_jobs(jobQueue=job_queue, jobStatus=status, nextToken=token)
       else:
-        objects = client.list_objects_v2(Bucket=bucket, Delimiter='/', Prefix=prefix)
-      if 'Contents' in objects:
-        keys.extend([ o['Key'] for o in objects['Contents'] ])
-      if 'CommonPrefixes' in objects:
-        pres.extend([ o['Prefix'] for o in objects['CommonPrefixes'] ])
-      token = objects.get('NextContinuationToken')
+        response = batch_client.list_jobs(jobQueue=job_queue, jobStatus=status)
+      unknown.extend([job['jobId'] for job in response.get('jobSummaryList', []) if job['jobId'] not in state['jobs']])
+      token = response.get('nextToken')
       first = False
-  return pres, keys
+  return unknown
+
+def forget_failures(tiles, state):
+  """ forget about failures for anything that has gone away, tiles has to be everything in the bucket """
+  for prefix in list(state['failures'].keys()):
+    if prefix not in tiles:
+      del state['failures'][prefix]
+
+def schedule(tiles, state, max_attempts=MAX_ATTEMPTS, listed=True):
+  """ the time tiles we can submit now, skipping any whose histogram is being written or that have failed too often """
+
+  #only one job at a time can write a given histogram, otherwise the last one to finish loses the others data
+  tiles_in_flight, busy = in_flight(state)
+  ready = {}
+  for tile, size in tiles.items():
+    if histogram(tile) in busy:
+      continue
+    if state['failures'].get(tile, 0) >= max_attempts:
+      logger.error('Giving up on %s after %d failed attempts' % (tile, state['failures'][tile]))
+      continue
+    ready[tile] = size
+  if listed:
+    forget_failures(tiles, state)
+  if tiles_in_flight or ready:
+    logger.info('Watermark is at %s' % time.strftime('%Y-%m-%d %H:00', time.gmtime(min([int(p.split('_')[0]) for p in tiles_in_flight | set(ready)]))))
+  return ready
+
+class EventBatcher(object):
+  """ collects object created events for each time tile until it has been quiet for a bit """
+
+  def __init__(self, quiet_seconds):
+    self.quiet_seconds = quiet_seconds
+    #time tile -> [objects, bytes, when we last heard about it]
+    self.tiles = {}
+    self.checked = 0
+    self.reconciled = 0
+
+  def add(self, tile, count, size, now):
+    tile = self.tiles.setdefault(tile, [0, 0, now])
+    tile[0] += count
+    tile[1] += size
+    tile[2] = max(tile[2], now)
+
+  def quiet(self, now):
+    """ takes out the time tiles that havent had anything new for long enough """
+    quiet = dict([(tile, (t[0], t[1])) for tile, t in self.tiles.items() if now - t[2] >= self.quiet_seconds])
+    for tile in quiet:
+      del self.tiles[tile]
+    return quiet
+
+  def update(self, waiting):
+    """ puts back time tiles that we couldnt submit yet, they are ready whenever there is room for them """
+    for tile, (count, size) in waiting.items():
+      self.add(tile, count, size, 0)
+
+def sqs_events(sqs_client, queue_url):
+  """ the keys and sizes of the objects created in each batch of s3 notifications from the queue, forever """
+  while True:
+    messages = sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=20).get('Messages', [])
+    created = []
+    for message in messages:
+      try:
+        body = json.loads(message['Body'])
+        #notifications can come straight from s3 or by way of sns
+        if 'Message' in body:
+          body = json.loads(body['Message'])
+        for record in body.get('Records', []):
+          if record.get('eventName', '').startswith('ObjectCreated'):
+            created.append((unquote_plus(record['s3']['object']['key']), record['s3']['object'].get('size', 0)))
+      except (ValueError, KeyError, TypeError) as e:
+        logger.warning('Ignoring message %s: %s' % (message.get('MessageId'), e))
+    if messages:
+      sqs_client.delete_message_batch(QueueUrl=queue_url,
+        Entries=[{'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']} for i, m in enumerate(messages)])
+    yield created
+
+def directory_events(path, interval=1):
+  """ a stand in for the queue, the keys and sizes of files that showed up under a local copy of the bucket """
+  seen = set()
+  while True:
+    created = []
+    for root, _, files in os.walk(path):
+      for f in files:
+        key = os.path.relpath(os.path.join(root, f), path).replace(os.sep, '/')
+        if key not in seen:
+          seen.add(key)
+          created.append((key, os.path.getsize(os.path.join(root, f))))
+    yield created
+    time.sleep(interval)
+
+def listen(events, batcher, state, batch_client, check_seconds, reconcile_seconds, reconcile, submit):
+  """ feed the events to the batcher and submit time tiles once they go quiet. every so often check on the jobs, putting
+  the time tiles of failed ones back, and list the whole bucket to catch anything the events missed. reconcile gives
+  back everything in the bucket and submit submits some time tiles, giving back the ones that have to wait """
+
+  for created in events:
+    now = time.time()
+    for key, size in created:
+      parts = key.split('/')
+      if len(parts) >= 4:
+        batcher.add('/'.join(parts[:3]) + '/', 1, size, now)
+    if now - batcher.checked >= check_seconds:
+      for tile, (count, size) in update_state(batch_client, state).items():
+        batcher.add(tile, count, size, 0)
+      batcher.checked = now
+    #this is also the only time we know enough to forget failures for data thats gone
+    if now - batcher.reconciled >= reconcile_seconds:
+      tiles = reconcile()
+      forget_failures(tiles, state)
+      busy = in_flight(state)[1]
+      for tile, (count, size) in tiles.items():
+        if histogram(tile) not in busy:
+          batcher.add(tile, count, size, 0)
+      batcher.reconciled = now
+    quiet = batcher.quiet(now)
+    if quiet:
+      batcher.update(submit(quiet))
+
+def submit(tiles, state, batch_client, job_queue, job_def, reporter_bucket, datastore_bucket, state_file, pack_limits,
+    max_in_flight=MAX_IN_FLIGHT, max_attempts=MAX_ATTEMPTS, listed=True):
+  """ submit whatever of the time tiles we can, oldest first, without going over the limit of jobs in flight
+  gives back the ones that are waiting on a job which is already in flight or for room in the queue """
+
+  #jobs we dont know about could be writing any histogram at all, so wait for them to finish
+  unknown = unknown_jobs(batch_client, job_queue, state)
+  if unknown:
+    logger.error('The queue has %d unfinished jobs we dont know about (%s), not submitting anything until they finish' %
+      (len(unknown), ' '.join(unknown[:10])))
+    save_state(state, state_file)
+    return dict(tiles)
+
+  ready = schedule(tiles, state, max_attempts, listed)
+  room = max_in_flight - len(state['jobs'])
+  busy = in_flight(state)[1]
+  waiting = dict([(tile, size) for tile, size in tiles.items() if histogram(tile) in busy])
+  try:
+    if not ready:
+      logger.info('Found no new tiles! Passing on this run.')
+    elif room <= 0:
+      logger.info('Already have %d jobs in flight, waiting for some to finish.' % len(state['jobs']))
+      waiting.update(ready)
+    else:
+      #make new jobs, packing the small time tiles together
+      jobs = pack_tiles(ready, *pack_limits)
+      jobs.sort(key=lambda prefixes: min([int(p.split('_')[0]) for p in prefixes]))
+      logger.info('Packed %d time tiles into %d jobs, submitting %d of them' % (len(ready), len(jobs), min(room, len(jobs))))
+      submit_jobs(jobs[:room], batch_client, job_queue, job_def, reporter_bucket, datastore_bucket, state['jobs'])
+      waiting.update([(tile, ready[tile]) for prefixes in jobs[room:] for tile in prefixes])
+  finally:
+    #even if submitting blew up part way we need to remember what did get submitted, and how big it was so that a
+    #retry is packed the same way
+    state['sizes'].update([(tile, ready[tile]) for prefixes in state['jobs'].values() for tile in prefixes if tile in ready])
+    save_state(state, state_file)
+  return waiting
+
+#tiles this big get a job to themselves, smaller ones are packed into jobs up to these limits
+PACK_MAX_OBJECTS = 2000
+PACK_MAX_BYTES = 256 * 1024 * 1024
+PACK_MAX_PREFIXES = 100
 
 def get_time_tiles(client, bucket):
-  """ check S3 for new data """
+  """ check S3 for new data, gives back how many objects and bytes there are under each time tile """
 
   logger.info('Getting contents of bucket: ' + bucket)
-  hours, _ = get_prefixes_keys(client, bucket, [''])
+  started = time.time()
+  hours, _ = listing.get_prefixes_keys(client, bucket, [''])
   logger.info('Got %d different hours' % len(hours))
-  levels, _ = get_prefixes_keys(client, bucket, hours)
-  logger.info('Got %d different levels of hours' % len(levels))
-  tiles, _ = get_prefixes_keys(client, bucket, levels)
-  logger.info('Got %d different tiles of levels of hours' % len(tiles))
+  #list everything under each hour in one go rather than a level at a time, we want the sizes anyway
+  tiles = {}
+  for key, size in listing.get_keys_sizes(client, bucket, hours):
+    parts = key.split('/')
+    if len(parts) < 4:
+      continue
+    tile = '/'.join(parts[:3]) + '/'
+    count, total = tiles.get(tile, (0, 0))
+    tiles[tile] = (count + 1, total + size)
+  logger.info('Got %d different tiles of levels of hours in %.1fs' % (len(tiles), time.time() - started))
   return tiles
 
-def submit_jobs(tiles, batch_client, job_queue, job_def, reporter_bucket, datastore_bucket):
-  """ loop over the tiles and create jobs """
+def pack_tiles(tiles, max_objects=PACK_MAX_OBJECTS, max_bytes=PACK_MAX_BYTES, max_prefixes=PACK_MAX_PREFIXES):
+  """ group the time tiles into jobs, big ones get a job each and small ones are packed together """
 
-  for tile in tiles:
+  #time tiles that end up in the same histogram have to be done together
+  groups = {}
+  for tile, (count, size) in tiles.items():
+    prefixes, c, s = groups.get(histogram(tile), ([], 0, 0))
+    groups[histogram(tile)] = (prefixes + [tile], c + count, s + size)
+
+  #biggest first so that each pack fills up with the biggest ones that still fit
+  jobs = []
+  pack, objects, total = [], 0, 0
+  for prefixes, count, size in sorted(groups.values(), key=lambda g: (g[2], g[1], g[0]), reverse=True):
+    if count >= max_objects or size >= max_bytes:
+      jobs.append(sorted(prefixes))
+      continue
+    if pack and (objects + count > max_objects or total + size > max_bytes or len(pack) + len(prefixes) > max_prefixes):
+      jobs.append(pack)
+      pack, objects, total = [], 0, 0
+    pack += sorted(prefixes)
+    objects += count
+    total += size
+  if pack:
+    jobs.append(pack)
+  return jobs
+
+def submit_jobs(jobs, batch_client, job_queue, job_def, reporter_bucket, datastore_bucket, submitted):
+  """ loop over the jobs and submit them, each is a list of time tiles, noting the time tiles of each job id as we go """
+
+  for prefixes in jobs:
     # NOTE on resources: these will generally run successfully with
     #   only 128mb specified, but they will fail miserably with only 64mb.
     #   Currently set to 1024mb for safety. Note that the settings here will
     #   override whatever the current setting is in the job definition.
-    logger.info('Submitting a new job: ' + tile)
-    batch_client.submit_job(
-      jobName=tile.replace('/','-'),
+    job_name = prefixes[0].strip('/').replace('/','-')
+    if len(prefixes) > 1:
+      job_name += '-plus-%d' % (len(prefixes) - 1)
+    logger.info('Submitting a new job: %s for %d time tiles' % (job_name, len(prefixes)))
+    response = batch_client.submit_job(
+      jobName=job_name,
       jobQueue=job_queue,
       jobDefinition=job_def,
       parameters={
         's3_reporter_bucket': reporter_bucket,
         's3_datastore_bucket': datastore_bucket,
-        's3_reporter_prefix': tile,
       },
       containerOverrides={
         'memory': 4096,
@@ -97,44 +348,60 @@ def submit_jobs(tiles, batch_client, job_queue, job_def, reporter_bucket, datast
           '--s3-datastore-bucket',
           'Ref::s3_datastore_bucket',
           '--s3-reporter-prefix',
-          'Ref::s3_reporter_prefix',
-        ]
+        ] + prefixes
       }
     )
+    submitted[response['jobId']] = prefixes
+
+if __name__ == "__main__":
+  env = os.getenv('DATASTORE_ENV', 'BOGUS') # required, 'prod' or 'dev'
+  sleep_between_runs = os.getenv('SLEEP_BETWEEN_RUNS', 120) # optional
+  pack_max_objects = int(os.getenv('PACK_MAX_OBJECTS', PACK_MAX_OBJECTS)) # optional
+  pack_max_bytes = int(os.getenv('PACK_MAX_BYTES', PACK_MAX_BYTES)) # optional
+  pack_max_prefixes = int(os.getenv('PACK_MAX_PREFIXES', PACK_MAX_PREFIXES)) # optional
+  max_in_flight = int(os.getenv('MAX_IN_FLIGHT', MAX_IN_FLIGHT)) # optional
+  max_attempts = int(os.getenv('MAX_ATTEMPTS', MAX_ATTEMPTS)) # optional
+  state_file = os.getenv('STATE_FILE', None) # required, somewhere that outlives the container, e.g. on a mounted volume
+  event_queue = os.getenv('EVENT_QUEUE', None) # optional, url of an sqs queue getting the reporter buckets object created notifications
+  event_dir = os.getenv('EVENT_DIR', None) # optional, watch a local directory for new files instead of a queue
+  quiet_seconds = int(os.getenv('QUIET_SECONDS', 60)) # optional, how long a time tile has to go without new data before its submitted
+  reconcile_seconds = int(os.getenv('RECONCILE_SECONDS', RECONCILE_SECONDS)) # optional, how often to list the whole bucket when listening for events
+
+  if env == 'BOGUS':
+    logger.error('DATASTORE_ENV environment variable not set! Exiting.')
+    sys.exit(1)
+  #without the state from the last run we cant tell what the jobs in the queue are writing and have to wait them out
+  elif not state_file:
+    logger.error('STATE_FILE environment variable not set! It has to be on storage that survives a restart. Exiting.')
+    sys.exit(1)
+  else:
+    sleep_between_runs = int(sleep_between_runs)
+    reporter_bucket = 'reporter-drop-' + env
+    datastore_bucket = 'datastore-output-' + env
+    job_queue = 'datastore-' + env
+    job_def = 'datastore-' + env
+
+  s3_resource = boto3.resource('s3')
+  s3_client = listing.s3_client()
+  batch_client = boto3.client('batch')
+
+  #check on what we already submitted
+  state = load_state(state_file)
+  update_state(batch_client, state)
+
+  #submit whatever new data there is, oldest first, without going over the limit of jobs in flight
+  pack_limits = (pack_max_objects, pack_max_bytes, pack_max_prefixes)
+  if event_queue or event_dir:
+    #react to new objects as they show up, the first listing catches up on anything that showed up while we werent listening
+    events = sqs_events(boto3.client('sqs'), event_queue) if event_queue else directory_events(event_dir)
+    listen(events, EventBatcher(quiet_seconds), state, batch_client, sleep_between_runs, reconcile_seconds,
+      lambda: get_time_tiles(s3_client, reporter_bucket),
+      lambda tiles: submit(tiles, state, batch_client, job_queue, job_def, reporter_bucket, datastore_bucket, state_file,
+        pack_limits, max_in_flight, max_attempts, False))
+  else:
+    submit(get_time_tiles(s3_client, reporter_bucket), state, batch_client, job_queue, job_def, reporter_bucket, datastore_bucket,
+      state_file, pack_limits, max_in_flight, max_attempts)
 
-env = os.getenv('DATASTORE_ENV', 'BOGUS') # required, 'prod' or 'dev'
-sleep_between_runs = os.getenv('SLEEP_BETWEEN_RUNS', 120) # optional
-
-if env == 'BOGUS':
-  logger.error('DATASTORE_ENV environment variable not set! Exiting.')
-  sys.exit(1)
-else:
-  sleep_between_runs = int(sleep_between_runs)
-  reporter_bucket = 'reporter-drop-' + env
-  datastore_bucket = 'datastore-output-' + env
-  job_queue = 'datastore-' + env
-  job_def = 'datastore-' + env
-
-s3_resource = boto3.resource('s3')
-s3_client = boto3.client('s3')
-batch_client = boto3.client('batch')
-
-#check if we are still working on stuff
-batch_queue_status = batch_check_queue(batch_client, job_queue)
-if batch_queue_status == 'processing':
   logger.info('Run complete!')
   logger.info('Sleeping before next run...')
   time.sleep(sleep_between_runs)
-else:
-  #check if there is new tile data to work on
-  logger.info('No jobs in the queue.')
-  tiles = get_time_tiles(s3_client, reporter_bucket)
-  if not tiles:
-    logger.info('Found no tiles! Passing on this run.')
-  else:
-    #make new jobs
-    submit_jobs(tiles, batch_client, job_queue, job_def, reporter_bucket, datastore_bucket)
-
-logger.info('Run complete!')
-logger.info('Sleeping before next run...')
-time.sleep(sleep_between_runs)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import time
 import glob
@@ -10,8 +11,12 @@ import logging
 import _thread
 import threading
 import math
+import collections
+import hashlib
 import time
 from botocore.exceptions import ClientError
+import listing
+import histogram_coverage
 
 logger = logging.getLogger('make_histograms')
 logger.setLevel(logging.INFO)
@@ -29,61 +34,148 @@ def parse_prefix(prefix):
   #time_bucket, tile_id, destination key
   return int(epoch / 3600), (int(parts[2]) << 3) | int(parts[1]), dest
 
-def convert(time_bucket, tile_id, dest_key):
-  logger.info('running conversion process')
-  fb_out_file = dest_key.split('/')[-1]
-  
-  # TODO: no idea if the exception handling works
+def convert(jobs):
+  # jobs are (time_bucket, tile_id, output file, input files), they all run in one jvm
+  logger.info('running conversion process for %d jobs' % len(jobs))
+  job_list = ''.join(['\t'.join([str(time_bucket), str(tile_id), fb_out_file] + inputs) + '\n' for time_bucket, tile_id, fb_out_file, inputs in jobs])
+
   try:
-    output = subprocess.check_output(['datastore-histogram-tile-writer', '-b', str(time_bucket), '-t', str(tile_id), '-f', fb_out_file] + glob.glob('*'), timeout=180, universal_newlines=True, stderr=subprocess.STDOUT)
-    for line in output.splitlines():
-      logger.info(line)
-  except subprocess.CalledProcessError as tilewriter:
-    logger.error('Failed running datastore-histogram-tile-writer: ' + str(tilewriter.returncode) + ' ' + str(tilewriter.output))
-    sys.exit(tilewriter.returncode)
+    tilewriter = subprocess.run(['datastore-histogram-tile-writer', '--jobs', '-'], input=job_list, timeout=180 * len(jobs),
+      universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  except subprocess.TimeoutExpired as tilewriter:
+    logger.error('Timed out running datastore-histogram-tile-writer: ' + str(tilewriter.output))
+    sys.exit(1)
+  failed = set()
+  for line in tilewriter.stdout.splitlines():
+    logger.info(line)
+    if line.startswith('FAILED\t'):
+      failed.add(line.split('\t')[1])
+  #the writer exits 2 when some of the jobs failed, anything else means we cant tell which of them worked
+  if tilewriter.returncode not in (0, 2) or (tilewriter.returncode == 2) != bool(failed):
+    logger.error('Failed running datastore-histogram-tile-writer with exit code %d' % tilewriter.returncode)
+    sys.exit(tilewriter.returncode or 1)
+  if failed:
+    logger.error('Failed running datastore-histogram-tile-writer: %d of %d jobs failed' % (len(failed), len(jobs)))
   logger.info('Finished running conversion')
+  # the output files of the jobs that failed
+  return failed
+
+#once a histogram has this many deltas, or they add up to this fraction of its size, they get folded back into it
+MAX_DELTAS = 16
+MAX_DELTA_RATIO = 0.5
+
+def delta_key(dest_key, prefix):
+  # rather than rewriting the histogram each new batch of reporter data becomes a small delta next to it:
+  # year/month/day/hour/tile_level/tile_index.fb.d/epochsecond_epochsecond.epochmillis.fb
+  return dest_key + '.d/' + prefix.split('/')[0] + '.' + str(int(time.time() * 1000)) + '.fb'
+
+def list_histograms(client, s3_datastore_bucket, dest_key):
+  # the size of the histogram if there is one and the sizes of any deltas sitting next to it
+  base = None
+  deltas = {}
+  token = None
+  first = True
+  while first or token:
+    if token:
+      objects = client.list_objects_v2(Bucket=s3_datastore_bucket, Prefix=dest_key, ContinuationToken=token)
+    else:
+      objects = client.list_objects_v2(Bucket=s3_datastore_bucket, Prefix=dest_key)
+    for o in objects.get('Contents', []):
+      if o['Key'] == dest_key:
+        base = o['Size']
+      elif o['Key'].startswith(dest_key + '.d/') and o['Key'].endswith('.fb'):
+        deltas[o['Key']] = o['Size']
+    token = objects.get('NextContinuationToken')
+    first = False
+  return base, deltas
+
+#a compaction says which deltas it folded before it uploads the new histogram, so that if it dies before deleting them
+#readers can tell they are already counted: year/month/day/hour/tile_level/tile_index.fb.d/folded holds the md5 of
+#the histogram they were folded into and then the name of each delta, one per line. it only counts while that is the
+#histogram sitting there, histograms are single part uploads so their etag is their md5
+def folded_key(dest_key):
+  return dest_key + '.d/folded'
 
-def upload(dest_key, s3_datastore_bucket):
+def read_folded(client, s3_datastore_bucket, dest_key):
+  # whether there is a record of a compaction and the deltas the current histogram already has in it
+  try:
+    lines = client.get_object(Bucket=s3_datastore_bucket, Key=folded_key(dest_key))['Body'].read().decode().split()
+    etag = client.head_object(Bucket=s3_datastore_bucket, Key=dest_key).get('ETag', '').strip('"')
+  except ClientError as e:
+    if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+      return False, set()
+    raise
+  if not lines or lines[0] != etag:
+    return True, set()
+  return True, set([dest_key + '.d/' + name for name in lines[1:]])
+
+def record_folded(file_name, dest_key, folded, s3_datastore_bucket):
+  with open(file_name, 'rb') as f:
+    digest = hashlib.md5(f.read()).hexdigest()
+  body = '\n'.join([digest] + [key.rsplit('/', 1)[-1] for key in folded]) + '\n'
+  logger.info('Recording %d deltas folded into %s' % (len(folded), dest_key))
+  boto3.client('s3').put_object(Bucket=s3_datastore_bucket, ContentType='text/plain', Body=body.encode(), Key=folded_key(dest_key))
+
+def should_compact(base, deltas, max_deltas=MAX_DELTAS, max_ratio=MAX_DELTA_RATIO):
+  # deltas includes the one we are about to write
+  return len(deltas) >= max_deltas or sum(deltas.values()) >= base * max_ratio
+
+def upload(file_name, dest_key, s3_datastore_bucket):
   s3_client = boto3.client('s3')
-  with open(dest_key.split('/')[-1], 'rb') as data:
-    
+  with open(file_name, 'rb') as data:
+
     logger.info('Uploading to ' + s3_datastore_bucket + ' ' + dest_key)
     s3_client.put_object(Bucket=s3_datastore_bucket, ContentType='binary/octet-stream', Body=data, Key=dest_key)
 
+#the most keys a single multi object delete can take
+DELETE_BATCH_SIZE = 1000
+
+def delete_batch(s3_client, keys, s3_reporter_bucket):
+  #ask for the verbose result so we hear about every key, anything not reported as deleted gets retried
+  response = s3_client.delete_objects(Bucket=s3_reporter_bucket, Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': False})
+  deleted = set([d['Key'] for d in response.get('Deleted', [])])
+  for error in response.get('Errors', []):
+    logger.error('Failed to delete ' + error['Key'] + ': ' + str(error.get('Code')) + ' ' + str(error.get('Message')))
+  return [key for key in keys if key not in deleted]
+
 def delete_keys(keys, s3_reporter_bucket):
   s3_client = boto3.client('s3')
-  for key in keys:
+  for start in range(0, len(keys), DELETE_BATCH_SIZE):
+    batch = keys[start:start + DELETE_BATCH_SIZE]
     secs = 1
     while True:
       try:
-        s3_client.delete_object(Bucket=s3_reporter_bucket, Key=key)
-        s3_client.head_object(Bucket=s3_reporter_bucket, Key=key)
+        failed = delete_batch(s3_client, batch, s3_reporter_bucket)
       except Exception as e:
-        if e.response['ResponseMetadata']['HTTPStatusCode'] == 404:
-          break
-        logger.error('Failed to delete ' + key + ': ' + str(d))
-        logger.info('Sleeping %d seconds until next try' % secs)
-        time.sleep(secs)
-        secs *= 2
-    logger.info('Deleted from ' + s3_reporter_bucket + ' ' + key)
+        logger.error('Failed to delete batch of %d keys: %s' % (len(batch), str(e)))
+        failed = batch
+      logger.info('Deleted %d keys from %s' % (len(batch) - len(failed), s3_reporter_bucket))
+      if not failed:
+        break
+      batch = failed
+      logger.info('Sleeping %d seconds until retrying %d keys' % (secs, len(batch)))
+      time.sleep(secs)
+      secs = min(secs * 2, 64)
 
 def delete(keys, s3_reporter_bucket):
-  # delete the files
-  chunks = split(keys, 10)
+  # delete the files a batch per thread
+  chunks = [keys[i:i + DELETE_BATCH_SIZE] for i in range(0, len(keys), DELETE_BATCH_SIZE)]
+  if not chunks:
+    return
   threads = []
-  for chunk in chunks:
-    threads.append(threading.Thread(target=delete_keys, args=(chunk, s3_reporter_bucket)))
+  for chunk in split(chunks, min(len(chunks), 10)):
+    threads.append(threading.Thread(target=delete_keys, args=([key for c in chunk for key in c], s3_reporter_bucket)))
     threads[-1].start()
   for t in threads:
     t.join()
 
-def get_files(keys, s3_reporter_bucket, s3_datastore_bucket, more):
+def get_files(keys, s3_reporter_bucket, s3_datastore_bucket, directory, more):
   session = boto3.session.Session()
   s3_resource = session.resource('s3')
   for key in keys:
     if not more.is_set():
       break
-    object_id = key.rsplit('/', 1)[-1]
+    object_id = os.path.join(directory, key.rsplit('/', 1)[-1])
     secs = 0
     for retry in range(0, 5):
       time.sleep(secs)
@@ -116,35 +208,17 @@ def split(l, n):
     pos = end
   return result
 
-def get_prefixes_keys(client, bucket, prefixes):
-  keys = []
-  pres = []
-  for prefix in prefixes:
-    token = None
-    first = True
-    while first or token:
-      if token:
-        objects = client.list_objects_v2(Bucket=bucket, Delimiter='/', Prefix=prefix, ContinuationToken=token)
-      else:
-        objects = client.list_objects_v2(Bucket=bucket, Delimiter='/', Prefix=prefix)
-      if 'Contents' in objects:
-        keys.extend([ o['Key'] for o in objects['Contents'] ])
-      if 'CommonPrefixes' in objects:
-        pres.extend([ o['Prefix'] for o in objects['CommonPrefixes'] ])
-      token = objects.get('NextContinuationToken')
-      first = False
-  return pres, keys
-
-def download_data(prefix, s3_reporter_bucket, s3_datastore_bucket, dest_key):
-  client = boto3.client('s3')
+def download_data(prefixes, s3_reporter_bucket, s3_datastore_bucket, histogram_keys, directory):
+  client = listing.s3_client()
 
   # get the keys for the files in this tile
-  _, keys = get_prefixes_keys(client, s3_reporter_bucket, [prefix])
+  _, keys = listing.get_prefixes_keys(client, s3_reporter_bucket, prefixes)
   if not keys:
     return []
- 
-  # add the key for the existing file
-  keys.append(dest_key)
+  reporter_keys = len(keys)
+
+  # add the keys for any existing histograms we need to fold in
+  keys.extend(histogram_keys)
 
   # download the files
   chunks = split(keys, 10)
@@ -153,7 +227,7 @@ def download_data(prefix, s3_reporter_bucket, s3_datastore_bucket, dest_key):
   more.set()
   try:
     for chunk in chunks:
-      threads.append(threading.Thread(target=get_files, args=(chunk, s3_reporter_bucket, s3_datastore_bucket, more)))
+      threads.append(threading.Thread(target=get_files, args=(chunk, s3_reporter_bucket, s3_datastore_bucket, directory, more)))
       threads[-1].start()
   except KeyboardInterrupt:
     more.clear()
@@ -162,37 +236,117 @@ def download_data(prefix, s3_reporter_bucket, s3_datastore_bucket, dest_key):
     for t in threads:
       t.join()
 
-  return keys[:-1]
+  return keys[:reporter_keys]
+
+def group_prefixes(prefixes):
+  # reporter prefixes that land in the same histogram have to be converted together
+  units = collections.OrderedDict()
+  for prefix in prefixes:
+    time_bucket, tile_id, dest_key = parse_prefix(prefix)
+    units.setdefault(dest_key, (time_bucket, tile_id, []))[2].append(prefix)
+  return units
+
+def plan(client, dest_key, prefixes, s3_datastore_bucket, max_deltas, max_delta_ratio):
+  #the first data for a tile hour becomes the histogram, after that its a delta unless its time to compact
+  base, deltas = list_histograms(client, s3_datastore_bucket, dest_key)
+  if base is not None:
+    recorded, stale = read_folded(client, s3_datastore_bucket, dest_key)
+    if recorded:
+      #an earlier compaction died before cleaning up, whatever it folded in must not be counted or folded again
+      stale = sorted([k for k in stale if k in deltas])
+      logger.warning('Removing %d deltas already folded into %s' % (len(stale), dest_key))
+      for k in stale:
+        del deltas[k]
+      delete(stale, s3_datastore_bucket)
+      delete([folded_key(dest_key)], s3_datastore_bucket)
+  out_key = delta_key(dest_key, prefixes[0])
+  folded = []
+  if base is None:
+    out_key = dest_key
+  elif should_compact(base, dict(deltas, **{out_key: 0}), max_deltas, max_delta_ratio):
+    logger.info('Compacting %d deltas totalling %d bytes into %s' % (len(deltas), sum(deltas.values()), dest_key))
+    folded = sorted(deltas.keys())
+    out_key = dest_key
+  histogram_keys = [dest_key] + folded if out_key == dest_key and base is not None else []
+  return out_key, folded, histogram_keys
+
+def run(prefixes, s3_reporter_bucket, s3_datastore_bucket, max_deltas=MAX_DELTAS, max_delta_ratio=MAX_DELTA_RATIO):
+  # each histogram gets its own directory to download into, then they all convert in one go
+  client = listing.s3_client()
+  jobs = []
+  finished = []
+  for dest_key, (time_bucket, tile_id, unit_prefixes) in group_prefixes(prefixes).items():
+    directory = dest_key.replace('/', '_')
+    os.makedirs(directory, exist_ok=True)
+    out_key, folded, histogram_keys = plan(client, dest_key, unit_prefixes, s3_datastore_bucket, max_deltas, max_delta_ratio)
+
+    #go download all the tiles
+    keys = download_data(unit_prefixes, s3_reporter_bucket, s3_datastore_bucket, histogram_keys, directory)
+    if not keys:
+      logger.warning('Nothing found under ' + ', '.join(unit_prefixes))
+      continue
+
+    #these are known to exist so if we dont have them we would be throwing data away
+    missing = [k for k in histogram_keys if not os.path.isfile(os.path.join(directory, k.rsplit('/', 1)[-1]))]
+    if missing:
+      logger.error('Failed to download existing histograms: ' + ', '.join(missing))
+      sys.exit(1)
+
+    out_file = os.path.join(directory, out_key.split('/')[-1])
+    jobs.append((time_bucket, tile_id, out_file, sorted(glob.glob(os.path.join(directory, '*')))))
+    finished.append((time_bucket, tile_id, out_file, out_key, folded, keys))
+
+  #an earlier job got here first, which is fine, there is just nothing to do
+  if not jobs:
+    logger.warning('Prefix was empty!')
+    return
+
+  #turn the downloaded files into histograms
+  failed = convert(jobs)
+
+  for time_bucket, tile_id, out_file, out_key, folded, keys in finished:
+    #an existing histogram or delta that couldnt be read means the output is missing data, so leave everything as it
+    #was, the deltas and the record in particular, rather than lose it
+    if out_file in failed:
+      logger.error('Not uploading %s or removing anything that went into it' % out_key)
+      continue
+
+    #say what went into the new histogram before it goes up, until it does the record doesnt match anything
+    if folded:
+      record_folded(out_file, out_key, folded, s3_datastore_bucket)
+
+    #upload the finished product
+    upload(out_file, out_key, s3_datastore_bucket)
+
+    #let the speed tile jobs know this tile has data for this hour, only once the histogram is there to be read
+    histogram_coverage.mark(client, s3_datastore_bucket, time_bucket * 3600, tile_id & 7, tile_id >> 3)
+
+    #the deltas are in the histogram now, once they are gone so is the need for the record
+    delete(folded, s3_datastore_bucket)
+    if folded:
+      delete([folded_key(out_key)], s3_datastore_bucket)
+
+    #delete the input data
+    delete(keys, s3_reporter_bucket)
+
+  #the rest is done, the failed ones are still there for a retry to pick up
+  if failed:
+    sys.exit(1)
 
 if __name__ == "__main__":
   # build args
   parser = argparse.ArgumentParser()
   parser.add_argument('--s3-reporter-bucket', type=str, help='Bucket (e.g. reporter-work-prod) in which the data we wish to process is located')
   parser.add_argument('--s3-datastore-bucket', type=str, help='Bucket (e.g. datastore-output-prod) into which we will place transformed data')
-  parser.add_argument('--s3-reporter-prefix', type=str, help='S3 prefix under which tiles will be found, should look like epochsecond_epochsecond/level/tile_index')
+  parser.add_argument('--s3-reporter-prefix', type=str, nargs='+', help='S3 prefixes under which tiles will be found, should look like epochsecond_epochsecond/level/tile_index')
+  parser.add_argument('--max-deltas', type=int, help='How many deltas a histogram can have before they are folded back into it', default=MAX_DELTAS)
+  parser.add_argument('--max-delta-ratio', type=float, help='How big the deltas can get as a fraction of the histogram before they are folded back into it', default=MAX_DELTA_RATIO)
   args = parser.parse_args()
 
   logger.info('reporter input bucket: ' + args.s3_reporter_bucket)
   logger.info('datastore output bucket: ' + args.s3_datastore_bucket)
-  logger.info('reporter prefix: ' + str(args.s3_reporter_prefix))
-
-  #where will this thing end up
-  time_bucket, tile_id, dest_key = parse_prefix(args.s3_reporter_prefix)
-
-  #go download all the tiles
-  keys = download_data(args.s3_reporter_prefix, args.s3_reporter_bucket, args.s3_datastore_bucket, dest_key)
-
-  if not keys:
-    logger.error('Prefix was empty!')
-    sys.exit(1)
-
-  #turn the downloaded files into
-  convert(time_bucket, tile_id, dest_key)
-
-  #upload the finished product
-  upload(dest_key, args.s3_datastore_bucket)
+  logger.info('reporter prefixes: ' + ' '.join(args.s3_reporter_prefix))
 
-  #delete the input data
-  delete(keys, args.s3_reporter_bucket)
+  run(args.s3_reporter_prefix, args.s3_reporter_bucket, args.s3_datastore_bucket, args.max_deltas, args.max_delta_ratio)
 
   logger.info('run complete')
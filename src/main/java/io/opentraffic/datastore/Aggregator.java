@@ -0,0 +1,110 @@
+package io.opentraffic.datastore;
+
+import java.util.ArrayList;
+import java.util.Comparator;
+import java.util.Iterator;
+import java.util.PriorityQueue;
+import java.util.TreeMap;
+
+/**
+ * Folds measurements together as they arrive so that memory follows the number of distinct (segment, next segment,
+ * duration bucket) keys rather than the number of rows read. Unsorted input is combined into a single sorted run on
+ * the fly, input which is already sorted (an existing histogram for example) is kept as its own run and all of the
+ * runs are merged k-way at the end.
+ */
+public class Aggregator {
+
+  // measurements that are equal under this end up as the same entry in the histogram
+  public static final Comparator<Measurement> KEY = new Comparator<Measurement>() {
+    @Override
+    public int compare(Measurement a, Measurement b) {
+      int cmp = Long.compare(a.segmentId, b.segmentId);
+      if (cmp != 0) return cmp;
+      cmp = Long.compare(a.nextSegmentId, b.nextSegmentId);
+      if (cmp != 0) return cmp;
+      return Integer.compare(DurationBucket.unquantise(DurationBucket.quantise(a.duration)),
+          DurationBucket.unquantise(DurationBucket.quantise(b.duration)));
+    }
+  };
+
+  private final TreeMap<Measurement, Measurement> combined = new TreeMap<Measurement, Measurement>(KEY);
+  private final ArrayList<Iterator<Measurement>> runs = new ArrayList<Iterator<Measurement>>();
+
+  /**
+   * Combines the measurement with any we already have under the same key.
+   */
+  public void add(Measurement measurement) {
+    Measurement existing = combined.get(measurement);
+    if (existing == null)
+      combined.put(measurement, measurement);
+    else
+      existing.combine(measurement);
+  }
+
+  /**
+   * Adds a run of measurements which must already be sorted by KEY, nothing is read from it until merge.
+   */
+  public void addRun(Iterator<Measurement> run) {
+    runs.add(run);
+  }
+
+  /**
+   * @return the number of distinct keys held in memory so far, not counting the sorted runs
+   */
+  public int size() {
+    return combined.size();
+  }
+
+  /**
+   * Merges every run into one list sorted by KEY with a single measurement per key.
+   */
+  public ArrayList<Measurement> merge() {
+    PriorityQueue<Head> heads = new PriorityQueue<Head>();
+    if (!combined.isEmpty())
+      heads.add(new Head(combined.values().iterator()));
+    for (Iterator<Measurement> run : runs)
+      if (run.hasNext())
+        heads.add(new Head(run));
+
+    ArrayList<Measurement> measurements = new ArrayList<Measurement>();
+    Measurement last = null;
+    while (!heads.isEmpty()) {
+      Head head = heads.poll();
+      Measurement m = head.current;
+      if (last != null && KEY.compare(last, m) == 0)
+        last.combine(m);
+      else {
+        measurements.add(m);
+        last = m;
+      }
+      if (head.advance())
+        heads.add(head);
+    }
+    combined.clear();
+    runs.clear();
+    return measurements;
+  }
+
+  // the next measurement of a run and the rest of it
+  private static class Head implements Comparable<Head> {
+    private final Iterator<Measurement> run;
+    private Measurement current;
+
+    Head(Iterator<Measurement> run) {
+      this.run = run;
+      this.current = run.next();
+    }
+
+    boolean advance() {
+      if (!run.hasNext())
+        return false;
+      current = run.next();
+      return true;
+    }
+
+    @Override
+    public int compareTo(Head o) {
+      return KEY.compare(current, o.current);
+    }
+  }
+}
@@ -1,11 +1,22 @@
 package io.opentraffic.datastore;
 
+import java.io.BufferedReader;
 import java.io.File;
 import java.io.FileOutputStream;
 import java.io.IOException;
+import java.io.InputStreamReader;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Paths;
 import java.util.ArrayList;
-import java.util.Collections;
+import java.util.Arrays;
 import java.util.List;
+import java.util.concurrent.Callable;
+import java.util.concurrent.ConcurrentLinkedQueue;
+import java.util.concurrent.ExecutionException;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+import java.util.concurrent.Future;
 
 import org.apache.commons.cli.CommandLine;
 import org.apache.commons.cli.CommandLineParser;
@@ -19,6 +30,7 @@ import org.apache.log4j.Logger;
 import io.opentraffic.datastore.sink.FlatBufferSink;
 import io.opentraffic.datastore.sink.ORCSink;
 import io.opentraffic.datastore.sink.PrintSink;
+import io.opentraffic.datastore.source.ColumnarSource;
 import io.opentraffic.datastore.source.FlatBufferSource;
 import io.opentraffic.datastore.source.MeasurementSource;
 import io.opentraffic.datastore.source.Source;
@@ -44,6 +56,15 @@ public class Main {
       help.printHelp("datastore-histogram-tile-writer", options);
       System.exit(1);
     }
+
+    // a whole list of jobs to do in this one jvm
+    if (cmd.hasOption("jobs")) {
+      if (runJobs(cmd, cmd.getOptionValue("jobs")) > 0) {
+        System.exit(2);
+      }
+      return;
+    }
+
     List<String> fileNames = cmd.getArgList();
     if (fileNames.isEmpty()) {
       throw new RuntimeException("No file names provided");
@@ -51,34 +72,121 @@ public class Main {
     if (!cmd.hasOption("output-flatbuffers") && !cmd.hasOption("output-orc") && !cmd.hasOption("verbose")) {
       throw new RuntimeException("No data sinks provided, so nothing to do!");
     }
+    if (!cmd.hasOption("time-bucket") || !cmd.hasOption("tile")) {
+      throw new RuntimeException("No time bucket or tile provided");
+    }
     TimeBucket timeBucket = new TimeBucket(BucketSize.HOURLY, Long.parseLong(cmd.getOptionValue("time-bucket")));
     long tileId = Long.parseLong(cmd.getOptionValue("tile"));
+    run(cmd, timeBucket, tileId, fileNames, cmd.getOptionValue("output-flatbuffers"), cmd.getOptionValue("output-orc"),
+        cmd.hasOption("verbose"));
+  }
 
-    // parse all the input into measurement buckets
-    ArrayList<Measurement> measurements = new ArrayList<Measurement>();
+  /**
+   * Runs each job in the list, one per line, until the list runs out. A job is tab separated: the time bucket, the tile,
+   * the flatbuffer file to write (and merge with if it exists) and then every input file. Blank lines and lines starting
+   * with # are skipped. Once a job is finished a line starting with OK or FAILED followed by the output file is written
+   * to stdout so that whoever is feeding us jobs can keep track.
+   *
+   * @return the number of jobs that failed
+   */
+  public static int runJobs(CommandLine cmd, String jobs) throws IOException {
+    int failed = 0;
+    try (BufferedReader reader = jobs.equals("-") ?
+        new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8)) :
+        Files.newBufferedReader(Paths.get(jobs), StandardCharsets.UTF_8)) {
+      String line;
+      while ((line = reader.readLine()) != null) {
+        if (line.trim().isEmpty() || line.startsWith("#"))
+          continue;
+        String[] job = line.split("\t");
+        long start = System.currentTimeMillis();
+        try {
+          if (job.length < 4) {
+            throw new IllegalArgumentException("Expected a time bucket, tile, output and at least one input");
+          }
+          TimeBucket timeBucket = new TimeBucket(BucketSize.HOURLY, Long.parseLong(job[0]));
+          long tileId = Long.parseLong(job[1]);
+          int count = run(cmd, timeBucket, tileId, Arrays.asList(job).subList(3, job.length), job[2], null, false);
+          System.out.println("OK\t" + job[2] + "\t" + count + "\t" + (System.currentTimeMillis() - start));
+        } catch (Exception e) {
+          failed++;
+          logger.error("Failed job: " + line + " - " + e.getMessage());
+          System.out.println("FAILED\t" + (job.length > 2 ? job[2] : line) + "\t" + e.getMessage());
+        }
+        System.out.flush();
+      }
+    }
+    return failed;
+  }
+
+  /**
+   * Folds all the input files into one histogram and writes it to whichever sinks are given.
+   *
+   * @return the number of measurements written
+   */
+  public static int run(final CommandLine cmd, final TimeBucket timeBucket, final long tileId, List<String> fileNames,
+      String fbFile, String orcFile, boolean verbose) {
+    // sorted sources are merged in at the end as they are, the rest are parsed concurrently with each thread folding
+    // what it reads into its own buckets
+    Aggregator aggregator = new Aggregator();
+    ArrayList<Source> runs = new ArrayList<Source>();
+    final ConcurrentLinkedQueue<String> unsorted = new ConcurrentLinkedQueue<String>();
     for (String fileName : fileNames) {
-      try {
-        File file = new File(fileName);
-        Source source = fileName.endsWith(".fb") ? 
-            new FlatBufferSource(file, timeBucket, tileId) :
-            new MeasurementSource(cmd, file, timeBucket, tileId);
-        //get the measurements
-        int size = measurements.size();
-        for (Measurement measurement : source)
-          measurements.add(measurement);
-        logger.info("Added " + (measurements.size() - size) + " from " + fileName);
-        source.close();
-      }// failed for some other reason
-      catch (Exception e) {      
-        logger.error("Failed to parse measurements from file: " + fileName + " - " + e.getMessage());
+      if (!fileName.endsWith(".fb")) {
+        unsorted.add(fileName);
+        continue;
+      }
+      // an existing histogram or one of its deltas that cant be read fails the whole job, writing the output without it
+      // would lose its data for good once the deltas are cleaned up or the histogram is overwritten
+      for (File file : FlatBufferSource.withDeltas(new File(fileName))) {
+        try {
+          Source source = new FlatBufferSource(file, timeBucket, tileId);
+          aggregator.addRun(source.iterator());
+          runs.add(source);
+          logger.info("Added a sorted run from " + file);
+        } catch (Exception e) {
+          for (Source run : runs)
+            closeQuietly(run);
+          throw new RuntimeException("Failed to read histogram " + file, e);
+        }
       }
     }
-    //TODO: sort them
-    Collections.sort(measurements);
+
+    int parsing = unsorted.size();
+    int threads = Math.max(1, Math.min(parsing,
+        Integer.parseInt(cmd.getOptionValue("parse-threads", Integer.toString(Runtime.getRuntime().availableProcessors())))));
+    long start = System.currentTimeMillis();
+    ExecutorService pool = Executors.newFixedThreadPool(threads);
+    ArrayList<Future<Aggregator>> parsed = new ArrayList<Future<Aggregator>>();
+    for (int i = 0; i < threads; i++) {
+      parsed.add(pool.submit(new Callable<Aggregator>() {
+        @Override
+        public Aggregator call() {
+          Aggregator buckets = new Aggregator();
+          String fileName;
+          while ((fileName = unsorted.poll()) != null)
+            parse(cmd, timeBucket, tileId, fileName, buckets);
+          return buckets;
+        }
+      }));
+    }
+    pool.shutdown();
+    try {
+      for (Future<Aggregator> buckets : parsed)
+        aggregator.addRun(buckets.get().merge().iterator());
+    } catch (InterruptedException | ExecutionException e) {
+      pool.shutdownNow();
+      throw new RuntimeException("Failed to parse measurements", e);
+    }
+    logger.info("Parsed " + parsing + " files on " + threads + " threads in "
+        + (System.currentTimeMillis() - start) + "ms");
+
+    ArrayList<Measurement> measurements = aggregator.merge();
+    for (Source run : runs)
+      closeQuietly(run);
     logger.info("Total measurements " + measurements.size());
 
     // flatbuffer
-    final String fbFile = cmd.getOptionValue("output-flatbuffers");
     if (fbFile != null) {
       try {
         File f = new File(fbFile);
@@ -90,7 +198,6 @@ public class Main {
     }
 
     // orc
-    final String orcFile = cmd.getOptionValue("output-orc");
     if (orcFile != null) {
       try {
         File f = new File(orcFile);
@@ -102,16 +209,52 @@ public class Main {
     }
 
     // stdout
-    if (cmd.hasOption("verbose")) {
+    if (verbose) {
       PrintSink.write(measurements);
     }
+    return measurements.size();
+  }
+
+  /**
+   * Folds the measurements in one unsorted file, columnar or otherwise csv, into the buckets, logging how long it took.
+   */
+  private static void parse(CommandLine cmd, TimeBucket timeBucket, long tileId, String fileName, Aggregator buckets) {
+    long start = System.currentTimeMillis();
+    Source source = null;
+    try {
+      source = fileName.endsWith(ColumnarSource.EXTENSION) ?
+          new ColumnarSource(new File(fileName), timeBucket, tileId) :
+          new MeasurementSource(cmd, new File(fileName), timeBucket, tileId);
+      //get the measurements
+      int count = 0;
+      for (Measurement measurement : source) {
+        buckets.add(measurement);
+        count++;
+      }
+      logger.info("Added " + count + " from " + fileName + " in " + (System.currentTimeMillis() - start) + "ms, "
+          + buckets.size() + " distinct so far on this thread");
+    }// failed for some other reason
+    catch (Exception e) {
+      logger.error("Failed to parse measurements from file: " + fileName + " - " + e.getMessage());
+    }
+    closeQuietly(source);
+  }
+
+  private static void closeQuietly(Source source) {
+    if (source == null)
+      return;
+    try {
+      source.close();
+    } catch (IOException e) {
+      logger.warn("Failed to close source - " + e.getMessage());
+    }
   }
 
   public static Options createOptions() {
     Options options = new Options();
-    options.addOption(Option.builder("b").longOpt("time-bucket").hasArg().required(true).type(Long.class)
+    options.addOption(Option.builder("b").longOpt("time-bucket").hasArg().required(false).type(Long.class)
         .desc("The timebucket to target when creating this tile. This is which sequential hour starting from the epoch").build());
-    options.addOption(Option.builder("t").longOpt("tile").hasArg().required(true).type(Long.class)
+    options.addOption(Option.builder("t").longOpt("tile").hasArg().required(false).type(Long.class)
         .desc("The tile and level to target when creating this tile. Note that the level is the first 3 bits followed by the tile "
             + "index which is the next 22 bits").build());
     
@@ -121,6 +264,12 @@ public class Main {
     options.addOption(Option.builder("o").longOpt("output-orc").hasArg().required(false)
         .desc("If present, the location to output an ORC file to. "
             + "If the file already exists it will merged with into the rest of the output").build());
+    options.addOption(Option.builder("j").longOpt("jobs").hasArg().required(false)
+        .desc("If present, a file (or - for stdin) listing one job per line to run in this process instead of the "
+            + "single job described by the other options. Each job is the tab separated time bucket, tile, flatbuffer "
+            + "output file and input files").build());
+    options.addOption(Option.builder("p").longOpt("parse-threads").hasArg().required(false).type(Integer.class)
+        .desc("How many threads to parse input files on. Defaults to the number of processors").build());
     options.addOption(Option.builder("v").longOpt("verbose").required(false)
         .desc("If present, the textual representation of the histogram will be written to stdout.").build());
 
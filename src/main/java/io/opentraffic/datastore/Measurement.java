@@ -53,7 +53,7 @@ public final class Measurement implements Comparable<Measurement> {
   public void combine(Measurement m) {
     double a = count / (double)(count + m.count);
     double b = m.count / (double)(count + m.count);
-    queue = (int)Math.round(queue * a + m.queue * b);
+    queue = (float)(queue * a + m.queue * b);
     duration = (int)Math.round(duration * a + m.duration * b);
     count += m.count;
     if(m.source != null) {
@@ -0,0 +1,171 @@
+package io.opentraffic.datastore.source;
+
+import java.io.BufferedInputStream;
+import java.io.DataInputStream;
+import java.io.EOFException;
+import java.io.File;
+import java.io.FileInputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.nio.ByteBuffer;
+import java.nio.charset.StandardCharsets;
+import java.util.Iterator;
+import java.util.NoSuchElementException;
+import java.util.zip.GZIPInputStream;
+
+import io.opentraffic.datastore.Measurement;
+import io.opentraffic.datastore.TimeBucket;
+import io.opentraffic.datastore.VehicleType;
+
+/**
+ * Reads reporter output in the columnar format written by scripts/csv_to_columns.py. The file is gzipped and starts
+ * with the magic bytes OTCL and a version, followed by blocks of rows until the end of the file. All numbers are big
+ * endian. Each block is:
+ *
+ * <pre>
+ * int rows, int bytes (the length of the rest of the block)
+ * int sources, then for each source: int length, utf-8 bytes
+ * long[rows] segment id, long[rows] next segment id
+ * int[rows] duration, int[rows] count, int[rows] length, int[rows] queue length
+ * long[rows] min timestamp, long[rows] max timestamp
+ * int[rows] source index (-1 for none), byte[rows] vehicle type
+ * </pre>
+ *
+ * Every column of a block comes out of a single bulk read, so there is no per row text parsing.
+ */
+public class ColumnarSource extends Source {
+  public static final String EXTENSION = ".col";
+  public static final byte[] MAGIC = "OTCL".getBytes(StandardCharsets.US_ASCII);
+  public static final int VERSION = 1;
+
+  private final TimeBucket bucket;
+  private final long tile;
+  private final DataInputStream input;
+
+  public ColumnarSource(File file, TimeBucket timeBucket, long tileId) throws IOException {
+    this(new FileInputStream(file), timeBucket, tileId);
+  }
+
+  public ColumnarSource(InputStream stream, TimeBucket timeBucket, long tileId) throws IOException {
+    bucket = timeBucket;
+    tile = tileId;
+    input = new DataInputStream(new BufferedInputStream(new GZIPInputStream(stream, 65536)));
+    byte[] magic = new byte[MAGIC.length];
+    input.readFully(magic);
+    for (int i = 0; i < MAGIC.length; i++)
+      if (magic[i] != MAGIC[i])
+        throw new IOException("Not a columnar measurement file");
+    int version = input.readInt();
+    if (version != VERSION)
+      throw new IOException("Unsupported columnar measurement file version " + version);
+  }
+
+  @Override
+  public void close() throws IOException {
+    input.close();
+  }
+
+  @Override
+  public Iterator<Measurement> iterator() {
+    return new Iterator<Measurement>() {
+      private Block block = null;
+      private int row = 0;
+      private Measurement nextObject = findNext();
+
+      @Override
+      public boolean hasNext() {
+        return nextObject != null;
+      }
+
+      @Override
+      public Measurement next() {
+        if (nextObject == null)
+          throw new NoSuchElementException();
+        Measurement m = nextObject;
+        nextObject = findNext();
+        return m;
+      }
+
+      private Measurement findNext() {
+        while (true) {
+          //go get another block when this one is used up
+          while (block == null || row == block.rows) {
+            block = readBlock();
+            row = 0;
+            if (block == null)
+              return null;
+          }
+          Measurement m = block.get(row++);
+          if (m.intersects(tile, bucket))
+            return m;
+        }
+      }
+    };
+  }
+
+  private Block readBlock() {
+    try {
+      int rows;
+      try {
+        rows = input.readInt();
+      } catch (EOFException e) {
+        return null;
+      }
+      byte[] bytes = new byte[input.readInt()];
+      input.readFully(bytes);
+      return new Block(rows, ByteBuffer.wrap(bytes));
+    } catch (IOException e) {
+      throw new RuntimeException("Failed to read columnar measurements", e);
+    }
+  }
+
+  // one block worth of columns
+  private static class Block {
+    final int rows;
+    final String[] sources;
+    final long[] segmentIds, nextSegmentIds, minTimestamps, maxTimestamps;
+    final int[] durations, counts, lengths, queueLengths, sourceIndices;
+    final byte[] vehicleTypes;
+
+    Block(int rows, ByteBuffer buffer) {
+      this.rows = rows;
+      sources = new String[buffer.getInt()];
+      for (int i = 0; i < sources.length; i++) {
+        byte[] source = new byte[buffer.getInt()];
+        buffer.get(source);
+        sources[i] = new String(source, StandardCharsets.UTF_8);
+      }
+      segmentIds = longs(buffer, rows);
+      nextSegmentIds = longs(buffer, rows);
+      durations = ints(buffer, rows);
+      counts = ints(buffer, rows);
+      lengths = ints(buffer, rows);
+      queueLengths = ints(buffer, rows);
+      minTimestamps = longs(buffer, rows);
+      maxTimestamps = longs(buffer, rows);
+      sourceIndices = ints(buffer, rows);
+      vehicleTypes = new byte[rows];
+      buffer.get(vehicleTypes);
+    }
+
+    Measurement get(int i) {
+      return new Measurement(VehicleType.values()[vehicleTypes[i]], segmentIds[i], nextSegmentIds[i], lengths[i],
+          queueLengths[i], durations[i], counts[i], sourceIndices[i] < 0 ? null : sources[sourceIndices[i]],
+          minTimestamps[i], maxTimestamps[i]);
+    }
+
+    private static long[] longs(ByteBuffer buffer, int rows) {
+      long[] column = new long[rows];
+      buffer.asLongBuffer().get(column);
+      buffer.position(buffer.position() + rows * 8);
+      return column;
+    }
+
+    private static int[] ints(ByteBuffer buffer, int rows) {
+      int[] column = new int[rows];
+      buffer.asIntBuffer().get(column);
+      buffer.position(buffer.position() + rows * 4);
+      return column;
+    }
+  }
+}
@@ -3,8 +3,16 @@ package io.opentraffic.datastore.source;
 import java.io.File;
 import java.io.IOException;
 import java.nio.ByteBuffer;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.security.MessageDigest;
+import java.security.NoSuchAlgorithmException;
 import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.HashSet;
 import java.util.Iterator;
+import java.util.List;
+import java.util.Set;
 
 import org.apache.commons.io.IOUtils;
 
@@ -25,10 +33,71 @@ public class FlatBufferSource extends Source {
   public FlatBufferSource(File file, TimeBucket timeBucket, long tileId) throws IOException {
     bucket = timeBucket;
     tile = tileId;
-    histogram = Histogram.getRootAsHistogram(ByteBuffer.wrap(IOUtils.toByteArray(file.toURI())));
+    //flatbuffers dont check anything up front, so make sure this looks like a histogram before relying on it
+    try {
+      histogram = Histogram.getRootAsHistogram(ByteBuffer.wrap(IOUtils.toByteArray(file.toURI())));
+      for (int i = 0; i < histogram.segmentsLength(); i++)
+        histogram.segments(i).entriesLength();
+    } catch (IndexOutOfBoundsException e) {
+      throw new IOException("Not a valid histogram: " + file, e);
+    }
     measurements = new ArrayList<Measurement>();
   }
 
+  /**
+   * Rather than being rewritten every time more data arrives, a histogram can have small deltas sitting next to it in
+   * a directory named after it with a .d on the end. Reading the histogram means reading those too.
+   *
+   * @return the histogram followed by its deltas, if it has any
+   */
+  public static List<File> withDeltas(File file) {
+    ArrayList<File> files = new ArrayList<File>();
+    files.add(file);
+    File[] deltas = new File(file.getPath() + ".d").listFiles();
+    if (deltas != null) {
+      Set<String> folded = folded(file);
+      Arrays.sort(deltas);
+      for (File delta : deltas)
+        if (delta.isFile() && delta.getName().endsWith(".fb") && !folded.contains(delta.getName()))
+          files.add(delta);
+    }
+    return files;
+  }
+
+  /**
+   * A compaction that died before removing the deltas it folded into the histogram leaves a record of them in a file
+   * named folded in the .d directory: the md5 of the histogram they went into and then the name of each delta. It only
+   * counts if that histogram is the one that is actually there.
+   *
+   * @return the names of the deltas that are already in the histogram
+   */
+  public static Set<String> folded(File file) {
+    Set<String> folded = new HashSet<String>();
+    File record = new File(file.getPath() + ".d", "folded");
+    if (!record.isFile())
+      return folded;
+    try {
+      List<String> lines = Files.readAllLines(record.toPath(), StandardCharsets.UTF_8);
+      StringBuilder digest = new StringBuilder();
+      for (byte b : MessageDigest.getInstance("MD5").digest(Files.readAllBytes(file.toPath())))
+        digest.append(String.format("%02x", b));
+      if (lines.isEmpty() || !lines.get(0).trim().equals(digest.toString()))
+        return folded;
+      for (String line : lines.subList(1, lines.size()))
+        if (!line.trim().isEmpty())
+          folded.add(line.trim());
+    } catch (IOException | NoSuchAlgorithmException e) {
+      throw new RuntimeException("Failed to read " + record, e);
+    }
+    return folded;
+  }
+
+  //segments are stored in order and the entries in each were sorted when the histogram was written
+  @Override
+  public boolean sorted() {
+    return true;
+  }
+
   @Override
   public Iterator<Measurement> iterator() {
     return new Iterator<Measurement>() {
@@ -6,4 +6,12 @@ import io.opentraffic.datastore.Measurement;
 
 public abstract class Source implements Iterable<Measurement>, Closeable{
 
+  /**
+   * @return whether the measurements come out already sorted by Aggregator.KEY, in which case they can be merged as
+   *         a run instead of being combined one at a time
+   */
+  public boolean sorted() {
+    return false;
+  }
+
 }
@@ -0,0 +1,57 @@
+package io.opentraffic.datastore;
+
+import static org.junit.Assert.assertEquals;
+
+import java.util.ArrayList;
+import java.util.Arrays;
+
+import org.junit.Test;
+
+public class AggregatorTest {
+
+  private Measurement m(long segment, long next, int duration, int count) {
+    return new Measurement(VehicleType.AUTO, segment << 25L, next, 100, 50, duration, count, null, 0, 1);
+  }
+
+  @Test
+  public void testCombinesSameBucket() {
+    Aggregator aggregator = new Aggregator();
+    // 100 and 101 share a duration bucket, 60 does not
+    aggregator.add(m(2, 7, 100, 1));
+    aggregator.add(m(1, 7, 60, 1));
+    aggregator.add(m(2, 7, 101, 3));
+    aggregator.add(m(2, 3, 100, 1));
+    assertEquals(3, aggregator.size());
+
+    ArrayList<Measurement> merged = aggregator.merge();
+    assertEquals(3, merged.size());
+    assertEquals(1L << 25L, merged.get(0).segmentId);
+    assertEquals(3L, merged.get(1).nextSegmentId);
+    assertEquals(4, merged.get(2).count);
+    assertEquals(DurationBucket.quantise(100), DurationBucket.quantise(merged.get(2).duration));
+    assertEquals(0.5f, merged.get(2).queue, 0.0001f);
+  }
+
+  @Test
+  public void testMergesRuns() {
+    Aggregator aggregator = new Aggregator();
+    aggregator.add(m(3, 1, 30, 1));
+    aggregator.add(m(1, 1, 30, 1));
+    aggregator.addRun(Arrays.asList(m(1, 1, 30, 2), m(2, 1, 30, 1), m(3, 1, 30, 5)).iterator());
+    aggregator.addRun(Arrays.asList(m(2, 1, 30, 1), m(4, 1, 30, 1)).iterator());
+    aggregator.addRun(new ArrayList<Measurement>().iterator());
+
+    ArrayList<Measurement> merged = aggregator.merge();
+    assertEquals(4, merged.size());
+    int[] counts = { 3, 2, 6, 1 };
+    for (int i = 0; i < counts.length; i++) {
+      assertEquals(i + 1, merged.get(i).getTileRelative());
+      assertEquals(counts[i], merged.get(i).count);
+    }
+  }
+
+  @Test
+  public void testNothing() {
+    assertEquals(0, new Aggregator().merge().size());
+  }
+}
@@ -0,0 +1,175 @@
+package io.opentraffic.datastore;
+
+import static org.junit.Assert.assertEquals;
+import static org.junit.Assert.assertTrue;
+
+import java.io.File;
+import java.io.IOException;
+import java.nio.ByteBuffer;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.security.MessageDigest;
+import java.util.ArrayList;
+import java.util.Arrays;
+
+import org.apache.commons.cli.CommandLine;
+import org.apache.commons.cli.DefaultParser;
+import org.junit.Rule;
+import org.junit.Test;
+import org.junit.rules.TemporaryFolder;
+
+import io.opentraffic.datastore.flatbuffer.Histogram;
+
+public class MainTest {
+
+  private static final String HEADER = "segment_id,next_segment_id,duration,count,length,queue_length,minimum_timestamp,maximum_timestamp,source,vehicle_type\n";
+
+  @Rule
+  public TemporaryFolder folder = new TemporaryFolder();
+
+  private File csv(String name, String... rows) throws IOException {
+    File file = folder.newFile(name);
+    StringBuilder builder = new StringBuilder(HEADER);
+    for (String row : rows)
+      builder.append(row).append('\n');
+    Files.write(file.toPath(), builder.toString().getBytes(StandardCharsets.UTF_8));
+    return file;
+  }
+
+  private Histogram read(File file) throws IOException {
+    return Histogram.getRootAsHistogram(ByteBuffer.wrap(Files.readAllBytes(file.toPath())));
+  }
+
+  @Test
+  public void testRunJobs() throws Exception {
+    // segments 5 and 6 of level 0 tile 2140 in the hour starting at 1478023200
+    File a = csv("a.csv", "167789280,201343712,60,1,500,0,1478023300,1478023360,foo,AUTO");
+    File b = csv("b.csv", "201343712,,30,2,500,0,1478023400,1478023430,foo,AUTO");
+    File first = new File(folder.getRoot(), "first.fb");
+    File second = new File(folder.getRoot(), "second.fb");
+    File jobs = folder.newFile("jobs.txt");
+    Files.write(jobs.toPath(), Arrays.asList(
+        "# time bucket, tile, output, inputs",
+        "410562\t17120\t" + first + "\t" + a + "\t" + b,
+        "",
+        "not a job",
+        "410562\t17120\t" + second + "\t" + b), StandardCharsets.UTF_8);
+
+    CommandLine cmd = new DefaultParser().parse(Main.createOptions(), new String[] { "--jobs", jobs.toString() });
+    assertEquals(1, Main.runJobs(cmd, cmd.getOptionValue("jobs")));
+
+    assertTrue(first.isFile());
+    Histogram h = read(first);
+    assertEquals(17120, h.tileId());
+    assertEquals(7, h.segmentsLength());
+    assertEquals(1, h.segments(5).entriesLength());
+    assertEquals(1, h.segments(6).entriesLength());
+
+    assertTrue(second.isFile());
+    h = read(second);
+    assertEquals(7, h.segmentsLength());
+    assertEquals(0, h.segments(5).entriesLength());
+    assertEquals(2, h.segments(6).entries(0).count());
+  }
+
+  @Test
+  public void testRunJobsMergesExisting() throws Exception {
+    File a = csv("a.csv", "167789280,201343712,60,1,500,0,1478023300,1478023360,foo,AUTO");
+    File out = new File(folder.getRoot(), "out.fb");
+    File jobs = folder.newFile("jobs.txt");
+    // the second job folds the same data into the output of the first
+    Files.write(jobs.toPath(), Arrays.asList(
+        "410562\t17120\t" + out + "\t" + a,
+        "410562\t17120\t" + out + "\t" + out + "\t" + a), StandardCharsets.UTF_8);
+
+    CommandLine cmd = new DefaultParser().parse(Main.createOptions(), new String[] {});
+    assertEquals(0, Main.runJobs(cmd, jobs.toString()));
+    Histogram h = read(out);
+    assertEquals(1, h.segments(5).entriesLength());
+    assertEquals(2, h.segments(5).entries(0).count());
+  }
+
+  @Test
+  public void testRunParsesConcurrently() throws Exception {
+    ArrayList<String> inputs = new ArrayList<String>();
+    for (int i = 0; i < 10; i++)
+      inputs.add(csv(i + ".csv", "167789280,201343712,60,1,500,0,1478023300,1478023360,foo,AUTO",
+          "201343712,,30," + (i + 1) + ",500,0,1478023400,1478023430,foo,AUTO").toString());
+    inputs.add(new File(folder.getRoot(), "missing.csv").toString());
+    File out = new File(folder.getRoot(), "out.fb");
+
+    CommandLine cmd = new DefaultParser().parse(Main.createOptions(), new String[] { "--parse-threads", "3" });
+    assertEquals(2, Main.run(cmd, new TimeBucket(BucketSize.HOURLY, 410562), 17120, inputs, out.toString(), null, false));
+    Histogram h = read(out);
+    assertEquals(10, h.segments(5).entries(0).count());
+    assertEquals(55, h.segments(6).entries(0).count());
+  }
+
+  @Test
+  public void testRunReadsDeltas() throws Exception {
+    File a = csv("a.csv", "167789280,201343712,60,1,500,0,1478023300,1478023360,foo,AUTO");
+    File base = new File(folder.getRoot(), "base.fb");
+    CommandLine cmd = new DefaultParser().parse(Main.createOptions(), new String[] {});
+    TimeBucket bucket = new TimeBucket(BucketSize.HOURLY, 410562);
+    Main.run(cmd, bucket, 17120, Arrays.asList(a.toString()), base.toString(), null, false);
+
+    // a couple of deltas next to it, one of which isnt a histogram
+    File deltas = folder.newFolder("base.fb.d");
+    Files.copy(base.toPath(), new File(deltas, "1.fb").toPath());
+    Files.copy(base.toPath(), new File(deltas, "2.fb").toPath());
+    Files.write(new File(deltas, "junk.txt").toPath(), "junk".getBytes(StandardCharsets.UTF_8));
+
+    File out = new File(folder.getRoot(), "out.fb");
+    assertEquals(1, Main.run(cmd, bucket, 17120, Arrays.asList(base.toString()), out.toString(), null, false));
+    assertEquals(3, read(out).segments(5).entries(0).count());
+  }
+
+  @Test
+  public void testRunSkipsFoldedDeltas() throws Exception {
+    File a = csv("a.csv", "167789280,201343712,60,1,500,0,1478023300,1478023360,foo,AUTO");
+    File base = new File(folder.getRoot(), "base.fb");
+    CommandLine cmd = new DefaultParser().parse(Main.createOptions(), new String[] {});
+    TimeBucket bucket = new TimeBucket(BucketSize.HOURLY, 410562);
+    Main.run(cmd, bucket, 17120, Arrays.asList(a.toString()), base.toString(), null, false);
+    File deltas = folder.newFolder("base.fb.d");
+    Files.copy(base.toPath(), new File(deltas, "1.fb").toPath());
+    Files.copy(base.toPath(), new File(deltas, "2.fb").toPath());
+
+    // a compaction that died after folding 1.fb into this histogram
+    StringBuilder digest = new StringBuilder();
+    for (byte b : MessageDigest.getInstance("MD5").digest(Files.readAllBytes(base.toPath())))
+      digest.append(String.format("%02x", b));
+    File record = new File(deltas, "folded");
+    Files.write(record.toPath(), (digest + "\n1.fb\n").getBytes(StandardCharsets.UTF_8));
+    File out = new File(folder.getRoot(), "out.fb");
+    assertEquals(1, Main.run(cmd, bucket, 17120, Arrays.asList(base.toString()), out.toString(), null, false));
+    assertEquals(2, read(out).segments(5).entries(0).count());
+
+    // the record is for some other histogram so every delta counts
+    Files.write(record.toPath(), "0123\n1.fb\n".getBytes(StandardCharsets.UTF_8));
+    File other = new File(folder.getRoot(), "other.fb");
+    assertEquals(1, Main.run(cmd, bucket, 17120, Arrays.asList(base.toString()), other.toString(), null, false));
+    assertEquals(3, read(other).segments(5).entries(0).count());
+  }
+
+  @Test
+  public void testRunJobsFailsOnCorruptDelta() throws Exception {
+    File a = csv("a.csv", "167789280,201343712,60,1,500,0,1478023300,1478023360,foo,AUTO");
+    File base = new File(folder.getRoot(), "base.fb");
+    CommandLine cmd = new DefaultParser().parse(Main.createOptions(), new String[] {});
+    Main.run(cmd, new TimeBucket(BucketSize.HOURLY, 410562), 17120, Arrays.asList(a.toString()), base.toString(), null, false);
+
+    // one good delta and one that got cut off part way
+    File deltas = folder.newFolder("base.fb.d");
+    Files.copy(base.toPath(), new File(deltas, "1.fb").toPath());
+    byte[] bytes = Files.readAllBytes(base.toPath());
+    Files.write(new File(deltas, "2.fb").toPath(), Arrays.copyOf(bytes, 6));
+
+    // compacting has to fail rather than write a histogram without the corrupt delta's data
+    File out = new File(folder.getRoot(), "out.fb");
+    File jobs = folder.newFile("jobs.txt");
+    Files.write(jobs.toPath(), Arrays.asList("410562\t17120\t" + out + "\t" + base + "\t" + a), StandardCharsets.UTF_8);
+    assertEquals(1, Main.runJobs(cmd, jobs.toString()));
+    assertTrue(!out.exists());
+  }
+}
@@ -0,0 +1,104 @@
+package io.opentraffic.datastore.source;
+
+import static org.junit.Assert.assertEquals;
+import static org.junit.Assert.assertNull;
+
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataOutputStream;
+import java.io.IOException;
+import java.nio.charset.StandardCharsets;
+import java.util.ArrayList;
+import java.util.zip.GZIPOutputStream;
+
+import org.junit.Test;
+
+import io.opentraffic.datastore.BucketSize;
+import io.opentraffic.datastore.Measurement;
+import io.opentraffic.datastore.TimeBucket;
+
+public class ColumnarSourceTest {
+
+  // the same layout scripts/csv_to_columns.py writes, one block per array of segment ids
+  private byte[] write(long[]... blocks) throws IOException {
+    ByteArrayOutputStream bytes = new ByteArrayOutputStream();
+    DataOutputStream out = new DataOutputStream(new GZIPOutputStream(bytes));
+    out.write(ColumnarSource.MAGIC);
+    out.writeInt(ColumnarSource.VERSION);
+    for (long[] segmentIds : blocks) {
+      int rows = segmentIds.length;
+      ByteArrayOutputStream blockBytes = new ByteArrayOutputStream();
+      DataOutputStream block = new DataOutputStream(blockBytes);
+      byte[] source = "foo".getBytes(StandardCharsets.UTF_8);
+      block.writeInt(1);
+      block.writeInt(source.length);
+      block.write(source);
+      for (long id : segmentIds)
+        block.writeLong(id);
+      for (int i = 0; i < rows; i++)
+        block.writeLong(i == 0 ? Measurement.INVALID_NEXT_SEGMENT_ID : segmentIds[i - 1]);
+      for (int column = 0; column < 4; column++)
+        for (int i = 0; i < rows; i++)
+          block.writeInt(new int[] { 60 + i, 1 + i, 100, 50 }[column]);
+      for (int i = 0; i < rows; i++)
+        block.writeLong(3600 + i);
+      for (int i = 0; i < rows; i++)
+        block.writeLong(3660 + i);
+      for (int i = 0; i < rows; i++)
+        block.writeInt(i == 2 ? -1 : 0);
+      for (int i = 0; i < rows; i++)
+        block.writeByte(0);
+      out.writeInt(rows);
+      out.writeInt(blockBytes.size());
+      out.write(blockBytes.toByteArray());
+    }
+    out.close();
+    return bytes.toByteArray();
+  }
+
+  private ArrayList<Measurement> read(byte[] bytes, long tile) throws IOException {
+    ArrayList<Measurement> measurements = new ArrayList<Measurement>();
+    ColumnarSource source = new ColumnarSource(new ByteArrayInputStream(bytes), new TimeBucket(BucketSize.HOURLY, 1), tile);
+    for (Measurement m : source)
+      measurements.add(m);
+    source.close();
+    return measurements;
+  }
+
+  @Test
+  public void testRead() throws IOException {
+    // the middle block is empty and one of the segments is in some other tile
+    byte[] bytes = write(new long[] { 5L << 25L, (6L << 25L) | 8L, 7L << 25L }, new long[] {}, new long[] { 8L << 25L });
+    ArrayList<Measurement> measurements = read(bytes, 0);
+    assertEquals(3, measurements.size());
+
+    Measurement m = measurements.get(0);
+    assertEquals(5L, m.getTileRelative());
+    assertEquals(Measurement.INVALID_NEXT_SEGMENT_ID, m.nextSegmentId);
+    assertEquals(60, m.duration);
+    assertEquals(1, m.count);
+    assertEquals(0.5f, m.queue, 0.0001f);
+    assertEquals(3600L, m.minTimestamp);
+    assertEquals(3660L, m.maxTimestamp);
+    assertEquals("foo", m.source);
+
+    m = measurements.get(1);
+    assertEquals(7L, m.getTileRelative());
+    assertEquals((6L << 25L) | 8L, m.nextSegmentId);
+    assertEquals(62, m.duration);
+    assertEquals(3, m.count);
+    assertNull(m.source);
+
+    assertEquals(8L, measurements.get(2).getTileRelative());
+    assertEquals("foo", measurements.get(2).source);
+  }
+
+  @Test(expected = IOException.class)
+  public void testNotColumnar() throws IOException {
+    ByteArrayOutputStream bytes = new ByteArrayOutputStream();
+    GZIPOutputStream out = new GZIPOutputStream(bytes);
+    out.write("segment_id,next_segment_id".getBytes(StandardCharsets.UTF_8));
+    out.close();
+    read(bytes.toByteArray(), 0);
+  }
+}
@@ -14,9 +14,9 @@ if [[ ! -f ${PWD}/tests/work-data/flatbuffer.fb ]] || [[ ! -s ${PWD}/tests/work-
   exit 1
 fi
 
-#should have some text output
-measurements=$(cat ${PWD}/tests/work-data/1478023200_1478026799/0/2140/* | grep -cF AUTO)
-counted=$(grep -cF Measurement ${PWD}/tests/work-data/verbose.txt)
+#should have some text output, rows that share a histogram entry are combined so compare the total counts
+measurements=$(cat ${PWD}/tests/work-data/1478023200_1478026799/0/2140/* | grep -F AUTO | awk -F, '{s += $4} END {print s}')
+counted=$(grep -oE 'count=[0-9]+' ${PWD}/tests/work-data/verbose.txt | awk -F= '{s += $2} END {print s}')
 if [[ ${counted} != ${measurements} ]]; then
   echo "Failed to garner the right number of measurements"
   exit 1
@@ -28,8 +28,15 @@ docker run \
   -v ${PWD}/tests/work-data:/work \
   datastore:latest \
   sh -c 'datastore-histogram-tile-writer -b $((1478023200/3600)) -t $(((2140 << 3) | 0)) -v flatbuffer.fb /work/1478023200_1478026799/0/2140/* 1>verbose2.txt'
-doubled=$(grep -cF Measurement ${PWD}/tests/work-data/verbose2.txt)
+doubled=$(grep -oE 'count=[0-9]+' ${PWD}/tests/work-data/verbose2.txt | awk -F= '{s += $2} END {print s}')
 if [[ ${doubled} != $((counted*2)) ]]; then
   echo "Failed to garner the right number of measurements after folding"
   exit 1
 fi
+
+#unit test the python scripts against local stand ins
+docker run \
+  --name datastore-scripts \
+  -v ${PWD}:/datastore-src \
+  datastore:latest \
+  python3 -m unittest discover -s /datastore-src/tests -p 'test_*.py'
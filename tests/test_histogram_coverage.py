@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import histogram_coverage
+from test_work import DirectoryS3
+
+class CoverageTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.s3 = DirectoryS3(self.root)
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def put(self, key):
+    self.s3.put_object(Bucket='datastore', Key=key, Body='h')
+
+  def test_week_hour(self):
+    #new year's day 2017 is the sunday at the end of the last week of 2016, the next day starts the first week of 2017
+    self.assertEqual(histogram_coverage.week_hour(1483228800), ('2016/52', 144))
+    self.assertEqual(histogram_coverage.week_hour(1483315200 + 3599), ('2017/01', 0))
+    self.assertEqual(histogram_coverage.week_start('2016/52'), 1483228800 - 6 * 86400)
+
+  def test_partial_index(self):
+    #one histogram was marked as it was written, the other was there from before
+    histogram_coverage.mark(self.s3, 'datastore', 1483315200 + 5 * 3600, 0, 2415)
+    self.put('2017/1/2/5/0/2415.fb')
+    self.put('2017/1/4/23/1/37740.fb')
+    self.put('2017/1/4/23/1/37740.fb.d/1483315200_1483318799.1.fb')
+    #the week after shouldnt be touched
+    self.put('2017/1/9/0/0/7.fb')
+    self.assertEqual(histogram_coverage.covered_tiles(self.s3, 'datastore', '2017/01'), None)
+
+    self.assertEqual(histogram_coverage.backfill(self.s3, 'datastore', '2017/01'), 1)
+    self.assertEqual(histogram_coverage.covered_tiles(self.s3, 'datastore', '2017/01'), {0: set([2415]), 1: set([37740])})
+    self.assertEqual(histogram_coverage.covered_hours(self.s3, 'datastore', '2017/01', 1, 37740), [71])
+    self.assertEqual(histogram_coverage.covered_tiles(self.s3, 'datastore', '2017/02'), None)
+    #nothing left to do the second time around
+    self.assertEqual(histogram_coverage.backfill(self.s3, 'datastore', '2017/01'), 0)
+
+  def test_empty_week(self):
+    histogram_coverage.backfill(self.s3, 'datastore', '2017/01')
+    self.assertEqual(histogram_coverage.covered_tiles(self.s3, 'datastore', '2017/01'), {})
+
+  def test_unpadded_week(self):
+    #the week can be given the way people write it and still finds the markers
+    self.put('2017/1/2/5/0/2415.fb')
+    self.assertEqual(histogram_coverage.backfill(self.s3, 'datastore', '2017/1'), 1)
+    self.assertEqual(histogram_coverage.covered_tiles(self.s3, 'datastore', '2017/1'), {0: set([2415])})
+    self.assertEqual(histogram_coverage.covered_tiles(self.s3, 'datastore', '2017/01/'), {0: set([2415])})
+    self.assertEqual(histogram_coverage.covered_hours(self.s3, 'datastore', '2017/1', 0, 2415), [5])
+
+if __name__ == '__main__':
+  unittest.main()
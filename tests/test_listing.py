@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import listing
+from test_work import DirectoryS3
+
+class SlowS3(DirectoryS3):
+  """Takes a while to answer so we can see how many listings are in flight at once"""
+
+  def __init__(self, root):
+    super(SlowS3, self).__init__(root)
+    self.lock = threading.Lock()
+    self.in_flight = 0
+    self.most_in_flight = 0
+
+  def list_objects_v2(self, **kwargs):
+    with self.lock:
+      self.in_flight += 1
+      self.most_in_flight = max(self.most_in_flight, self.in_flight)
+    time.sleep(0.01)
+    try:
+      return super(SlowS3, self).list_objects_v2(**kwargs)
+    finally:
+      with self.lock:
+        self.in_flight -= 1
+
+class ListingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.s3 = SlowS3(self.root)
+    self.keys = []
+    for hour in range(0, 6):
+      for level in range(0, 3):
+        for tile in range(0, 3):
+          key = '%d_%d/%d/%d/data' % (hour * 3600, hour * 3600 + 3599, level, tile * 100 + hour)
+          self.s3.put_object(Bucket='reporter', Key=key, Body='data')
+          self.keys.append(key)
+    self.s3.calls = []
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def walk(self, concurrency):
+    hours, _ = listing.get_prefixes_keys(self.s3, 'reporter', [''], concurrency)
+    levels, _ = listing.get_prefixes_keys(self.s3, 'reporter', hours, concurrency)
+    tiles, _ = listing.get_prefixes_keys(self.s3, 'reporter', levels, concurrency)
+    _, keys = listing.get_prefixes_keys(self.s3, 'reporter', tiles, concurrency)
+    return hours, levels, tiles, keys
+
+  def test_same_as_sequential(self):
+    sequential = self.walk(1)
+    self.assertEqual(self.s3.most_in_flight, 1)
+    self.assertEqual(sorted(sequential[3]), sorted(self.keys))
+    self.assertEqual(len(sequential[2]), len(self.keys))
+    self.s3.most_in_flight = 0
+    self.assertEqual(self.walk(8), sequential)
+    self.assertGreater(self.s3.most_in_flight, 1)
+    self.assertLessEqual(self.s3.most_in_flight, 8)
+
+  def test_nothing(self):
+    self.assertEqual(listing.get_prefixes_keys(self.s3, 'reporter', []), ([], []))
+    self.assertEqual(listing.get_prefixes_keys(self.s3, 'reporter', ['nope/', 'nada/']), ([], []))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import shutil
+import tempfile
+import json
+import unittest
+import importlib.util
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+spec = importlib.util.spec_from_file_location('submit_work_service', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'submit-work-service.py'))
+service = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(service)
+
+class FakeBatch(object):
+  """A stand in for the bits of the batch client the service uses, jobs stay runnable until told otherwise"""
+
+  def __init__(self):
+    self.status = {}
+    self.submitted = []
+
+  def submit_job(self, **kwargs):
+    job_id = 'job%d' % (len(self.submitted) + 1)
+    self.status[job_id] = 'RUNNABLE'
+    self.submitted.append(kwargs['containerOverrides']['command'][6:])
+    return {'jobId': job_id}
+
+  def describe_jobs(self, jobs):
+    return {'jobs': [{'jobId': j, 'status': self.status[j]} for j in jobs if j in self.status]}
+
+  def list_jobs(self, jobQueue, jobStatus, nextToken=None):
+    #one job per page so paging gets exercised
+    jobs = sorted([j for j, status in self.status.items() if status == jobStatus])
+    start = int(nextToken or 0)
+    response = {'jobSummaryList': [{'jobId': j} for j in jobs[start:start + 1]]}
+    if start + 1 < len(jobs):
+      response['nextToken'] = str(start + 1)
+    return response
+
+def tile(hour, level=0, index=2415, start=0, end=3599):
+  return '%d_%d/%d/%d/' % (hour * 3600 + start, hour * 3600 + end, level, index)
+
+class SubmitTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.state_file = os.path.join(self.root, 'state', 'state.json')
+    self.batch = FakeBatch()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def submit(self, tiles, max_in_flight=2, max_attempts=2, limits=(1000, 10 ** 9, 1)):
+    #one pass of the service, just like the polling loop
+    state = service.load_state(self.state_file)
+    service.update_state(self.batch, state)
+    waiting = service.submit(tiles, state, self.batch, 'queue', 'def', 'reporter', 'datastore', self.state_file, limits,
+      max_in_flight, max_attempts)
+    return state, waiting
+
+  def test_pack_tiles(self):
+    #the two halves of one hour go into the same histogram so they stay together, even when they dont fit
+    tiles = {tile(1, start=0, end=1799): (10, 100), tile(1, start=1800): (10, 100), tile(2): (5, 50), tile(3): (5, 50), tile(4): (3000, 1)}
+    jobs = service.pack_tiles(tiles, 2000, 10 ** 9, 2)
+    self.assertEqual(sorted([sorted(job) for job in jobs]), sorted([[tile(4)], [tile(1, start=0, end=1799), tile(1, start=1800)], sorted([tile(2), tile(3)])]))
+
+  def test_oldest_first_with_room(self):
+    tiles = dict([(tile(h), (1, 1)) for h in range(5, 0, -1)])
+    state, waiting = self.submit(tiles)
+    self.assertEqual(self.batch.submitted, [[tile(1)], [tile(2)]])
+    self.assertEqual(sorted(waiting), [tile(3), tile(4), tile(5)])
+    #nothing finished so there is no room, and nothing is submitted twice
+    state, waiting = self.submit(tiles)
+    self.assertEqual(len(self.batch.submitted), 2)
+    self.assertEqual(sorted(state['jobs'].values()), [[tile(1)], [tile(2)]])
+
+  def test_same_histogram_not_in_flight_twice(self):
+    self.submit({tile(1, start=0, end=1799): (1, 1)})
+    #the other half of the same hour and tile has to wait for the first job, another tile doesnt
+    state, waiting = self.submit({tile(1, start=1800): (1, 1), tile(1, index=7): (1, 1)})
+    self.assertEqual(self.batch.submitted, [[tile(1, start=0, end=1799)], [tile(1, index=7)]])
+    self.assertEqual(list(waiting), [tile(1, start=1800)])
+    self.batch.status['job1'] = 'SUCCEEDED'
+    self.submit({tile(1, start=1800): (1, 1)})
+    self.assertEqual(self.batch.submitted[-1], [tile(1, start=1800)])
+
+  def test_failures_retried_then_given_up(self):
+    tiles = {tile(1): (1, 1)}
+    for attempt in range(2):
+      self.submit(tiles)
+      self.batch.status['job%d' % (attempt + 1)] = 'FAILED'
+    state, waiting = self.submit(tiles)
+    self.assertEqual(len(self.batch.submitted), 2)
+    self.assertEqual(state['failures'], {tile(1): 2})
+    #once the data is gone so is the failure
+    state, waiting = self.submit({})
+    self.assertEqual(state['failures'], {})
+
+  def test_failures_keep_their_size(self):
+    self.submit({tile(1): (3, 30), tile(2): (1, 10)})
+    self.batch.status['job1'] = 'FAILED'
+    self.batch.status['job2'] = 'SUCCEEDED'
+    #the state is read back in like it would be after a restart, the size survives that too
+    state = service.load_state(self.state_file)
+    self.assertEqual(service.update_state(self.batch, state), {tile(1): (3, 30)})
+    self.assertEqual(state['sizes'], {})
+
+  def test_unknown_jobs(self):
+    #a lost state file means we dont know what the jobs in the queue are writing
+    self.submit({tile(1): (1, 1)})
+    os.remove(self.state_file)
+    state, waiting = self.submit({tile(2): (1, 1)})
+    self.assertEqual(len(self.batch.submitted), 1)
+    self.assertEqual(list(waiting), [tile(2)])
+    self.batch.status['job1'] = 'SUCCEEDED'
+    self.submit({tile(2): (1, 1)})
+    self.assertEqual(self.batch.submitted, [[tile(1)], [tile(2)]])
+
+class FakeSqs(object):
+  """Hands out the given bodies as one batch of messages and remembers what got deleted"""
+
+  def __init__(self, bodies):
+    self.bodies = bodies
+    self.deleted = []
+
+  def receive_message(self, QueueUrl, MaxNumberOfMessages, WaitTimeSeconds):
+    messages = [{'MessageId': str(i), 'ReceiptHandle': 'handle%d' % i, 'Body': b} for i, b in enumerate(self.bodies)]
+    self.bodies = []
+    return {'Messages': messages} if messages else {}
+
+  def delete_message_batch(self, QueueUrl, Entries):
+    self.deleted.extend([e['ReceiptHandle'] for e in Entries])
+
+def notification(event, key, size=10):
+  return {'Records': [{'eventName': event, 's3': {'object': {'key': key, 'size': size}}}]}
+
+class EventTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.state_file = os.path.join(self.root, 'state.json')
+    self.batch = FakeBatch()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def test_batcher(self):
+    batcher = service.EventBatcher(10)
+    batcher.add(tile(1), 1, 5, 100)
+    batcher.add(tile(1), 1, 5, 105)
+    batcher.add(tile(2), 1, 5, 100)
+    #only the one nothing has happened to for long enough comes out, with everything that was added for it
+    self.assertEqual(batcher.quiet(111), {tile(2): (1, 5)})
+    self.assertEqual(batcher.quiet(111), {})
+    self.assertEqual(batcher.quiet(115), {tile(1): (2, 10)})
+    #the ones that had to wait are ready straight away next time
+    batcher.update({tile(3): (4, 40)})
+    self.assertEqual(batcher.quiet(115), {tile(3): (4, 40)})
+
+  def test_sqs_events(self):
+    raw = json.dumps(notification('ObjectCreated:Put', tile(1) + 'a+file%3D.csv'))
+    sns = json.dumps({'Type': 'Notification', 'Message': json.dumps(notification('ObjectCreated:CompleteMultipartUpload', tile(2) + 'b', 20))})
+    removed = json.dumps(notification('ObjectRemoved:Delete', tile(1) + 'c'))
+    sqs = FakeSqs([raw, sns, removed, 'not json'])
+    events = service.sqs_events(sqs, 'queue')
+    self.assertEqual(next(events), [(tile(1) + 'a file=.csv', 10), (tile(2) + 'b', 20)])
+    #everything is deleted, even what we couldnt use, so it doesnt come back forever
+    self.assertEqual(sqs.deleted, ['handle0', 'handle1', 'handle2', 'handle3'])
+    self.assertEqual(next(events), [])
+
+  def test_directory_events(self):
+    os.makedirs(os.path.join(self.root, 'drop', tile(1)))
+    with open(os.path.join(self.root, 'drop', tile(1), 'a'), 'w') as f:
+      f.write('abc')
+    events = service.directory_events(os.path.join(self.root, 'drop'), 0)
+    self.assertEqual(next(events), [(tile(1) + 'a', 3)])
+    self.assertEqual(next(events), [])
+
+  def listen(self, events, listed, failures=None):
+    state = service.load_state(self.state_file)
+    state['failures'] = failures or {}
+    submit = lambda tiles: service.submit(tiles, state, self.batch, 'queue', 'def', 'reporter', 'datastore', self.state_file,
+      (1000, 10 ** 9, 1), 2, 2, False)
+    service.listen(events, service.EventBatcher(0), state, self.batch, 0, 3600, lambda: listed, submit)
+    return state
+
+  def test_retry(self):
+    def events():
+      yield [(tile(1) + 'a', 10)]
+      #the job fails, so the time tile goes back in and gets another job
+      self.batch.status['job1'] = 'FAILED'
+      yield []
+      self.batch.status['job2'] = 'FAILED'
+      yield []
+    state = self.listen(events(), {})
+    self.assertEqual(self.batch.submitted, [[tile(1)], [tile(1)]])
+    self.assertEqual(state['failures'], {tile(1): 2})
+
+  def test_reconcile(self):
+    #the first listing picks up what was there before we started and forgets failures for whatever is gone
+    state = self.listen(iter([[]]), {tile(1): (1, 1)}, {tile(1): 1, tile(2): 2})
+    self.assertEqual(self.batch.submitted, [[tile(1)]])
+    self.assertEqual(state['failures'], {tile(1): 1})
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import hashlib
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import work
+
+class DirectoryS3(object):
+  """A stand in for the bits of the s3 client the scripts use, objects are files under a directory"""
+
+  def __init__(self, root):
+    self.root = root
+    self.calls = []
+    #key -> how many more times deleting it should fail
+    self.failing = {}
+    #how many more delete_objects calls should blow up entirely
+    self.broken = 0
+
+  def path(self, bucket, key):
+    return os.path.join(self.root, bucket, key)
+
+  def put_object(self, Bucket, Key, Body, **kwargs):
+    self.calls.append(('put_object', Key))
+    path = self.path(Bucket, Key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+      f.write(Body if isinstance(Body, bytes) else Body.read() if hasattr(Body, 'read') else Body.encode())
+
+  def etag(self, Bucket, Key):
+    with open(self.path(Bucket, Key), 'rb') as f:
+      return '"' + hashlib.md5(f.read()).hexdigest() + '"'
+
+  def head_object(self, Bucket, Key):
+    self.calls.append(('head_object', Key))
+    if not os.path.isfile(self.path(Bucket, Key)):
+      raise work.ClientError({'Error': {'Code': '404'}, 'ResponseMetadata': {'HTTPStatusCode': 404}}, 'HeadObject')
+    return {'ETag': self.etag(Bucket, Key)}
+
+  def get_object(self, Bucket, Key):
+    self.calls.append(('get_object', Key))
+    if not os.path.isfile(self.path(Bucket, Key)):
+      raise work.ClientError({'Error': {'Code': 'NoSuchKey'}, 'ResponseMetadata': {'HTTPStatusCode': 404}}, 'GetObject')
+    with open(self.path(Bucket, Key), 'rb') as f:
+      return {'Body': io.BytesIO(f.read())}
+
+  def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, ContinuationToken=None, MaxKeys=2):
+    #small pages so paging gets exercised
+    self.calls.append(('list_objects_v2', Prefix))
+    keys = []
+    for root, dirs, files in os.walk(os.path.join(self.root, Bucket)):
+      keys.extend([os.path.relpath(os.path.join(root, f), os.path.join(self.root, Bucket)) for f in files])
+    #anything past the delimiter gets rolled up into a common prefix
+    entries = set()
+    for key in keys:
+      if not key.startswith(Prefix):
+        continue
+      cut = key.find(Delimiter, len(Prefix)) if Delimiter else -1
+      entries.add(key if cut < 0 else key[:cut + 1])
+    entries = sorted(entries)
+    start = int(ContinuationToken or 0)
+    page = entries[start:start + MaxKeys]
+    objects = {
+      'Contents': [{'Key': k, 'Size': os.path.getsize(self.path(Bucket, k)), 'ETag': self.etag(Bucket, k)} for k in page if not k.endswith('/')],
+      'CommonPrefixes': [{'Prefix': k} for k in page if k.endswith('/')]}
+    if start + MaxKeys < len(entries):
+      objects['NextContinuationToken'] = str(start + MaxKeys)
+    return objects
+
+  def delete_objects(self, Bucket, Delete):
+    keys = [o['Key'] for o in Delete['Objects']]
+    self.calls.append(('delete_objects', keys))
+    if len(keys) > 1000:
+      raise work.ClientError({'Error': {'Code': 'MalformedXML'}, 'ResponseMetadata': {'HTTPStatusCode': 400}}, 'DeleteObjects')
+    if self.broken:
+      self.broken -= 1
+      raise work.ClientError({'Error': {'Code': 'SlowDown'}, 'ResponseMetadata': {'HTTPStatusCode': 503}}, 'DeleteObjects')
+    response = {'Deleted': [], 'Errors': []}
+    for key in keys:
+      if self.failing.get(key, 0) > 0:
+        self.failing[key] -= 1
+        response['Errors'].append({'Key': key, 'Code': 'InternalError', 'Message': 'try again'})
+        continue
+      #deleting something that isnt there still counts as deleted
+      if os.path.isfile(self.path(Bucket, key)):
+        os.remove(self.path(Bucket, key))
+      if not Delete.get('Quiet'):
+        response['Deleted'].append({'Key': key})
+    return response
+
+  def Object(self, bucket, key):
+    #just enough of the s3 resource to download things
+    s3 = self
+    class Object(object):
+      def download_file(self, dest):
+        if not os.path.isfile(s3.path(bucket, key)):
+          raise work.ClientError({'Error': {'Code': '404'}, 'ResponseMetadata': {'HTTPStatusCode': 404}}, 'HeadObject')
+        s3.calls.append(('download_file', key))
+        shutil.copy(s3.path(bucket, key), dest)
+    return Object()
+
+class DirectorySession(object):
+  def __init__(self, s3):
+    self.s3 = s3
+
+  def resource(self, name):
+    return self.s3
+
+  def client(self, name):
+    return self.s3
+
+class DeleteTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.s3 = DirectoryS3(self.root)
+    self.client = work.boto3.client
+    self.sleep = work.time.sleep
+    work.boto3.client = lambda *args, **kwargs: self.s3
+    work.time.sleep = lambda secs: None
+
+  def tearDown(self):
+    work.boto3.client = self.client
+    work.time.sleep = self.sleep
+    shutil.rmtree(self.root)
+
+  def put(self, count):
+    keys = ['1483228800_1483232399/0/2415/%05d' % i for i in range(count)]
+    for key in keys:
+      self.s3.put_object(Bucket='reporter', Key=key, Body='data')
+    self.s3.calls = []
+    return keys
+
+  def remaining(self):
+    return [os.path.join(root, f) for root, dirs, files in os.walk(os.path.join(self.root, 'reporter')) for f in files]
+
+  def test_batches(self):
+    keys = self.put(2500)
+    work.delete(keys, 'reporter')
+    self.assertEqual(self.remaining(), [])
+    batches = [c[1] for c in self.s3.calls if c[0] == 'delete_objects']
+    self.assertEqual(sorted([len(b) for b in batches]), [500, 1000, 1000])
+    self.assertEqual(sorted([k for b in batches for k in b]), keys)
+    self.assertFalse([c for c in self.s3.calls if c[0] != 'delete_objects'])
+
+  def test_retries_only_failures(self):
+    keys = self.put(10)
+    self.s3.failing = {keys[3]: 2, keys[7]: 1}
+    work.delete(keys, 'reporter')
+    self.assertEqual(self.remaining(), [])
+    batches = [c[1] for c in self.s3.calls]
+    self.assertEqual(batches, [keys, [keys[3], keys[7]], [keys[3]]])
+
+  def test_retries_failed_call(self):
+    keys = self.put(5)
+    self.s3.broken = 2
+    work.delete(keys, 'reporter')
+    self.assertEqual(self.remaining(), [])
+    self.assertEqual([c[1] for c in self.s3.calls], [keys, keys, keys])
+
+  def test_nothing(self):
+    work.delete([], 'reporter')
+    self.assertEqual(self.s3.calls, [])
+
+class DeltaTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.s3 = DirectoryS3(self.root)
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def test_list_histograms(self):
+    dest_key = '2017/1/1/0/0/2415.fb'
+    self.assertEqual(work.list_histograms(self.s3, 'datastore', dest_key), (None, {}))
+    self.s3.put_object(Bucket='datastore', Key=dest_key, Body='0123456789')
+    #a different tile that shares the prefix
+    self.s3.put_object(Bucket='datastore', Key='2017/1/1/0/0/2415.fbx', Body='0')
+    deltas = [work.delta_key(dest_key, '1483228800_1483232399/0/2415'), '2017/1/1/0/0/2415.fb.d/1483228800_1483232399.1.fb']
+    for i, key in enumerate(deltas):
+      self.assertTrue(key.startswith(dest_key + '.d/1483228800_1483232399.') and key.endswith('.fb'))
+      self.s3.put_object(Bucket='datastore', Key=key, Body='0' * (i + 1))
+    self.assertEqual(work.list_histograms(self.s3, 'datastore', dest_key), (10, {deltas[0]: 1, deltas[1]: 2}))
+
+  def test_should_compact(self):
+    self.assertFalse(work.should_compact(100, {'a': 10, 'b': 0}, 3, 0.5))
+    self.assertTrue(work.should_compact(100, {'a': 10, 'b': 10, 'c': 0}, 3, 0.5))
+    self.assertTrue(work.should_compact(100, {'a': 50, 'b': 0}, 3, 0.5))
+
+class RunTest(unittest.TestCase):
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.cwd = os.getcwd()
+    os.makedirs(os.path.join(self.root, 'work'))
+    os.chdir(os.path.join(self.root, 'work'))
+    self.s3 = DirectoryS3(self.root)
+    self.jobs = []
+    self.patched = [(work.boto3, 'client'), (work.boto3.session, 'Session'), (work.listing, 's3_client'), (work.time, 'sleep'), (work, 'convert')]
+    self.originals = [getattr(o, a) for o, a in self.patched]
+    work.boto3.client = lambda *args, **kwargs: self.s3
+    work.boto3.session.Session = lambda *args, **kwargs: DirectorySession(self.s3)
+    work.listing.s3_client = lambda *args, **kwargs: self.s3
+    work.time.sleep = lambda secs: None
+    work.convert = self.convert
+
+  def tearDown(self):
+    for (o, a), original in zip(self.patched, self.originals):
+      setattr(o, a, original)
+    os.chdir(self.cwd)
+    shutil.rmtree(self.root)
+
+  def convert(self, jobs):
+    #the histogram is just the names of everything that went into it, unless one of them is corrupt
+    self.jobs.extend(jobs)
+    failed = set()
+    for time_bucket, tile_id, out, inputs in jobs:
+      names = [os.path.basename(i) for i in inputs]
+      if 'corrupt' in [self.read(f) for f in inputs if os.path.isfile(f)]:
+        failed.add(out)
+        continue
+      with open(out, 'w') as f:
+        f.write(' '.join(names))
+    return failed
+
+  def read(self, path):
+    with open(path) as f:
+      return f.read()
+
+  def get(self, bucket, key):
+    return self.read(self.s3.path(bucket, key))
+
+  def test_packed(self):
+    #two reporter prefixes in the same hour and tile, and another tile which already has a histogram
+    prefixes = ['1483228800_1483230599/0/2415/', '1483230600_1483232399/0/2415/', '1483228800_1483232399/1/37740/']
+    for i, prefix in enumerate(prefixes):
+      self.s3.put_object(Bucket='reporter', Key=prefix + 'data%d' % i, Body='data')
+    self.s3.put_object(Bucket='datastore', Key='2017/1/1/0/1/37740.fb', Body='old')
+    work.run(prefixes + ['1483228800_1483232399/0/1/'], 'reporter', 'datastore')
+
+    self.assertEqual(len(self.jobs), 2)
+    self.assertEqual([(j[0], j[1]) for j in self.jobs], [(412008, (2415 << 3) | 0), (412008, (37740 << 3) | 1)])
+    self.assertEqual(self.get('datastore', '2017/1/1/0/0/2415.fb'), 'data0 data1')
+    deltas = [k for k in work.list_histograms(self.s3, 'datastore', '2017/1/1/0/1/37740.fb')[1]]
+    self.assertEqual(len(deltas), 1)
+    self.assertEqual(self.get('datastore', deltas[0]), 'data2')
+    self.assertEqual(self.get('datastore', '2017/1/1/0/1/37740.fb'), 'old')
+    self.assertEqual(work.listing.get_prefixes_keys(self.s3, 'reporter', prefixes)[1], [])
+
+    #new year's day 2017 is the sunday at the end of the last week of 2016, the histogram that was already there has
+    #no marker though so the week cant be trusted until its backfilled
+    self.assertEqual(work.histogram_coverage.covered_hours(self.s3, 'datastore', '2016/52', 0, 2415), [144])
+    self.assertEqual(work.histogram_coverage.covered_hours(self.s3, 'datastore', '2016/52', 1, 37740), [144])
+    self.assertEqual(work.histogram_coverage.covered_tiles(self.s3, 'datastore', '2016/52'), None)
+
+  def test_compacts(self):
+    prefix = '1483228800_1483232399/0/2415/'
+    self.s3.put_object(Bucket='reporter', Key=prefix + 'data', Body='data')
+    self.s3.put_object(Bucket='datastore', Key='2017/1/1/0/0/2415.fb', Body='old')
+    for i in range(0, 2):
+      self.s3.put_object(Bucket='datastore', Key='2017/1/1/0/0/2415.fb.d/%d.fb' % i, Body='d')
+    self.s3.calls = []
+    work.run([prefix], 'reporter', 'datastore', max_deltas=3)
+
+    self.assertEqual(self.get('datastore', '2017/1/1/0/0/2415.fb'), '0.fb 1.fb 2415.fb data')
+    self.assertEqual(work.list_histograms(self.s3, 'datastore', '2017/1/1/0/0/2415.fb'), (22, {}))
+    #what was folded is written down before the histogram goes up and cleaned up after the deltas are gone
+    puts = [c[1] for c in self.s3.calls if c[0] == 'put_object' and c[1].startswith('2017/')]
+    self.assertEqual(puts, ['2017/1/1/0/0/2415.fb.d/folded', '2017/1/1/0/0/2415.fb'])
+    self.assertFalse(os.path.exists(self.s3.path('datastore', '2017/1/1/0/0/2415.fb.d/folded')))
+
+  def crashed(self, base, matches):
+    #a compaction that died after uploading the histogram but before removing the deltas it folded into it
+    prefix = '1483228800_1483232399/0/2415/'
+    self.s3.put_object(Bucket='reporter', Key=prefix + 'data', Body='data')
+    self.s3.put_object(Bucket='datastore', Key='2017/1/1/0/0/2415.fb', Body=base)
+    for i in range(0, 2):
+      self.s3.put_object(Bucket='datastore', Key='2017/1/1/0/0/2415.fb.d/%d.fb' % i, Body='d')
+    digest = hashlib.md5((base if matches else 'something else').encode()).hexdigest()
+    self.s3.put_object(Bucket='datastore', Key='2017/1/1/0/0/2415.fb.d/folded', Body=digest + '\n0.fb\n1.fb\n')
+    work.run([prefix], 'reporter', 'datastore')
+    return prefix
+
+  def test_crashed_compaction(self):
+    self.crashed('0.fb 1.fb old', True)
+    #the folded deltas are removed rather than being counted again, the new data is just a delta
+    self.assertEqual(self.get('datastore', '2017/1/1/0/0/2415.fb'), '0.fb 1.fb old')
+    deltas = work.list_histograms(self.s3, 'datastore', '2017/1/1/0/0/2415.fb')[1]
+    self.assertEqual([self.get('datastore', k) for k in deltas], ['data'])
+    self.assertFalse(os.path.exists(self.s3.path('datastore', '2017/1/1/0/0/2415.fb.d/folded')))
+
+  def test_crashed_before_upload(self):
+    self.crashed('old', False)
+    #the histogram never went up so the deltas are still the only place their data is, they get folded in this time
+    self.assertEqual(self.get('datastore', '2017/1/1/0/0/2415.fb'), '0.fb 1.fb 2415.fb data')
+    self.assertEqual(work.list_histograms(self.s3, 'datastore', '2017/1/1/0/0/2415.fb'), (22, {}))
+    self.assertFalse(os.path.exists(self.s3.path('datastore', '2017/1/1/0/0/2415.fb.d/folded')))
+
+  def test_corrupt_delta(self):
+    #a compaction that cant read one of the deltas, alongside a tile that is fine
+    prefixes = ['1483228800_1483232399/0/2415/', '1483228800_1483232399/0/7/']
+    for prefix in prefixes:
+      self.s3.put_object(Bucket='reporter', Key=prefix + 'data', Body='data')
+    self.s3.put_object(Bucket='datastore', Key='2017/1/1/0/0/2415.fb', Body='old')
+    self.s3.put_object(Bucket='datastore', Key='2017/1/1/0/0/2415.fb.d/0.fb', Body='d')
+    self.s3.put_object(Bucket='datastore', Key='2017/1/1/0/0/2415.fb.d/1.fb', Body='corrupt')
+    with self.assertRaises(SystemExit):
+      work.run(prefixes, 'reporter', 'datastore', max_deltas=2)
+
+    #nothing that went into the failed one is touched, not even to say it was folded
+    self.assertEqual(self.get('datastore', '2017/1/1/0/0/2415.fb'), 'old')
+    self.assertEqual(len(work.list_histograms(self.s3, 'datastore', '2017/1/1/0/0/2415.fb')[1]), 2)
+    self.assertFalse(os.path.exists(self.s3.path('datastore', '2017/1/1/0/0/2415.fb.d/folded')))
+    self.assertEqual(work.listing.get_prefixes_keys(self.s3, 'reporter', prefixes)[1], [prefixes[0] + 'data'])
+    #the other one still goes through
+    self.assertEqual(self.get('datastore', '2017/1/1/0/0/7.fb'), 'data')
+
+  def test_empty(self):
+    #nothing to do isnt a failure
+    work.run(['1483228800_1483232399/0/2415/'], 'reporter', 'datastore')
+    self.assertEqual(self.jobs, [])
+    self.assertEqual(work.listing.get_prefixes_keys(self.s3, 'datastore', [''])[1], [])
+
+if __name__ == '__main__':
+  unittest.main()